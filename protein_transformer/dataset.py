@@ -1,7 +1,6 @@
 import numpy as np
 import torch
 import torch.utils.data
-import wandb
 
 from protein_transformer.protein.Sequence import ProteinVocabulary, VOCAB
 from protein_transformer.protein.Structure import NUM_PREDICTED_COORDS
@@ -54,50 +53,112 @@ def collate_fn(insts, coords=False, sequences=False, max_seq_len=None):
     return batch
 
 
+# Per-protein information that the data converter stores alongside each split, see precompute_sequence_data
+PRECOMPUTED_KEYS = ["seq_ints", "has_missing", "lens"]
+
+
+def precompute_sequence_data(seqs, angs):
+    """
+    Given lists of sequences (strings) and angle matrices, this function
+    returns a dictionary with the integer-encoded sequences (int8 arrays,
+    without <sos>/<eos>), a boolean array flagging the proteins that contain
+    at least one entirely missing residue, and an array of sequence lengths.
+
+    The data converter stores these with each split so that the datasets
+    below do not need to recompute them at the start of every training run.
+    """
+    seq_ints = VOCAB.encode_batch(seqs, add_sos_eos=False, padded=False, dtype=np.int8)
+    has_missing = np.asarray([np.isnan(a).all(axis=-1).any() for a in angs], dtype=bool)
+    lens = np.asarray([len(s) for s in seqs], dtype=np.int32)
+    return {"seq_ints": seq_ints, "has_missing": has_missing, "lens": lens}
+
+
+def select_proteins(lens, has_missing, skip_missing_residues=True, sort_by_length=False, reverse_sort=False):
+    """
+    Returns an array with the indices of the proteins that a dataset should
+    hold, optionally skipping those with missing residues and (stably)
+    sorting them by length.
+    """
+    if skip_missing_residues:
+        idx = np.flatnonzero(~np.asarray(has_missing, dtype=bool))
+    else:
+        idx = np.arange(len(lens))
+    if sort_by_length:
+        sel_lens = np.asarray(lens)[idx]
+        idx = idx[np.argsort(-sel_lens if reverse_sort else sel_lens, kind="stable")]
+    return idx
+
+
+def sample_crop_start(ang, crop_len, observed_bias=0.):
+    """
+    Returns the first residue of a random, contiguous window of crop_len
+    residues within a protein with angles ang (L x NUM_PREDICTED_ANGLES*2).
+
+    If observed_bias is 0, windows are sampled uniformly. As observed_bias
+    approaches 1, windows are sampled in proportion to the number of observed
+    (not entirely missing) residues they contain.
+    """
+    num_windows = len(ang) - crop_len + 1
+    if num_windows <= 1:
+        return 0
+    if not observed_bias:
+        return np.random.randint(num_windows)
+    observed = np.concatenate(([0], np.cumsum(~np.isnan(ang).all(axis=-1))))
+    observed_frac = (observed[crop_len:] - observed[:num_windows]) / crop_len
+    weights = (1 - observed_bias) + observed_bias * observed_frac
+    if weights.sum() == 0:
+        return np.random.randint(num_windows)
+    return np.random.choice(num_windows, p=weights / weights.sum())
+
+
+def crop_protein(seq, ang, crd, crop_len, observed_bias=0.):
+    """
+    Crops the integer-encoded sequence (without <sos>/<eos>), angles, and
+    coordinates of a protein to the same random window of at most crop_len
+    residues. See sample_crop_start.
+    """
+    if len(seq) <= crop_len:
+        return seq, ang, crd
+    start = sample_crop_start(ang, crop_len, observed_bias)
+    end = start + crop_len
+    return (seq[start:end], ang[start:end],
+            crd[start * NUM_PREDICTED_COORDS:end * NUM_PREDICTED_COORDS])
+
+
 class ProteinDataset(torch.utils.data.Dataset):
     """
     This dataset can hold lists of sequences, angles, and coordinates for
     each protein.
+
+    If the precomputed seq_ints, has_missing and lens (see
+    precompute_sequence_data) are provided, they are used directly and the
+    dataset only records which proteins it holds. <sos>/<eos> are added to
+    each sequence when it is retrieved.
     """
     def __init__(self, seqs=None, angs=None, crds=None, add_sos_eos=True,
-                 sort_by_length=True, reverse_sort=True, skip_missing_residues=True):
+                 sort_by_length=True, reverse_sort=True, skip_missing_residues=True,
+                 seq_ints=None, has_missing=None, lens=None):
 
         assert seqs is not None
         assert (angs is None) or (len(seqs) == len(angs) and len(angs) == len(crds))
-        self._seqs, self._angs, self._crds = [], [], []
-        for i in range(len(seqs)):
-            if np.isnan(angs[i]).all(axis=-1).any() and skip_missing_residues:
-                continue
-            else:
-                self._seqs.append(VOCAB.str2ints(seqs[i], add_sos_eos))
-                self._angs.append(angs[i])
-                self._crds.append(crds[i])
-
-
-        if sort_by_length:
-            sorted_len_indices = [a[0] for a in sorted(enumerate(self._angs),
-                                                       key=lambda x:x[1].shape[0],
-                                                       reverse=reverse_sort)]
-            new_seqs = [self._seqs[i] for i in sorted_len_indices]
-            self._seqs = new_seqs
-            new_angs = [self._angs[i] for i in sorted_len_indices]
-            self._angs = new_angs
-            new_crds = [self._crds[i] for i in sorted_len_indices]
-            self._crds = new_crds
-
+        if seq_ints is None or has_missing is None or lens is None:
+            precomputed = precompute_sequence_data(seqs, angs)
+            seq_ints, has_missing, lens = [precomputed[k] for k in PRECOMPUTED_KEYS]
+        self.add_sos_eos = add_sos_eos
+        self._seq_ints, self._angs, self._crds = seq_ints, angs, crds
+        self._idx = select_proteins(lens, has_missing, skip_missing_residues, sort_by_length, reverse_sort)
+        self.crop_len, self.crop_observed_bias = None, 0.
 
     @property
     def n_insts(self):
         """ Property for dataset size """
-        return len(self._seqs)
+        return len(self._idx)
 
     def __len__(self):
         return self.n_insts
 
     def __getitem__(self, idx):
-        if self._angs is not None:
-            return self._seqs[idx], self._angs[idx], self._crds[idx]
-        return self._seqs[idx]
+        return get_protein(self, idx)
 
 
 class BinnedProteinDataset(torch.utils.data.Dataset):
@@ -106,56 +167,76 @@ class BinnedProteinDataset(torch.utils.data.Dataset):
     each protein.
 
     Assumes protein data is sorted from shortest to longest (ascending).
+
+    If bin_data (the "bin-data" entry of the data dictionary's settings) is
+    provided and bins is "auto", its bin edges are reused instead of
+    recomputing the length histogram.
+
+    If crop_len is provided, each protein longer than crop_len residues is
+    cropped to a random window of crop_len residues whenever it is retrieved
+    (see crop_protein), instead of being truncated at MAX_SEQ_LEN by the
+    collate function. Proteins are binned by their cropped lengths.
     """
-    def __init__(self, seqs=None, angs=None, crds=None, add_sos_eos=True, skip_missing_residues=True, bins="auto"):
+    def __init__(self, seqs=None, angs=None, crds=None, add_sos_eos=True, skip_missing_residues=True, bins="auto",
+                 seq_ints=None, has_missing=None, lens=None, bin_data=None, crop_len=None, crop_observed_bias=0.):
 
         assert seqs is not None
         assert (angs is None) or (len(seqs) == len(angs) and len(angs) == len(crds))
         self.vocab = ProteinVocabulary()
-        self._seqs, self._angs, self._crds = [], [], []
-        for i in range(len(seqs)):
-            if np.isnan(angs[i]).all(axis=-1).any() and skip_missing_residues:
-                continue
-            else:
-                self._seqs.append(VOCAB.str2ints(seqs[i], add_sos_eos))
-                self._angs.append(angs[i])
-                self._crds.append(crds[i])
-
-
-        # Compute length-based histogram bins and probabilities
-        self.lens = list(map(lambda x: len(x) if len(x) <= MAX_SEQ_LEN else MAX_SEQ_LEN, self._seqs))
-        self.hist_counts, self.hist_bins = np.histogram(self.lens, bins=bins)
-        self.hist_bins = self.hist_bins[1:]  # make each bin define the rightmost value in each bin, ie '( , ]'.
-        self.bin_probs = self.hist_counts / self.hist_counts.sum()
-        self.bin_map = {}
-
-        # Compute a mapping from bin number to index in dataset
-        seq_i = 0
-        bin_j = 0
-        while seq_i < len(self._seqs):
-            if self.lens[seq_i] <= self.hist_bins[bin_j]:
-                try:
-                    self.bin_map[bin_j].append(seq_i)
-                except KeyError:
-                    self.bin_map[bin_j] = [seq_i]
-                seq_i += 1
-            else:
-                bin_j += 1
+        if seq_ints is None or has_missing is None or lens is None:
+            precomputed = precompute_sequence_data(seqs, angs)
+            seq_ints, has_missing, lens = [precomputed[k] for k in PRECOMPUTED_KEYS]
+        self.add_sos_eos = add_sos_eos
+        self._seq_ints, self._angs, self._crds = seq_ints, angs, crds
+        self.crop_len, self.crop_observed_bias = crop_len, crop_observed_bias
+        self._idx = select_proteins(lens, has_missing, skip_missing_residues)
+        max_len = MAX_SEQ_LEN if crop_len is None else min(crop_len, MAX_SEQ_LEN)
+        raw_lens = np.minimum(np.asarray(lens)[self._idx], max_len)
+        self.lens = np.minimum(raw_lens + 2 * add_sos_eos, MAX_SEQ_LEN)
+
+        # Compute length-based histogram bins, with each bin defining the rightmost value in each bin, ie '( , ]'.
+        if bin_data is not None and isinstance(bins, str) and bins == "auto" and \
+                bin_data["bin_max_len"] == MAX_SEQ_LEN and max_len == MAX_SEQ_LEN:
+            self.hist_bins = np.asarray(bin_data["hist_bins"])
+            bin_idx = np.searchsorted(self.hist_bins, raw_lens, side="left")
+        else:
+            self.hist_bins = np.histogram(self.lens, bins=bins)[1][1:]
+            bin_idx = np.searchsorted(self.hist_bins, self.lens, side="left")
+        bin_idx = np.minimum(bin_idx, len(self.hist_bins) - 1)
 
+        # Compute bin probabilities and a mapping from bin number to index in dataset
+        self.hist_counts = np.bincount(bin_idx, minlength=len(self.hist_bins))
+        self.bin_probs = self.hist_counts / self.hist_counts.sum()
+        self.bin_map = {int(b): np.flatnonzero(bin_idx == b) for b in np.flatnonzero(self.hist_counts)}
 
     @property
     def n_insts(self):
         """ Property for dataset size """
-        return len(self._seqs)
+        return len(self._idx)
 
     def __len__(self):
         return self.n_insts
 
-
     def __getitem__(self, idx):
-        if self._angs is not None:
-            return self._seqs[idx], self._angs[idx], self._crds[idx]
-        return self._seqs[idx]
+        return get_protein(self, idx)
+
+
+def get_protein(dataset, idx):
+    """
+    Returns the integer-encoded sequence, angles, and coordinates of the
+    idx-th protein held by a ProteinDataset or BinnedProteinDataset.
+    """
+    i = dataset._idx[idx]
+    seq = dataset._seq_ints[i].astype(np.int64)
+    ang = dataset._angs[i] if dataset._angs is not None else None
+    crd = dataset._crds[i] if dataset._angs is not None else None
+    if dataset.crop_len is not None and ang is not None:
+        seq, ang, crd = crop_protein(seq, ang, crd, dataset.crop_len, dataset.crop_observed_bias)
+    if dataset.add_sos_eos:
+        seq = np.concatenate(([VOCAB.sos_id], seq, [VOCAB.eos_id]))
+    if ang is not None:
+        return seq, ang, crd
+    return seq
 
 
 class SimilarLengthBatchSampler(torch.utils.data.Sampler):
@@ -225,6 +306,15 @@ class SimilarLengthBatchSampler(torch.utils.data.Sampler):
         return batch_generator()
 
 
+def get_precomputed(split_data):
+    """
+    Returns the precomputed per-protein information stored with a data split
+    (if any) as keyword arguments for ProteinDataset/BinnedProteinDataset.
+    Datasets created by older versions of the converter lack these entries.
+    """
+    return {k: split_data[k] for k in PRECOMPUTED_KEYS if k in split_data}
+
+
 def prepare_dataloaders(data, args, max_seq_len, num_workers=1):
     """
     Using the pre-processed data, stored in a nested Python dictionary, this
@@ -239,7 +329,10 @@ def prepare_dataloaders(data, args, max_seq_len, num_workers=1):
             seqs=data['train']['seq'],
             crds=data['train']['crd'],
             angs=data['train']['ang'],
-            add_sos_eos=args.add_sos_eos, skip_missing_residues=args.skip_missing_res_train, bins=args.bins)
+            add_sos_eos=args.add_sos_eos, skip_missing_residues=args.skip_missing_res_train, bins=args.bins,
+            bin_data=data['settings'].get('bin-data'), crop_len=args.crop_len,
+            crop_observed_bias=args.crop_observed_bias,
+            **get_precomputed(data['train']))
     train_loader = torch.utils.data.DataLoader(
                     train_dataset,
                     num_workers=num_workers,
@@ -270,7 +363,8 @@ def prepare_dataloaders(data, args, max_seq_len, num_workers=1):
                 crds=data[f'valid-{split}']['crd'],
                 angs=data[f'valid-{split}']['ang'],
                 add_sos_eos=args.add_sos_eos,
-                skip_missing_residues=args.skip_missing_res_train),
+                skip_missing_residues=args.skip_missing_res_train,
+                **get_precomputed(data[f'valid-{split}'])),
             num_workers=num_workers,
             batch_size=args.batch_size,
             collate_fn=paired_collate_fn)
@@ -282,7 +376,8 @@ def prepare_dataloaders(data, args, max_seq_len, num_workers=1):
             crds=data['test']['crd'],
             angs=data['test']['ang'],
             add_sos_eos=args.add_sos_eos,
-            skip_missing_residues=args.skip_missing_res_train),
+            skip_missing_residues=args.skip_missing_res_train,
+            **get_precomputed(data['test'])),
         num_workers=num_workers,
         batch_size=args.batch_size,
         collate_fn=paired_collate_fn)
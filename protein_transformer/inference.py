@@ -0,0 +1,285 @@
+""" Utilities for making predictions with trained models.
+
+    load_model_from_checkpoint restores a model saved during training, or
+    exported for inference by export_inference_checkpoint. Exported models
+    are a directory holding the weights as one flat, aligned binary file and
+    a JSON file describing the model (training arguments, vocabulary, angle
+    means, and the dtype, shape and offset of every tensor). They are loaded
+    by assigning the model tensors backed by a memory map of the weights, so
+    nothing is unpickled or copied when a worker starts. Likewise,
+    predict_angles, build_coords and bucket_by_length are shared by the
+    prediction script (scripts/predict_fasta.py) and the prediction server.
+
+    Encoder-only models can only attend to max_seq_len residues (the size of
+    their positional encoding) and the cost of attention grows quadratically
+    with sequence length. predict_windowed predicts long chains as a batch of
+    overlapping windows of fixed length, then blends the predicted angles in
+    the overlapping regions, so memory and time grow linearly with length.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+
+from protein_transformer.dataset import MAX_SEQ_LEN
+from protein_transformer.losses import inverse_trig_transform, angles_to_coords
+from protein_transformer.protein.Sequence import VOCAB
+
+
+INFERENCE_CONFIG_FILE = "model.json"
+INFERENCE_WEIGHTS_FILE = "weights.bin"
+INFERENCE_FORMAT_VERSION = 1
+WEIGHTS_ALIGNMENT = 64
+
+
+def load_model_from_checkpoint(path, device=torch.device("cpu")):
+    """
+    Loads a model saved by train.py's checkpoint_model, or a directory
+    written by export_inference_checkpoint, in evaluation mode. Returns the
+    model and the training arguments it was created with.
+
+    Checkpoints saved before the angle means were recorded recover them from
+    the output layer's bias, which the models initialize from the means.
+    """
+    from protein_transformer.train import make_model
+
+    if os.path.isdir(path):
+        return load_inference_checkpoint(path, device)
+    checkpoint = torch.load(path, map_location=device, weights_only=False)
+    args = checkpoint["settings"]
+    state = checkpoint["model_state_dict"]
+    angle_means = checkpoint.get("angle_means")
+    if angle_means is None:
+        bias = state["output_projection.bias"].cpu().numpy()
+        angle_means = bias if args.model == "enc-dec" or "linear-out" in args.model else np.tanh(bias)
+    model = make_model(args, device, angle_means)
+    model.load_state_dict(state)
+    model.to(device)
+    model.eval()
+    return model, args
+
+
+def export_inference_checkpoint(model, model_args, out_dir):
+    """
+    Writes the weights of model to out_dir/weights.bin, one tensor after
+    another with each tensor's offset aligned to WEIGHTS_ALIGNMENT bytes,
+    and everything needed to rebuild the model to out_dir/model.json.
+    Optimizer state, metrics and other training history are left out.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    tensors, offset = {}, 0
+    with open(os.path.join(out_dir, INFERENCE_WEIGHTS_FILE), "wb") as f:
+        for name, tensor in model.state_dict().items():
+            data = tensor.detach().cpu().contiguous().flatten().view(torch.uint8).numpy().tobytes()
+            padding = -offset % WEIGHTS_ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+            tensors[name] = {"dtype": str(tensor.dtype).replace("torch.", ""), "shape": list(tensor.shape),
+                             "offset": offset, "nbytes": len(data)}
+            f.write(data)
+            offset += len(data)
+    config = {"format_version": INFERENCE_FORMAT_VERSION,
+              "settings": vars(model_args),
+              "vocab": [VOCAB.int2char(i) for i in range(len(VOCAB))],
+              "angle_means": np.asarray(model.angle_means, dtype=np.float64).tolist(),
+              "weights_file": INFERENCE_WEIGHTS_FILE,
+              "tensors": tensors}
+    with open(os.path.join(out_dir, INFERENCE_CONFIG_FILE), "w") as f:
+        json.dump(config, f, indent=1, default=str)
+
+
+def load_inference_checkpoint(path, device=torch.device("cpu")):
+    """
+    Loads a model written by export_inference_checkpoint in evaluation mode
+    and returns it with its training arguments. The parameters of the model
+    are replaced by tensors backed by a copy-on-write memory map of the
+    weights file, so pages are only read from disk when first used (and are
+    copied when device is not the CPU).
+
+    The model is created on the CPU rather than the meta device, because the
+    first meta tensor operations of a process import torch's Python meta
+    kernels, which takes longer than initializing the model.
+    """
+    from protein_transformer.train import make_model
+
+    with open(os.path.join(path, INFERENCE_CONFIG_FILE)) as f:
+        config = json.load(f)
+    if config["format_version"] != INFERENCE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported inference checkpoint format {config['format_version']}.")
+    if config["vocab"] != [VOCAB.int2char(i) for i in range(len(VOCAB))]:
+        raise ValueError("The model was exported with a different vocabulary.")
+
+    weights = np.memmap(os.path.join(path, config["weights_file"]), dtype=np.uint8, mode="c")
+    state = {}
+    for name, info in config["tensors"].items():
+        data = torch.from_numpy(weights[info["offset"]:info["offset"] + info["nbytes"]])
+        state[name] = data.view(getattr(torch, info["dtype"])).reshape(info["shape"])
+
+    args = argparse.Namespace(**config["settings"])
+    model = make_model(args, device, np.asarray(config["angle_means"]))
+    model.load_state_dict(state, assign=True)
+    model.to(device)
+    model.eval()
+    return model, args
+
+
+def get_windows(length, window, overlap):
+    """
+    Returns a list of (start, end) tuples describing windows of size window
+    that cover a sequence of the given length, where consecutive windows
+    overlap by at least overlap residues. The last window ends at length.
+    """
+    if length <= window:
+        return [(0, length)]
+    assert 0 <= overlap < window, "The overlap must be smaller than the window."
+    step = window - overlap
+    starts = list(range(0, length - window, step)) + [length - window]
+    return [(s, s + window) for s in starts]
+
+
+def get_window_weights(start, end, length, overlap, device=torch.device("cpu")):
+    """
+    Returns a vector of weights for the residues of window [start, end). The
+    weights ramp up linearly over the first and last overlap residues,
+    unless the window begins or ends the chain, so that predictions made far
+    from the edges of a window are preferred when blending.
+    """
+    pos = torch.arange(end - start, dtype=torch.float32, device=device)
+    weights = torch.ones(end - start, device=device)
+    if start > 0:
+        weights = torch.min(weights, (pos + 1) / (overlap + 1))
+    if end < length:
+        weights = torch.min(weights, (end - start - pos) / (overlap + 1))
+    return weights
+
+
+def predict_windowed(model, seq, window=None, overlap=None, batch_size=None):
+    """
+    Predicts the angles (L x NUM_PREDICTED_ANGLES*2, in the model's sin/cos
+    output space) of a single protein with an encoder-only model.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        An encoder-only model mapping a (B x L) batch of sequences to angles.
+    seq : torch.LongTensor
+        Integer-encoded sequence (L), without padding or <sos>/<eos>.
+    window : int
+        Length of each window. Defaults to the model's max_seq_len.
+    overlap : int
+        Minimum number of residues shared by consecutive windows. Defaults to
+        a quarter of the window.
+    batch_size : int
+        Maximum number of windows predicted at once. Defaults to all windows.
+
+    Sequences that fit within a single window are predicted directly.
+    Otherwise, the windows are predicted in batches and each residue's
+    prediction is the weighted average of its predictions in every window
+    containing it (see get_window_weights).
+    """
+    if hasattr(model, "decoder"):
+        raise ValueError("Windowed prediction is only supported for encoder-only models.")
+    if window is None:
+        window = getattr(getattr(model, "encoder", None), "max_seq_len", MAX_SEQ_LEN)
+    if overlap is None:
+        overlap = window // 4
+    device = next(model.parameters()).device
+    seq = seq.to(device)
+    length = seq.shape[0]
+    windows = get_windows(length, window, overlap)
+    batch_size = batch_size or len(windows)
+
+    with torch.no_grad():
+        if len(windows) == 1:
+            return model(seq.unsqueeze(0))[0]
+        blended, total_weight = None, torch.zeros(length, 1, device=device)
+        for i in range(0, len(windows), batch_size):
+            batch_windows = windows[i:i + batch_size]
+            preds = model(torch.stack([seq[s:e] for s, e in batch_windows]))
+            if blended is None:
+                blended = torch.zeros(length, preds.shape[-1], device=device)
+            for (s, e), pred in zip(batch_windows, preds):
+                weights = get_window_weights(s, e, length, overlap, device).unsqueeze(-1)
+                blended[s:e] += pred * weights
+                total_weight[s:e] += weights
+    return blended / total_weight
+
+
+def predict_structure_windowed(model, seq, window=None, overlap=None, batch_size=None):
+    """
+    Predicts a protein's angles with predict_windowed and builds the full
+    chain once. Returns the predicted angles in radians
+    (L x NUM_PREDICTED_ANGLES) and coordinates (L*NUM_PREDICTED_COORDS x 3).
+    """
+    pred = predict_windowed(model, seq, window, overlap, batch_size)
+    angles = inverse_trig_transform(pred.unsqueeze(0).cpu())[0]
+    return angles, angles_to_coords(angles, seq.cpu())
+
+
+def get_max_len(model):
+    """ Returns the length of the longest sequence a model can predict in one pass (excluding <sos>/<eos>). """
+    max_len = getattr(getattr(model, "encoder", None), "max_seq_len", MAX_SEQ_LEN)
+    return max_len - 2 if hasattr(model, "decoder") else max_len
+
+
+def predict_angles(model, seqs, refine_passes=None, window=None, overlap=None):
+    """
+    Predicts the angles of a list of sequences (strings) as one padded batch
+    and returns a list of angle arrays in radians (L x NUM_PREDICTED_ANGLES).
+
+    Encoder-decoder models decode autoregressively, or with refine_passes
+    refinement passes if provided. Sequences longer than an encoder-only
+    model's maximum length are predicted separately with predict_windowed.
+    """
+    device = next(model.parameters()).device
+    is_enc_dec = hasattr(model, "decoder")
+    max_len = get_max_len(model)
+    long_idx = [i for i, s in enumerate(seqs) if len(s) > max_len and not is_enc_dec]
+    batch_idx = [i for i, s in enumerate(seqs) if len(s) <= max_len or is_enc_dec]
+    angles = [None] * len(seqs)
+
+    with torch.no_grad():
+        if batch_idx:
+            enc_input = torch.tensor(VOCAB.encode_batch([seqs[i] for i in batch_idx], add_sos_eos=is_enc_dec),
+                                     device=device)
+            pred = model.predict(enc_input, refine_passes=refine_passes) if is_enc_dec else model(enc_input)
+            pred = inverse_trig_transform(pred.cpu()).numpy()
+            for j, i in enumerate(batch_idx):
+                angles[i] = pred[j, :len(seqs[i])]
+        for i in long_idx:
+            pred = predict_windowed(model, torch.tensor(VOCAB.encode(seqs[i], add_sos_eos=False)), window, overlap)
+            angles[i] = inverse_trig_transform(pred.unsqueeze(0).cpu())[0].numpy()
+    return angles
+
+
+def build_coords(seq, angles):
+    """
+    Builds the full-atom coordinates ((L * NUM_PREDICTED_COORDS) x 3 numpy
+    array) of a sequence (string) from its angles in radians.
+    """
+    with torch.no_grad():
+        coords = angles_to_coords(torch.as_tensor(angles), torch.tensor(VOCAB.encode(seq, add_sos_eos=False)))
+    return coords.numpy()
+
+
+def bucket_by_length(records, max_tokens, max_batch_size, max_len=None):
+    """
+    Sorts records (tuples whose second item is a sequence) by sequence length
+    and yields batches whose length padded to their longest sequence is at
+    most max_tokens residues, with at most max_batch_size records each.
+    Sequences longer than max_len are yielded as batches of one.
+    """
+    batch = []
+    for record in sorted(records, key=lambda r: len(r[1])):
+        length = len(record[1])
+        if max_len is not None and length > max_len:
+            yield [record]
+            continue
+        if batch and (length * (len(batch) + 1) > max_tokens or len(batch) >= max_batch_size):
+            yield batch
+            batch = []
+        batch.append(record)
+    if batch:
+        yield batch
@@ -12,7 +12,6 @@ import wandb
 
 from protein_transformer.protein.Sequence import VOCAB
 from .dataset import  VALID_SPLITS, paired_collate_fn
-from .protein.PDB_Creator import PDB_Creator
 from .losses import angles_to_coords, inverse_trig_transform
 
 def print_train_batch_status(args, items):
@@ -112,9 +111,10 @@ def update_loss_trackers(args, epoch_i, metrics):
     return metrics
 
 
-def log_batch(log_writer, metrics, start_time,  mode="valid", end_of_epoch=False, t=None):
+def log_batch(log_writer, metrics, start_time,  mode="valid", end_of_epoch=False, t=None, lr=None):
     """
-    Logs training info to an already instantiated CSV-writer log.
+    Logs training info to an already instantiated CSV-writer log. If lr is
+    not provided, the most recent learning rate is recorded.
     """
     if not t:
         t = time.time()
@@ -126,17 +126,17 @@ def log_batch(log_writer, metrics, start_time,  mode="valid", end_of_epoch=False
     if "speed" not in m.keys():
         m["speed"] =0
     log_writer.writerow([m[f"{be}-drmsd-full"], m[f"{be}-lndrmsd-full"], np.sqrt(m[f"{be}-mse-full"]),
-                         m[f"{be}-rmsd-full"], m[f"{be}-combined-full"], metrics["history-lr"][-1],
+                         m[f"{be}-rmsd-full"], m[f"{be}-combined-full"],
+                         metrics["history-lr"][-1] if lr is None else lr,
                          mode, "epoch", round(t - start_time, 4), m["speed"]])
 
 
 def do_train_batch_logging(metrics, losses, src_seq, optimizer, args, log_writer, pbar, start_time, pred_angs,
-                           tgt_coords, step, validation_datasets, model, device):
+                           tgt_coords, step, validation_datasets, model, device, accumulator=None):
     """
     Performs all necessary logging at the end of a batch in the training epoch.
     Updates custom metrics dictionary and wandb logs. Prints status of training.
     Also checks for NaN losses.
-    # TODO log structure using a subprocess for speed
 
         1. Updates metrics.
         2. Logs training batch performance with wandb.
@@ -144,45 +144,28 @@ def do_train_batch_logging(metrics, losses, src_seq, optimizer, args, log_writer
         4. Updates the training progress bar (`print_train_batch_status`).
         5. Logs structures.
 
+    If a MetricAccumulator is provided, steps 1-4 (and the NaN check) are
+    deferred until the next batch that is logged to wandb, and are then
+    performed once with the mean losses of the batches since the last
+    flush. See flush_train_batch_logging. Otherwise, they are performed
+    immediately.
+
     Parameters
     ----------
     losses
 
     """
-    d_loss, ln_d_loss, m_loss_full, c_loss, loss = losses["drmsd-full"], losses["lndrmsd-full"], losses["mse-full"], \
-                                              losses["combined-full"], losses["loss"]
-    d_bb_loss, d_bb_ln_loss = losses["drmsd-bb"], losses["lndrmsd-bb"]
-
-    metrics = update_metrics(metrics, losses, "train", src_seq, tracking_loss=loss, batch_level=True)
-
-    do_log_str = not step or step % args.log_structure_step == 0
-    do_log_lr  = args.lr_scheduling == "noam" and (not step or args.log_wandb_step % step == 0)
+    flush_now = accumulator is None
+    if accumulator is None:
+        accumulator = MetricAccumulator()
 
-    if not step or step % args.log_wandb_step == 0:
-        wandb.log({"Train Batch RMSE": np.sqrt(m_loss_full.item()),
-                   "Train Batch DRMSD": d_loss,
-                   "Train Batch ln-DRMSD": ln_d_loss,
-                   "Train Batch Combined Loss": c_loss,
-                   "Train Batch Speed": metrics["train"]["speed"],
-                   "Batch size": pred_angs.shape[0],
-
-                   "Train Batch DRMSD Backbone": losses["drmsd-bb"],
-                   "Train Batch ln-DRMSD Backbone": losses["lndrmsd-bb"],
-                   "Train Batch RMSE Backbone": np.sqrt(losses["mse-bb"].item()),
-                   "Train Batch RMSE Sidechain": np.sqrt(losses["mse-sc"].item())}, commit=not do_log_lr and not do_log_str)
     if args.lr_scheduling == "noam":
         metrics["history-lr"].append(optimizer.cur_lr)
-        if not step or step % args.log_wandb_step  == 0:
-            wandb.log({"Learning Rate": optimizer.cur_lr}, commit=not do_log_str)
+    accumulator.add(losses, src_seq, lr=metrics["history-lr"][-1], batch_size=pred_angs.shape[0])
 
-    log_batch(log_writer, metrics, start_time, mode="train", end_of_epoch=False)
-    if pbar:
-        print_train_batch_status(args, (pbar, metrics, src_seq))
-
-    # Check for NaNs
-    if np.isnan(loss.item()):
-        print("A nan loss has occurred. Exiting training.")
-        sys.exit(1)
+    do_log_str = not step or step % args.log_structure_step == 0
+    if flush_now or not step or step % args.log_wandb_step == 0:
+        metrics = flush_train_batch_logging(metrics, accumulator, args, log_writer, pbar, start_time, step)
 
     # Log the 16th structure of each validation set
     if args.log_val_struct_step != 0 and step % args.log_val_struct_step == 0:
@@ -207,6 +190,51 @@ def do_train_batch_logging(metrics, losses, src_seq, optimizer, args, log_writer
     return metrics
 
 
+def flush_train_batch_logging(metrics, accumulator, args, log_writer, pbar, start_time, step=None):
+    """
+    Materializes the running losses recorded in accumulator, then updates
+    the metrics with their means over the batches since the last flush,
+    logs them to the CSV log and checks for NaN/inf losses. If step is
+    provided and is a wandb logging step, the means are also logged to
+    wandb. Finally, the progress bar is updated.
+    """
+    summary = accumulator.flush()
+    if summary is None:
+        return metrics
+    means = summary["means"]
+    metrics = update_metrics(metrics, means, "train", None, tracking_loss=means["loss"], batch_level=True,
+                             num_res=summary["num-res"], t=summary["time"], num_batches=summary["num-batches"])
+    log_batch(log_writer, metrics, start_time, mode="train", end_of_epoch=False, t=summary["time"],
+              lr=summary["lr"])
+
+    # Check for NaNs and infs
+    if not summary["finite"]:
+        print("A non-finite loss has occurred. Exiting training.")
+        sys.exit(1)
+
+    if step is not None and (not step or step % args.log_wandb_step == 0):
+        logged = dict(means, lr=summary["lr"], batch_size=summary["batch_size"])
+        do_log_str = not step or step % args.log_structure_step == 0
+        do_log_lr = args.lr_scheduling == "noam" and (not step or args.log_wandb_step % step == 0)
+        wandb.log({"Train Batch RMSE": np.sqrt(logged["mse-full"]),
+                   "Train Batch DRMSD": logged["drmsd-full"],
+                   "Train Batch ln-DRMSD": logged["lndrmsd-full"],
+                   "Train Batch Combined Loss": logged["combined-full"],
+                   "Train Batch Speed": metrics["train"]["speed"],
+                   "Batch size": logged["batch_size"],
+
+                   "Train Batch DRMSD Backbone": logged["drmsd-bb"],
+                   "Train Batch ln-DRMSD Backbone": logged["lndrmsd-bb"],
+                   "Train Batch RMSE Backbone": np.sqrt(logged["mse-bb"]),
+                   "Train Batch RMSE Sidechain": np.sqrt(logged["mse-sc"])}, commit=not do_log_lr and not do_log_str)
+        if args.lr_scheduling == "noam":
+            wandb.log({"Learning Rate": logged["lr"]}, commit=not do_log_str)
+
+    if pbar:
+        print_train_batch_status(args, (pbar, metrics, None))
+    return metrics
+
+
 def log_angle_distributions(args, pred_ang, src_seq):
     """ Logs a histogram of predicted angles to wandb. """
     # Remove batch-level masking
@@ -311,10 +339,12 @@ def log_structure_and_angs(args, pred_ang, pred_coords, true_coords, src_seq, co
     """
     Logs a 3D structure prediction to wandb.
     """
+    # PyMOL is only needed for structure logging, so it is not imported with this module
+    from .protein.PDB_Creator import PDB_Creator
     if log_angs:
         log_angle_distributions(args, pred_ang, src_seq)
 
-    src_seq_cpu = src_seq.cpu().detach().numpy()
+    seq_str = VOCAB.ints2str(src_seq)
 
     # Make dir if needed
     cur_struct_path = os.path.join(args.structure_dir, struct_name)
@@ -327,12 +357,12 @@ def log_structure_and_angs(args, pred_ang, pred_coords, true_coords, src_seq, co
     true_coords[torch.isnan(true_coords)] = 0
 
     creator = PDB_Creator(pred_coords.detach().numpy(),
-                          seq=VOCAB.ints2str(src_seq_cpu))
+                          seq=seq_str)
     creator.save_pdb(f"{cur_struct_path}/{wandb.run.step:05}_pred.pdb",
                      title="pred")
 
     t_creator = PDB_Creator(true_coords.cpu().detach().numpy(),
-                            seq=VOCAB.ints2str(src_seq_cpu))
+                            seq=seq_str)
     if not os.path.isfile(f"{cur_struct_path}/true.pdb") or struct_name == "train":
         t_creator.save_pdb(f"{cur_struct_path}/true.pdb", title="true")
         wandb.log({f"{struct_name}_mol_true" : wandb.Molecule(f"{cur_struct_path}/true.pdb")}, commit=False)
@@ -386,7 +416,8 @@ def init_metrics(args):
     return metrics
 
 
-def update_metrics(metrics, losses, mode, src_seq, tracking_loss=None, batch_level=True):
+def update_metrics(metrics, losses, mode, src_seq, tracking_loss=None, batch_level=True, num_res=None, t=None,
+                   num_batches=1):
     """
     Records relevant metrics in the metrics data structure while training.
     If batch_level is true, this means the loss for the current batch is
@@ -395,38 +426,50 @@ def update_metrics(metrics, losses, mode, src_seq, tracking_loss=None, batch_lev
     Parameters
     ----------
     losses
+        Dictionary of losses for the batch, either as tensors or floats.
+    num_res, t
+        The number of residues in the batch and the time at which the batch
+        finished. If not provided, they are computed from src_seq and the
+        current time.
+    num_batches
+        The number of batches losses describes. If greater than 1, losses
+        are the mean losses of that many batches, which contain num_res
+        residues in total.
     """
     drmsd, ln_drmsd, mse, combined, rmsd = losses["drmsd-full"], losses["lndrmsd-full"], losses["mse-full"], losses["combined-full"], losses["rmsd-full"]
     # Update loss values
     if batch_level:
-        metrics["n_batches"] += 1
-        metrics[mode]["batch-drmsd-full"] = drmsd.item()
-        metrics[mode]["batch-lndrmsd-full"] = ln_drmsd.item()
-        metrics[mode]["batch-mse-full"] = mse.item()
-        metrics[mode]["batch-combined-full"] = combined.item()
-        if rmsd: metrics[mode]["batch-rmsd-full"] = rmsd.item()
-        metrics[mode]["batch-drmsd-bb"] = losses["drmsd-bb"].item()
-        metrics[mode]["batch-mse-bb"] = losses["mse-bb"].item()
-        metrics[mode]["batch-mse-sc"] = losses["mse-sc"].item()
-        metrics[mode]["batch-lndrmsd-bb"] = losses["lndrmsd-bb"].item()
-    metrics[mode]["epoch-drmsd-full"] += drmsd.item()
-    metrics[mode]["epoch-lndrmsd-full"] += ln_drmsd.item()
-    metrics[mode]["epoch-mse-full"] += mse.item()
-    metrics[mode]["epoch-combined-full"] += combined.item()
-    if rmsd: metrics[mode]["epoch-rmsd-full"] += rmsd.item()
-    metrics[mode]["epoch-drmsd-bb"] = losses["drmsd-bb"].item()
-    metrics[mode]["epoch-mse-bb"] = losses["mse-bb"].item()
-    metrics[mode]["epoch-mse-sc"] = losses["mse-sc"].item()
-    metrics[mode]["epoch-lndrmsd-bb"] = losses["lndrmsd-bb"].item()
+        metrics["n_batches"] += num_batches
+        metrics[mode]["batch-drmsd-full"] = float(drmsd)
+        metrics[mode]["batch-lndrmsd-full"] = float(ln_drmsd)
+        metrics[mode]["batch-mse-full"] = float(mse)
+        metrics[mode]["batch-combined-full"] = float(combined)
+        if rmsd: metrics[mode]["batch-rmsd-full"] = float(rmsd)
+        metrics[mode]["batch-drmsd-bb"] = float(losses["drmsd-bb"])
+        metrics[mode]["batch-mse-bb"] = float(losses["mse-bb"])
+        metrics[mode]["batch-mse-sc"] = float(losses["mse-sc"])
+        metrics[mode]["batch-lndrmsd-bb"] = float(losses["lndrmsd-bb"])
+    metrics[mode]["epoch-drmsd-full"] += float(drmsd) * num_batches
+    metrics[mode]["epoch-lndrmsd-full"] += float(ln_drmsd) * num_batches
+    metrics[mode]["epoch-mse-full"] += float(mse) * num_batches
+    metrics[mode]["epoch-combined-full"] += float(combined) * num_batches
+    if rmsd: metrics[mode]["epoch-rmsd-full"] += float(rmsd) * num_batches
+    metrics[mode]["epoch-drmsd-bb"] = float(losses["drmsd-bb"])
+    metrics[mode]["epoch-mse-bb"] = float(losses["mse-bb"])
+    metrics[mode]["epoch-mse-sc"] = float(losses["mse-sc"])
+    metrics[mode]["epoch-lndrmsd-bb"] = float(losses["lndrmsd-bb"])
 
     # Compute and update speed
-    num_res = (src_seq != VOCAB.pad_id).sum().item()
-    metrics[mode]["speed"] = num_res / (time.time() - metrics[mode]["batch-time"])
+    if num_res is None:
+        num_res = (src_seq != VOCAB.pad_id).sum().item()
+    if t is None:
+        t = time.time()
+    metrics[mode]["speed"] = num_res / (t - metrics[mode]["batch-time"])
     if "speeds" not in metrics[mode].keys():
         metrics[mode]["speeds"] = []
     metrics[mode]["speeds"].append(metrics[mode]["speed"])
 
-    metrics[mode]["batch-time"] = time.time()
+    metrics[mode]["batch-time"] = t
     metrics[mode]["speed-history"].append(metrics[mode]["speed"])
 
     if tracking_loss:
@@ -434,6 +477,83 @@ def update_metrics(metrics, losses, mode, src_seq, tracking_loss=None, batch_lev
     return metrics
 
 
+class MetricAccumulator(object):
+    """
+    Keeps running sums of the training losses as tensors on their device.
+    Calling .item() on each loss tensor every batch forces a device
+    synchronization for every value; instead, the sums, counts, and a flag
+    recording whether every loss was finite are updated on the device and
+    copied to the host together, with one copy per device, when flush() is
+    called, i.e. every log_wandb_step batches and at the end of the epoch.
+
+    Only finite values are summed and counted for each metric, so that
+    metrics which are not computed every batch (reported as NaN, see
+    losses.drmsd_work) are averaged over the batches that computed them.
+    """
+    KEYS = ["loss", "drmsd-full", "lndrmsd-full", "drmsd-bb", "lndrmsd-bb", "combined-full", "mse-full", "mse-bb",
+            "mse-sc", "rmsd-full"]
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.sums, self.counts = {}, {}
+        self.finite = self.num_res = None
+        self.num_batches = 0
+        self.info = {}
+
+    def __len__(self):
+        return self.num_batches
+
+    def add(self, losses, src_seq, **kwargs):
+        """
+        Adds the losses for a batch, and the number of residues in the batch,
+        to the running sums. The current time and any other keyword arguments
+        are kept for the most recent batch only.
+        """
+        for k in self.KEYS:
+            if losses[k] is None:
+                continue
+            value = losses[k].detach().float() if torch.is_tensor(losses[k]) else torch.tensor(float(losses[k]))
+            is_finite = torch.isfinite(value)
+            self.sums[k] = self.sums.get(k, 0) + torch.where(is_finite, value, torch.zeros_like(value))
+            self.counts[k] = self.counts.get(k, 0) + is_finite.long()
+            if k == "loss":
+                self.finite = is_finite if self.finite is None else self.finite & is_finite
+        num_res = (src_seq != VOCAB.pad_id).sum()
+        self.num_res = num_res if self.num_res is None else self.num_res + num_res
+        self.num_batches += 1
+        self.info = dict(kwargs, time=time.time())
+
+    def flush(self):
+        """
+        Returns a dictionary of the mean of each loss ("means", NaN if no
+        finite value was recorded, None if it was never provided), whether
+        every loss was finite ("finite"), the number of batches
+        ("num-batches") and residues ("num-res") since the last flush, and
+        the information recorded for the most recent batch. Then, the running
+        sums are cleared. Returns None if nothing was added.
+        """
+        if not self.num_batches:
+            return None
+        tensors = [(("sum", k), v) for k, v in self.sums.items()] + [(("count", k), v) for k, v in self.counts.items()]
+        tensors += [(("finite", None), self.finite), (("num-res", None), self.num_res)]
+        tensors_by_device = {}
+        for name, v in tensors:
+            tensors_by_device.setdefault(v.device, []).append((name, v))
+        values = {}
+        for items in tensors_by_device.values():
+            for (name, _), value in zip(items, torch.stack([v.double() for _, v in items]).cpu().tolist()):
+                values[name] = value
+        means = {k: (values[("sum", k)] / values[("count", k)] if values[("count", k)] else float("nan"))
+                 if k in self.sums else None for k in self.KEYS}
+        summary = dict(self.info)
+        summary.update({"means": means, "finite": bool(values[("finite", None)]),
+                        "num-res": int(values[("num-res", None)]), "num-batches": self.num_batches})
+        self._reset()
+        return summary
+
+
 def reset_metrics_for_epoch(metrics, mode):
     """
     Resets the running and batch-specific metrics for a new epoch.
@@ -1,9 +1,9 @@
 """ Loss functions for training protein structure prediction models. """
 
+import time
+
 import numpy as np
-import prody as pr
 import torch
-import wandb
 
 import protein_transformer.protein.Structure
 from protein_transformer.protein.Sequence import VOCAB
@@ -19,7 +19,9 @@ def combine_drmsd_mse(d, mse, w=.5, lndrmsd_norm=0.02, mse_norm=0.01, log=True):
     """
     d = w * (d / lndrmsd_norm)
     mse = (1 - w) * (mse / mse_norm)
-    if log: wandb.log({"MSE Weight": mse, "DRMSD Weight": d}, commit=False)
+    if log:
+        import wandb
+        wandb.log({"MSE Weight": mse, "DRMSD Weight": d}, commit=False)
     return d + mse
 
 
@@ -46,12 +48,43 @@ def remove_sos_eos_from_input(input_seq):
     return input_seq[start_idx : end_idx]
 
 
-def drmsd_work(pred_ang, true_crd, input_seq, return_rmsd, do_backward=True, backbone_only=False):
+DRMSD_VARIANTS = ("drmsd-full", "lndrmsd-full", "drmsd-bb", "lndrmsd-bb")
+
+
+def masked_drmsd(pred_crd, true_crd):
+    """
+    Computes dRMSD and length-normalized dRMSD between the atoms of pred_crd
+    that are present (not NaN) in true_crd. Also returns the masked
+    coordinates.
+    """
+    true_crd_non_nan = torch.isnan(true_crd).eq(0)
+    pred_crds_masked = pred_crd[true_crd_non_nan].reshape(-1, 3)
+    true_crds_masked = true_crd[true_crd_non_nan].reshape(-1, 3)
+    loss = drmsd(pred_crds_masked, true_crds_masked)
+    return loss, loss / pred_crds_masked.shape[0], pred_crds_masked, true_crds_masked
+
+
+def drmsd_work(pred_ang, true_crd, input_seq, return_rmsd, do_backward=True, backbone_only=False,
+               variants=DRMSD_VARIANTS, timings=None):
     """
     A version of drmsd loss meant to be used in parallel. Operates on a tuple
     of predicted angles, coordinates, and sequence. Works for 1 protein at a
     time.
+
+    variants is a subset of DRMSD_VARIANTS listing the dRMSD values that are
+    needed. Values that were not needed are returned as NaN. If
+    backbone_only is True, sidechains are never built, the "full" dRMSD is
+    measured over the backbone, and the backbone dRMSD values are copied from
+    it rather than being computed a second time.
+
+    If timings is a dictionary, the wall-clock time at which work started
+    ("start", from time.time()) and the seconds spent building coordinates
+    ("build") and backpropagating ("backward") are recorded in it.
     """
+    if timings is not None:
+        timings["start"] = time.time()
+        t = time.perf_counter()
+
     # Move numpy arrays to torch tensors
     pred_ang, true_crd, input_seq = torch.tensor(pred_ang), torch.tensor(true_crd), torch.tensor(input_seq)
 
@@ -64,32 +97,38 @@ def drmsd_work(pred_ang, true_crd, input_seq, return_rmsd, do_backward=True, bac
     input_seq = input_seq[batch_mask]
     true_crd = true_crd[:input_seq.shape[0] * NUM_PREDICTED_COORDS]
 
+    # Determine which dRMSD values must be computed. The full dRMSD is needed for the backward pass and RMSD.
+    need_full = do_backward or return_rmsd or "drmsd-full" in variants or "lndrmsd-full" in variants
+    need_bb = "drmsd-bb" in variants or "lndrmsd-bb" in variants
+    if backbone_only:
+        need_full, need_bb = need_full or need_bb, False
+
     # Compute coordinates
-    pred_crd = angles_to_coords(pred_ang, input_seq)
+    pred_crd = angles_to_coords(pred_ang, input_seq, backbone_only=backbone_only)
     if backbone_only:
         pred_crd = get_backbone_from_full_coords(pred_crd)
         true_crd = get_backbone_from_full_coords(true_crd)
-
-    # Remove coordinate-level masking for missing atoms
-    true_crd_non_nan = torch.isnan(true_crd).eq(0)
-    pred_crds_masked = pred_crd[true_crd_non_nan].reshape(-1, 3)
-    true_crds_masked = true_crd[true_crd_non_nan].reshape(-1, 3)
+    if timings is not None:
+        timings["build"] = time.perf_counter() - t
 
     # Compute drmsd between existing atoms only
-    loss = drmsd(pred_crds_masked, true_crds_masked)
-    l_normed = loss / pred_crds_masked.shape[0]
+    loss = l_normed = bb_loss = bb_loss_normed = torch.tensor(np.nan)
+    if need_full:
+        loss, l_normed, pred_crds_masked, true_crds_masked = masked_drmsd(pred_crd, true_crd)
+        if backbone_only:
+            bb_loss, bb_loss_normed = loss, l_normed
 
     # Repeat above for bb only
-    pred_crd_bb = get_backbone_from_full_coords(pred_crd)
-    true_crd_bb = get_backbone_from_full_coords(true_crd)
-    true_crd_bb_non_nan = torch.isnan(true_crd_bb).eq(0)
-    pred_crd_bb_masked = pred_crd_bb[true_crd_bb_non_nan].reshape(-1, 3)
-    true_crd_bb_masked = true_crd_bb[true_crd_bb_non_nan].reshape(-1, 3)
-    bb_loss = drmsd(pred_crd_bb_masked, true_crd_bb_masked)
-    bb_loss_normed = bb_loss / pred_crd_bb_masked.shape[0]
+    if need_bb:
+        bb_loss, bb_loss_normed, _, _ = masked_drmsd(get_backbone_from_full_coords(pred_crd),
+                                                     get_backbone_from_full_coords(true_crd))
 
     if do_backward:
+        if timings is not None:
+            t = time.perf_counter()
         l_normed.backward()
+        if timings is not None:
+            timings["backward"] = time.perf_counter() - t
 
     if return_rmsd:
         return starting_ang.grad, loss.item(), l_normed.item(), bb_loss.item(), bb_loss_normed.item(), \
@@ -98,9 +137,10 @@ def drmsd_work(pred_ang, true_crd, input_seq, return_rmsd, do_backward=True, bac
         return starting_ang.grad, loss.item(), l_normed.item(), bb_loss.item(), bb_loss_normed.item()
 
 
-def angles_to_coords(angles, seq, remove_batch_padding=False):
+def angles_to_coords(angles, seq, remove_batch_padding=False, backbone_only=False):
     """
-    Convert torsional angles to coordinates.
+    Convert torsional angles to coordinates. If backbone_only is True,
+    sidechain atoms are not built.
     """
     pred_ang, input_seq = angles, seq
     if remove_batch_padding:
@@ -113,41 +153,76 @@ def angles_to_coords(angles, seq, remove_batch_padding=False):
     pred_ang = pred_ang[:input_seq.shape[0]]
 
     # Generate coordinates
-    return protein_transformer.protein.Structure.generate_coords(pred_ang, input_seq, torch.device("cpu"))
+    return protein_transformer.protein.Structure.generate_coords(pred_ang, input_seq, torch.device("cpu"),
+                                                                 backbone_only=backbone_only)
 
 
 def parallel_coords_only(ang, seq):
     coords = angles_to_coords(ang, seq)
     return coords
 
-def drmsd_work_wrapper(ang_crd_seq_retrmsd_doback_bbonly):
+def drmsd_work_wrapper(ang_crd_seq_retrmsd_doback_bbonly_variants_timed):
     """
     Unpacks arguments for the drmsd_work function. Useful for Pool.map().
+    If timed is True, returns (result, timings) instead of result, where
+    timings is the dictionary described in drmsd_work.
     Parameters
     ----------
-    ang_crd_seq_retrmsd_doback_bbonly : tuple
+    ang_crd_seq_retrmsd_doback_bbonly_variants_timed : tuple
     """
-    ang, crd, seq, return_rmsd, do_backward, backbone_only = ang_crd_seq_retrmsd_doback_bbonly
-    return drmsd_work(ang, crd, seq, return_rmsd, do_backward, backbone_only)
+    ang, crd, seq, return_rmsd, do_backward, backbone_only, variants, timed = \
+        ang_crd_seq_retrmsd_doback_bbonly_variants_timed
+    timings = {} if timed else None
+    result = drmsd_work(ang, crd, seq, return_rmsd, do_backward, backbone_only, variants, timings)
+    return (result, timings) if timed else result
 
 def compute_batch_drmsd(pred_angs, true_crds, input_seqs, device=torch.device("cpu"), return_rmsd=False,
-                        do_backward=False, retain_graph=False, pool=None, backbone_only=False):
+                        do_backward=False, retain_graph=False, pool=None, backbone_only=False,
+                        variants=DRMSD_VARIANTS, defer_backward=False, timings=None):
     """
     Calculate DRMSD loss by first generating predicted coordinates from
     angles. Then, predicted coordinates are compared with the true coordinate
-    tensor provided to the function.
+    tensor provided to the function. See drmsd_work for a description of
+    backbone_only and variants.
+
+    If do_backward is True, the gradient of each protein's length-normalized
+    dRMSD is immediately backpropagated from pred_angs. If defer_backward is
+    also True, no backward pass is made here. Instead, the returned
+    length-normalized dRMSD is a scalar tensor whose value is the batch mean
+    and whose gradient w.r.t. pred_angs is the mean of the per-protein
+    gradients. It can then be combined with other losses and backpropagated
+    through the model once.
+
+    If timings is a dictionary, the time spent computing the dRMSD
+    ("drmsd") and backpropagating its gradients through the model
+    ("backward", if that happens here) is recorded in it. These two stages
+    do not overlap. The mean time per protein that dRMSD work waited to be
+    started by a worker ("drmsd-queue"), spent building coordinates
+    ("drmsd-build") and backpropagating through the structure
+    ("drmsd-backward") is also recorded; these are a breakdown of "drmsd".
     """
+    start = time.perf_counter()
     pred_angs, true_crds, input_seqs = pred_angs.to(device), true_crds.to(device), input_seqs.to(device)
     pred_angs = inverse_trig_transform(pred_angs)
 
     # Compute drmsd in parallel over the batch
+    timed = timings is not None
+    submitted = time.time()
     if pool is not None:
         results = pool.map(drmsd_work_wrapper, zip(pred_angs.detach().numpy(), true_crds.detach().numpy(),
                                                    input_seqs.detach().numpy(), [return_rmsd]*pred_angs.shape[0],
-                                                   [do_backward]*pred_angs.shape[0], [backbone_only]*pred_angs.shape[0]))
+                                                   [do_backward]*pred_angs.shape[0],
+                                                   [backbone_only]*pred_angs.shape[0],
+                                                   [variants]*pred_angs.shape[0], [timed]*pred_angs.shape[0]))
     else:
-        results = (drmsd_work(ang.detach(), crd.detach(), seq.detach(), return_rmsd, do_backward, backbone_only)
-                              for ang, crd, seq in zip(pred_angs, true_crds, input_seqs))
+        results = [drmsd_work_wrapper((ang.detach(), crd.detach(), seq.detach(), return_rmsd, do_backward,
+                                       backbone_only, variants, timed))
+                   for ang, crd, seq in zip(pred_angs, true_crds, input_seqs)]
+    if timed:
+        results, work_timings = zip(*results)
+        timings["drmsd-queue"] = float(np.mean([wt["start"] for wt in work_timings]) - submitted)
+        timings["drmsd-build"] = float(np.mean([wt["build"] for wt in work_timings]))
+        timings["drmsd-backward"] = float(np.mean([wt.get("backward", 0.) for wt in work_timings]))
 
     # Unpack the multiprocessing results
     grads, losses, ln_losses, bb_losses, bb_ln_losses, rmsds = [], [], [], [], [], []
@@ -163,13 +238,22 @@ def compute_batch_drmsd(pred_angs, true_crds, input_seqs, device=torch.device("c
         bb_losses.append(bb_l)
         bb_ln_losses.append(bb_ln)
 
-    if do_backward:
+    ln_loss = np.mean(ln_losses)
+    if do_backward and defer_backward:
+        surrogate = (pred_angs * torch.stack(grads).to(pred_angs.device)).sum() / pred_angs.shape[0]
+        ln_loss = surrogate - surrogate.detach() + ln_loss
+    if timed:
+        timings["drmsd"] = time.perf_counter() - start
+    if do_backward and not defer_backward:
+        t = time.perf_counter()
         pred_angs.backward(gradient=torch.stack(grads), retain_graph=retain_graph)
+        if timed:
+            timings["backward"] = time.perf_counter() - t
 
     if return_rmsd:
-        return np.mean(losses), np.mean(ln_losses), np.mean(bb_losses), np.mean(bb_ln_losses), np.mean(rmsds)
+        return np.mean(losses), ln_loss, np.mean(bb_losses), np.mean(bb_ln_losses), np.mean(rmsds)
     else:
-        return np.mean(losses), np.mean(ln_losses), np.mean(bb_losses), np.mean(bb_ln_losses)
+        return np.mean(losses), ln_loss, np.mean(bb_losses), np.mean(bb_ln_losses)
 
 
 def mse_over_angles(pred, true, bb_only=False, sc_only=False):
@@ -214,6 +298,46 @@ def mse_over_angles(pred, true, bb_only=False, sc_only=False):
     return torch.nn.functional.mse_loss(pred[ang_non_zero][ang_non_nans], true[ang_non_zero][ang_non_nans])
 
 
+def mse_over_angles_fused(pred, true):
+    """Returns the full, backbone, sidechain, and per-angle mean squared errors
+    between two tensor batches in a single pass.
+
+    Equivalent to calling mse_over_angles with each of its bb_only/sc_only
+    settings, but the batch padding (all-zero rows) and missing-angle (NaN)
+    masks are only built once, and masked values are zeroed in place rather
+    than gathered into new tensors.
+
+    Args:
+        pred, true (torch.Tensor): 3-dimensional tensors (B x L x A), where A
+            is NUM_PREDICTED_ANGLES (radians) or NUM_PREDICTED_ANGLES * 2
+            (sin/cos pairs).
+
+    Returns:
+        (mse_full, mse_bb, mse_sc, mse_per_angle), where mse_per_angle is a
+        tensor with NUM_PREDICTED_ANGLES values.
+    """
+    assert len(pred.shape) == 3, "This function must operate on a batch of angles."
+    if pred.shape[-1] == NUM_PREDICTED_ANGLES * 2:
+        sc_start = SC_ANGLES_START_POS * 2
+    elif pred.shape[-1] == NUM_PREDICTED_ANGLES:
+        sc_start = SC_ANGLES_START_POS
+    else:
+        raise Exception("Unknown angle tensor shape.")
+
+    # Mask batch padding and missing angles, then sum squared errors over the batch for each angle column
+    valid = true.ne(0).any(dim=2, keepdim=True) & ~torch.isnan(true)
+    diff = torch.where(valid, pred - torch.where(valid, true, torch.zeros_like(true)), torch.zeros_like(pred))
+    col_sq_err = (diff ** 2).sum(dim=(0, 1))
+    col_counts = valid.sum(dim=(0, 1)).to(col_sq_err.dtype)
+
+    mse_full = col_sq_err.sum() / col_counts.sum()
+    mse_bb = col_sq_err[:sc_start].sum() / col_counts[:sc_start].sum()
+    mse_sc = col_sq_err[sc_start:].sum() / col_counts[sc_start:].sum()
+    mse_per_angle = col_sq_err.view(NUM_PREDICTED_ANGLES, -1).sum(-1) / \
+                    col_counts.view(NUM_PREDICTED_ANGLES, -1).sum(-1)
+    return mse_full, mse_bb, mse_sc, mse_per_angle
+
+
 def mse_over_angles_numpy(pred, true):
     """ Numpy version of mse_over_angles.
 
@@ -282,5 +406,6 @@ def rmsd(a, b):
     """
     Returns the RMSD between two sets of coordinates.
     """
+    import prody as pr
     t = pr.calcTransformation(a, b)
     return pr.calcRMSD(t.apply(a), b)
@@ -7,19 +7,21 @@ import torch.nn as nn
 
 from protein_transformer.models.transformer.Sublayers import Embeddings, PositionalEncoding
 from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES
-from protein_transformer.models.transformer.Encoder import Encoder, EncoderLayer
+from protein_transformer.models.transformer.Encoder import Encoder, EncoderLayer, expand_attn_types
 
 
 class ConvEncoderOnlyTransformer(nn.Module):
     """ A Transformer that starts with 1D sequence convolutions before applying attention. """
 
     def __init__( self, nlayers, nhead, dmodel, dff, max_seq_len, vocab, angle_means, use_tanh_out, conv_kernel_sizes,
-                  conv_dim_reductions, use_embedding, conv_out_matches_dm, dropout=0.1):
+                  conv_dim_reductions, use_embedding, conv_out_matches_dm, dropout=0.1,
+                  attn_types=None, attn_window=32, attn_global_tokens=0):
         super().__init__()
         self.angle_means = angle_means
         self.vocab = vocab
         self.encoder = ConvolutionalEncoder(len(vocab), dmodel, dff, nhead, nlayers, max_seq_len, dropout,
-                                            conv_kernel_sizes, conv_dim_reductions, use_embedding, conv_out_matches_dm)
+                                            conv_kernel_sizes, conv_dim_reductions, use_embedding, conv_out_matches_dm,
+                                            attn_types, attn_window, attn_global_tokens)
         self.output_projection = torch.nn.Linear(self.encoder.conv_out_size(), NUM_PREDICTED_ANGLES*2)
         self.use_tanh_out = use_tanh_out
         if use_tanh_out:
@@ -56,7 +58,8 @@ class ConvolutionalEncoder(torch.nn.Module):
     """
 
     def __init__(self, din, dm, dff, n_heads, n_enc_layers, max_seq_len, dropout, conv_kernel_sizes,
-                 conv_dim_reductions, use_embedding, conv_out_matches_dm):
+                 conv_dim_reductions, use_embedding, conv_out_matches_dm, attn_types=None, attn_window=32,
+                 attn_global_tokens=0):
         super(ConvolutionalEncoder, self).__init__()
         self.din = din
         self.dm = dm
@@ -78,8 +81,10 @@ class ConvolutionalEncoder(torch.nn.Module):
 
         self.conv_layers = torch.nn.ModuleList(self.make_sequence_conv_layers(conv_kernel_sizes, conv_dim_reductions))
 
-        self.enc_layers = torch.nn.ModuleList([EncoderLayer(self.conv_out_size(), dff, n_heads, dropout)
-                                               for _ in range(self.n_enc_layers)])
+        self.attn_types = expand_attn_types(attn_types, n_enc_layers)
+        self.enc_layers = torch.nn.ModuleList([EncoderLayer(self.conv_out_size(), dff, n_heads, dropout, attn_type,
+                                                            attn_window, attn_global_tokens)
+                                               for attn_type in self.attn_types])
 
     def conv_out_size(self):
         if self.conv_out_matches_dm:
@@ -10,11 +10,13 @@ from .transformer.Encoder import Encoder
 class EncoderOnlyTransformer(nn.Module):
     """ A Transformer that only uses Encoder layers. """
 
-    def __init__( self, nlayers, nhead, dmodel, dff, max_seq_len, vocab, angle_means, use_tanh_out, dropout=0.1):
+    def __init__( self, nlayers, nhead, dmodel, dff, max_seq_len, vocab, angle_means, use_tanh_out, dropout=0.1,
+                  attn_types=None, attn_window=32, attn_global_tokens=0):
         super().__init__()
         self.angle_means = angle_means
         self.vocab = vocab
-        self.encoder = Encoder(len(vocab), dmodel, dff, nhead, nlayers, max_seq_len, dropout)
+        self.encoder = Encoder(len(vocab), dmodel, dff, nhead, nlayers, max_seq_len, dropout, attn_types, attn_window,
+                               attn_global_tokens)
         self.output_projection = torch.nn.Linear(dmodel, NUM_PREDICTED_ANGLES*2)
         self.use_tanh_out = use_tanh_out
         if use_tanh_out:
@@ -69,6 +69,80 @@ class MultiHeadedAttention(torch.nn.Module):
         return self.wo(attn_output)
 
 
+class LocalMultiHeadedAttention(MultiHeadedAttention):
+    """
+    Multi-headed self-attention layer where each position only attends to the
+    positions within +/- window of itself. Optionally, the first n_global
+    positions are global tokens that attend to, and are attended by, every
+    position.
+
+    The sequence is split into blocks of length window, and the queries of
+    each block are only scored against the keys of that block and of its two
+    neighbouring blocks. The full L x L score matrix is never built, so
+    attention memory grows as O(L * window) rather than O(L^2). Padding is
+    masked in the same way as MultiHeadedAttention. Attention scores are not
+    recorded.
+    """
+    def __init__(self, dm, n_heads, window, n_global=0, dropout=0.1):
+        super(LocalMultiHeadedAttention, self).__init__(dm, n_heads, dropout)
+        assert window > 0, "The attention window must be positive."
+        self.window = window
+        self.n_global = n_global
+
+    def forward(self, preQ, preK, preV, mask=None):
+        n_batch, L = preQ.shape[0], preQ.shape[1]
+        b, g = self.window, min(self.n_global, L)
+        n_blocks = -(-L // b)
+        pad = n_blocks * b - L
+        Q, K, V = self.wq(preQ), self.wk(preK), self.wv(preV)
+        Q, K, V = (x.view(n_batch, -1, self.n_heads, self.dk).transpose(1, 2) for x in (Q, K, V))
+        Q = Q / np.sqrt(self.dk)
+        if mask is not None:
+            valid = mask.reshape(n_batch, L).bool()
+        else:
+            valid = torch.ones(n_batch, L, dtype=torch.bool, device=preQ.device)
+
+        # Split queries into blocks, and gather the keys/values of each block and its neighbours (views, no copies).
+        # Qb                        = [ n_batch x n_heads x n_blocks x b x dk ]
+        # Kl                        = [ n_batch x n_heads x n_blocks x dk x 3b ]
+        # Vl                        = [ n_batch x n_heads x n_blocks x 3b x dk ]
+        Qb = torch.nn.functional.pad(Q, (0, 0, 0, pad)).view(n_batch, self.n_heads, n_blocks, b, self.dk)
+        Kl, Vl = (torch.nn.functional.pad(x, (0, 0, b, pad + b)).unfold(2, 3 * b, b) for x in (K, V))
+        Vl = Vl.transpose(-1, -2)
+        valid_l = torch.nn.functional.pad(valid, (b, pad + b)).unfold(1, 3 * b, b)
+
+        # Key j may be attended to by query i if |i - j| <= window, j is a real (non-padding) position and it is
+        # not a global token (which are scored separately below).
+        # allowed                   = [ n_batch x 1 x n_blocks x b x 3b ]
+        block_start = torch.arange(n_blocks, device=preQ.device).view(n_blocks, 1, 1) * b
+        q_pos = block_start + torch.arange(b, device=preQ.device).view(1, b, 1)
+        k_pos = block_start - b + torch.arange(3 * b, device=preQ.device).view(1, 1, 3 * b)
+        allowed = ((q_pos - k_pos).abs() <= self.window) & (k_pos >= g)
+        allowed = (allowed.unsqueeze(0) & valid_l.unsqueeze(2)).unsqueeze(1)
+
+        fill = torch.finfo(Q.dtype).min
+        scores = torch.matmul(Qb, Kl).masked_fill(~allowed, fill)
+        if g:
+            Kg, Vg = K[:, :, :g], V[:, :, :g]
+            scores_g = torch.matmul(Qb, Kg.transpose(-2, -1).unsqueeze(2))
+            scores_g = scores_g.masked_fill(~valid[:, None, None, None, :g], fill)
+            scores = torch.cat([scores_g, scores], dim=-1)
+        scores = self.dropout(torch.softmax(scores, dim=-1))
+        attn_output = torch.matmul(scores[..., g:], Vl)
+        if g:
+            attn_output = attn_output + torch.matmul(scores[..., :g], Vg.unsqueeze(2))
+        attn_output = attn_output.view(n_batch, self.n_heads, n_blocks * b, self.dk)[:, :, :L]
+
+        # Global tokens attend to every position
+        if g:
+            scores_g = torch.matmul(Q[:, :, :g], K.transpose(-2, -1)).masked_fill(~valid[:, None, None, :], fill)
+            global_output = torch.matmul(self.dropout(torch.softmax(scores_g, dim=-1)), V)
+            attn_output = torch.cat([global_output, attn_output[:, :, g:]], dim=2)
+
+        attn_output = attn_output.transpose(1, 2).contiguous().view(n_batch, -1, self.dm)
+        return self.wo(attn_output)
+
+
 if __name__ == "__main__":
     dm = 128
     seq = torch.zeros(8, 31, dm)
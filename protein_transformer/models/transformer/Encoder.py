@@ -1,6 +1,6 @@
 import torch
 
-from .Attention import MultiHeadedAttention
+from .Attention import MultiHeadedAttention, LocalMultiHeadedAttention
 from .Sublayers import PositionwiseFeedForward, PositionalEncoding, \
     SublayerConnection, Embeddings
 
@@ -10,7 +10,8 @@ class Encoder(torch.nn.Module):
     Transformer encoder model.
     """
 
-    def __init__(self, din, dm, dff, n_heads, n_enc_layers, max_seq_len, dropout):
+    def __init__(self, din, dm, dff, n_heads, n_enc_layers, max_seq_len, dropout, attn_types=None, attn_window=32,
+                 attn_global_tokens=0):
         super(Encoder, self).__init__()
         self.din = din
         self.dm = dm
@@ -23,7 +24,10 @@ class Encoder(torch.nn.Module):
         self.input_embedding = Embeddings(self.din, self.dm)
         self.positional_enc = PositionalEncoding(dm, dropout, max_seq_len)
 
-        self.enc_layers = torch.nn.ModuleList([EncoderLayer(dm, dff, n_heads, dropout) for _ in range(self.n_enc_layers)])
+        self.attn_types = expand_attn_types(attn_types, n_enc_layers)
+        self.enc_layers = torch.nn.ModuleList([EncoderLayer(dm, dff, n_heads, dropout, attn_type, attn_window,
+                                                            attn_global_tokens)
+                                               for attn_type in self.attn_types])
 
     def forward(self, src_seq, src_mask):
         enc_output = self.input_embedding(src_seq)
@@ -38,17 +42,40 @@ class EncoderLayer(torch.nn.Module):
     Transformer encoder layer.
     """
 
-    def __init__(self, dm, dff, n_heads, dropout):
+    def __init__(self, dm, dff, n_heads, dropout, attn_type="full", attn_window=32, attn_global_tokens=0):
         super(EncoderLayer, self).__init__()
         self.dm = dm
         self.dff = dff
         self.n_heads = n_heads
+        self.attn_type = attn_type
 
-        self.self_attn = MultiHeadedAttention(dm, n_heads)
+        if attn_type == "full":
+            self.self_attn = MultiHeadedAttention(dm, n_heads)
+        elif attn_type == "local":
+            self.self_attn = LocalMultiHeadedAttention(dm, n_heads, attn_window, attn_global_tokens)
+        else:
+            raise ValueError(f"Unknown attention type '{attn_type}'.")
         self.pwff = PositionwiseFeedForward(dm, dff, dropout)
         self.sublayer_connections = torch.nn.ModuleList([SublayerConnection(dm, dropout) for _ in range(2)])
 
     def forward(self, enc_input, enc_input_mask):
         enc_output = self.sublayer_connections[0](enc_input, lambda x: self.self_attn(x, x, x, mask=enc_input_mask))
         enc_output = self.sublayer_connections[1](enc_output, self.pwff)
-        return enc_output
\ No newline at end of file
+        return enc_output
+
+
+def expand_attn_types(attn_types, n_layers):
+    """
+    Returns a list with the attention type ("full" or "local") of each of the
+    n_layers layers. attn_types may be None (all full attention), a single
+    type used by every layer, or a list with one type per layer, e.g. local
+    lower layers followed by full upper layers.
+    """
+    if attn_types is None:
+        return ["full"] * n_layers
+    if isinstance(attn_types, str):
+        attn_types = [attn_types]
+    if len(attn_types) == 1:
+        return list(attn_types) * n_layers
+    assert len(attn_types) == n_layers, "Please provide one attention type, or one for each layer."
+    return list(attn_types)
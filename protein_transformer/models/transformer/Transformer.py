@@ -14,7 +14,7 @@ class Transformer(torch.nn.Module):
     """
     def __init__(self, dm, dff, din, dout, n_heads, n_enc_layers, n_dec_layers,
                  max_seq_len, pad_char, missing_coord_filler, device, dropout, fraction_complete_tf,
-                 fraction_subseq_tf, angle_means):
+                 fraction_subseq_tf, angle_means, scheduled_sampling="parallel"):
         super(Transformer, self).__init__()
         self.din = din
         self.dout = dout
@@ -30,8 +30,11 @@ class Transformer(torch.nn.Module):
         self.fraction_subseq_tf = fraction_subseq_tf
         self.fraction_complete_tf = fraction_complete_tf
         self.angle_means = angle_means
+        assert scheduled_sampling in ["parallel", "sequential"], "Unknown scheduled sampling mode."
+        self.scheduled_sampling = scheduled_sampling
 
         self.decoder_sos_char = -0.1
+        self.refine_history = None
 
         self.encoder = Encoder(self.din, dm, dff, n_heads, n_enc_layers, max_seq_len, dropout)
         self.decoder = Decoder(self.dout, dm, dff, n_heads, n_dec_layers, max_seq_len, dropout)
@@ -73,6 +76,9 @@ class Transformer(torch.nn.Module):
                      np.random.random() < self.fraction_complete_tf):
             return self.forward_tf(enc_input, dec_input)
 
+        if self.scheduled_sampling == "parallel":
+            return self.forward_parallel_ss(enc_input, dec_input)
+
         # Otherwise, proceed with a method that will use sub-sequence level teacher forcing
         src_mask = (enc_input != self.pad_char).unsqueeze(-2)
         enc_output = self.encoder(enc_input, src_mask)
@@ -100,6 +106,39 @@ class Transformer(torch.nn.Module):
         return self.tanh(self.output_projection(dec_output))
 
 
+    def forward_parallel_ss(self, enc_input, dec_input):
+        """
+        Forward method of Transformer that approximates sub-sequence level
+        teacher forcing (scheduled sampling) with two parallel decoder passes.
+
+        The first pass is teacher forced and not differentiated. Each decoder
+        input (except SOS and padding) is then replaced by the first pass's
+        prediction for that position with probability 1 - fraction_subseq_tf,
+        or always if the true angles are missing. The second pass decodes the
+        mixed input, again in parallel. Unlike the sequential method, every
+        step runs the decoder exactly twice, regardless of sequence length.
+        """
+        src_mask = (enc_input != self.pad_char).unsqueeze(-2)
+        tgt_mask = (dec_input != self.pad_char).any(dim=-1).unsqueeze(-2) & self.subsequent_mask(dec_input.shape[1])
+        enc_output = self.encoder(enc_input, src_mask)
+
+        # First pass, with teacher forcing. The prediction for position t is the decoder input at position t + 1.
+        with torch.no_grad():
+            first_pass = self.tanh(self.output_projection(self.decoder(dec_input, enc_output, tgt_mask, src_mask)))
+        first_pass = torch.cat([dec_input[:, :1], first_pass[:, :-1]], dim=1)
+
+        # Mix the predictions into the decoder input with a per-position Bernoulli mask
+        feed_prediction = torch.rand(dec_input.shape[:2], device=dec_input.device) > self.fraction_subseq_tf
+        feed_prediction |= (dec_input == self.missing_coord_filler).all(dim=-1)
+        feed_prediction &= (dec_input != self.pad_char).any(dim=-1)
+        feed_prediction[:, 0] = False
+        mixed_input = torch.where(feed_prediction.unsqueeze(-1), first_pass, dec_input)
+
+        # Second pass
+        dec_output = self.decoder(mixed_input, enc_output, tgt_mask, src_mask)
+        return self.tanh(self.output_projection(dec_output))
+
+
     def _init_parameters(self):
         """
         Initialize model parameters. Also, attempt to initialize model output to
@@ -122,10 +161,14 @@ class Transformer(torch.nn.Module):
         return torch.from_numpy(mask).bool().to(self.device)
 
 
-    def predict(self, enc_input):
+    def predict(self, enc_input, refine_passes=None, refine_tol=None):
         """
-        Makes predictions with self-recursive decoding.
+        Makes predictions with self-recursive decoding. If refine_passes is
+        provided, uses non-autoregressive refinement decoding instead (see
+        predict_refine).
         """
+        if refine_passes:
+            return self.predict_refine(enc_input, refine_passes, refine_tol)
         src_mask = (enc_input != self.pad_char).unsqueeze(-2)
         enc_output = self.encoder(enc_input, src_mask)
         max_len = enc_input.shape[1]
@@ -152,3 +195,41 @@ class Transformer(torch.nn.Module):
                 working_input_seq.data[:, t] = angles.data
 
         return self.tanh(self.output_projection(dec_output))
+
+
+    def predict_refine(self, enc_input, n_passes=4, tol=None):
+        """
+        Makes predictions with non-autoregressive, iterative refinement.
+
+        The predicted angles are initialized with the angle means. Then, each
+        of (at most) n_passes decodes every position in parallel, where the
+        decoder input is the previous pass's full set of predictions (shifted
+        by one position after SOS, as in teacher forcing). Decoding stops early
+        if tol is provided and the mean absolute change of the predictions
+        between two passes is below tol. This requires n_passes sequential
+        decoder calls, rather than one per residue.
+
+        The convergence of each pass is recorded in self.refine_history as a
+        list of dictionaries with the mean and max absolute change.
+        """
+        src_mask = (enc_input != self.pad_char).unsqueeze(-2)
+        tgt_mask = src_mask & self.subsequent_mask(enc_input.shape[1])
+        enc_output = self.encoder(enc_input, src_mask)
+
+        angle_means = torch.as_tensor(np.nan_to_num(self.angle_means), dtype=enc_output.dtype,
+                                      device=enc_output.device)
+        preds = angle_means.expand(enc_input.shape[0], enc_input.shape[1], self.dout)
+        sos = torch.full_like(preds[:, :1], self.decoder_sos_char)
+        self.refine_history = []
+        for k in range(n_passes):
+            dec_input = torch.cat([sos, preds[:, :-1]], dim=1)
+            dec_output = self.decoder(dec_input, enc_output, tgt_mask, src_mask)
+            new_preds = self.tanh(self.output_projection(dec_output))
+            change = (new_preds - preds).abs()[src_mask.squeeze(-2)]
+            self.refine_history.append({"pass": k + 1,
+                                        "mean_change": change.mean().item() if change.numel() else 0.,
+                                        "max_change": change.max().item() if change.numel() else 0.})
+            preds = new_preds
+            if tol is not None and self.refine_history[-1]["mean_change"] < tol:
+                break
+        return preds
@@ -0,0 +1,142 @@
+""" A persistent, content-addressed cache of predicted structures.
+
+    Inference jobs often predict the same sequence more than once (redundant
+    chains, reruns over overlapping sets of proteins). PredictionCache stores
+    the predicted angles, coordinates and, optionally, the PDB file of each
+    sequence in an .npz file named by the SHA-1 digest of the sequence and of
+    the model that predicted it (see model_digest), so that a cached
+    prediction is only reused by the same weights, configuration and
+    prediction options. Cache hits skip both the model and the
+    StructureBuilder. The least recently used files are evicted once the
+    cache grows beyond max_bytes.
+
+    Several processes may share a cache directory; each keeps its own index
+    of the files, so the size limit is only enforced approximately.
+"""
+import hashlib
+import json
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from protein_transformer.protein.PDB_Creator import PDB_Creator
+
+
+def model_digest(model, model_args=None, **options):
+    """
+    Returns the SHA-1 hex digest of a model's weights, the arguments it was
+    created with, and any options (e.g. refine_passes) that change its
+    predictions.
+    """
+    sha = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        sha.update(f"{name}:{tuple(tensor.shape)}:{tensor.dtype}".encode())
+        sha.update(tensor.flatten().view(torch.uint8).numpy().tobytes())
+    config = {"args": vars(model_args) if model_args is not None else None, "options": options}
+    sha.update(json.dumps(config, sort_keys=True, default=str).encode())
+    return sha.hexdigest()
+
+
+class PredictionCache(object):
+    """
+    Stores predictions for the model identified by model_digest in
+    cache_dir. Entries are dictionaries with the keys "angles" (L x
+    NUM_PREDICTED_ANGLES, in radians), and optionally "coords" (L *
+    NUM_PREDICTED_COORDS x 3) and "pdb". PDB files are only stored if
+    store_pdb is True, and are stored without their title so that they can
+    be reused by any protein with the same sequence.
+    """
+
+    def __init__(self, cache_dir, model_digest, max_bytes=10 * 2 ** 30, store_pdb=False):
+        self.cache_dir = cache_dir
+        self.model_digest = model_digest
+        self.max_bytes = max_bytes
+        self.store_pdb = store_pdb
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # Path -> size in bytes, least recently used first
+        self._total_bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """ Indexes the files already in the cache directory, ordered by their last use. """
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".npz"):
+                    stat = os.stat(os.path.join(root, name))
+                    files.append((stat.st_mtime_ns, os.path.join(root, name), stat.st_size))
+        for _, path, size in sorted(files):
+            self._index[path] = size
+            self._total_bytes += size
+
+    def _cache_path(self, seq):
+        digest = hashlib.sha1(f"{self.model_digest}:{seq}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".npz")
+
+    def get(self, seq, title="test"):
+        """
+        Returns the cached entry for seq, or None if it is not cached. A
+        cached PDB file is given the header for title.
+        """
+        path = self._cache_path(seq)
+        try:
+            with np.load(path) as data:
+                entry = {k: data[k] for k in data.files}
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            with self._lock:
+                self.misses += 1
+                self._remove(path)
+            return None
+        with self._lock:
+            self.hits += 1
+            if path in self._index:
+                self._index.move_to_end(path)
+        if "pdb" in entry:
+            entry["pdb"] = PDB_Creator._make_header(title) + "\n" + str(entry["pdb"])
+        return entry
+
+    def put(self, seq, angles, coords=None, pdb=None):
+        """ Stores the prediction for seq, replacing any previous entry, then evicts old entries if needed. """
+        arrays = {"angles": np.asarray(angles, dtype=np.float32)}
+        if coords is not None:
+            arrays["coords"] = np.asarray(coords, dtype=np.float32)
+        if pdb is not None and self.store_pdb:
+            arrays["pdb"] = np.array(pdb.split("\n", 1)[1])  # Without the one-line header, see get
+        path = self._cache_path(seq)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._total_bytes += size - self._index.pop(path, 0)
+            self._index[path] = size
+            self._evict()
+
+    def _remove(self, path):
+        """ Removes path from the index and the disk. Must be called with the lock held. """
+        self._total_bytes -= self._index.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        """ Removes the least recently used files until the cache fits in max_bytes, keeping the newest file. """
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            self._remove(next(iter(self._index)))
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._index),
+                    "bytes": self._total_bytes}
@@ -0,0 +1,215 @@
+""" An opt-in, per-stage profiler for the training loop.
+
+    Each training step is divided into named stages (data wait, host-to-device
+    copy, forward pass, losses, backward pass, optimizer step, logging, ...).
+    When enabled, the wall-clock time spent in every stage is recorded for
+    every step so that the time of a step can be attributed to its parts,
+    rather than relying on the overall residues/second measurement. CUDA work
+    is asynchronous, so the device is synchronized at stage boundaries while
+    profiling; this slows training slightly and is why profiling is opt-in.
+
+    Optionally, a window of steps can also be recorded with torch.profiler and
+    exported as a Chrome trace (viewable at chrome://tracing or
+    https://ui.perfetto.dev).
+"""
+import contextlib
+import csv
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+# Stages recorded during a training step, in the order they occur. Stages that are measured outside of the main
+# process (i.e. by dRMSD workers) are reported as the mean time per protein in the batch.
+TRAIN_STAGES = ["data-wait", "to-device", "forward", "mse", "drmsd", "drmsd-queue", "drmsd-build",
+                "drmsd-backward", "backward", "optimizer", "logging"]
+
+
+class StepProfiler(object):
+    """
+    Records the time spent in each stage of every training step.
+
+    Usage:
+        profiler = StepProfiler(enabled=True, device=device, out_dir=out_dir)
+        for batch in loader:
+            profiler.start_step()
+            with profiler.stage("forward"):
+                ...
+            profiler.end_step()
+        profiler.save()
+
+    When disabled, every method is a no-op so that the profiler may be used
+    unconditionally by the training loop.
+    """
+
+    def __init__(self, enabled=False, device=None, out_dir=None, name="train", trace_steps=None):
+        """
+        Parameters
+        ----------
+        enabled : bool
+            Whether or not to record anything.
+        device : torch.device
+            If a CUDA device, it is synchronized before each timestamp is taken.
+        out_dir : str
+            Directory where the step CSV, the JSON summary and traces are written.
+        name : str
+            Prefix for the files written to out_dir.
+        trace_steps : tuple
+            (first, last) step indices (inclusive, counted over the lifetime of
+            the profiler) to record with torch.profiler. None disables tracing.
+        """
+        self.enabled = enabled
+        self.sync = enabled and device is not None and torch.device(device).type == "cuda"
+        self.out_dir = out_dir
+        self.name = name
+        self.trace_steps = trace_steps
+        self.steps = []
+        self.step_idx = -1
+        self._current = None
+        self._last_step_end = None
+        self._torch_profiler = None
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start_step(self, num_res=None):
+        """
+        Begins a new step. The time since the end of the previous step (i.e.
+        the time spent waiting on the data loader) is recorded as "data-wait".
+        """
+        if not self.enabled:
+            return
+        now = self._now()
+        self.step_idx += 1
+        self._current = {"step": self.step_idx}
+        if num_res is not None:
+            self._current["num-res"] = int(num_res)
+        if self._last_step_end is not None:
+            self._current["data-wait"] = now - self._last_step_end
+        self._start_trace_if_needed()
+        self._step_start = now
+
+    def end_step(self):
+        """ Completes the current step, recording its total duration. """
+        if not self.enabled or self._current is None:
+            return
+        now = self._now()
+        self._current["step-total"] = now - self._step_start + self._current.get("data-wait", 0)
+        self.steps.append(self._current)
+        self._current = None
+        self._last_step_end = now
+        self._stop_trace_if_needed()
+
+    def reset_data_wait(self):
+        """
+        Restarts the data wait timer. Should be called before iterating over a
+        new data loader so that time spent between epochs is not attributed to
+        the first step.
+        """
+        if self.enabled:
+            self._last_step_end = self._now()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager that adds the time spent inside of it to stage 'name' of the current step. """
+        if not self.enabled or self._current is None:
+            yield
+            return
+        start = self._now()
+        with torch.autograd.profiler.record_function(name):
+            yield
+        self.record(name, self._now() - start)
+
+    def record(self, name, seconds):
+        """ Adds an externally measured duration (in seconds) to stage 'name' of the current step. """
+        if not self.enabled or self._current is None:
+            return
+        self._current[name] = self._current.get(name, 0) + seconds
+
+    def record_many(self, timings):
+        """ Records every (name, seconds) pair in the dictionary timings. """
+        for name, seconds in timings.items():
+            self.record(name, seconds)
+
+    def _start_trace_if_needed(self):
+        if self.trace_steps is None or self._torch_profiler is not None or self.step_idx != self.trace_steps[0]:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.sync:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        self._torch_profiler.__enter__()
+
+    def _stop_trace_if_needed(self, force=False):
+        if self._torch_profiler is None or (not force and self.step_idx < self.trace_steps[1]):
+            return
+        self._torch_profiler.__exit__(None, None, None)
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, f"{self.name}.steps{self.trace_steps[0]}-{self.step_idx}.trace.json")
+        self._torch_profiler.export_chrome_trace(path)
+        print(f"[Info] Chrome trace written to {path}.")
+        self._torch_profiler = None
+        self.trace_steps = None
+
+    def stage_names(self):
+        """ Returns the names of all stages recorded so far, with known training stages first. """
+        names = [s for s in TRAIN_STAGES if any(s in step for step in self.steps)]
+        for step in self.steps:
+            for k in step:
+                if k not in names and k not in ("step", "num-res", "step-total"):
+                    names.append(k)
+        return names
+
+    def summary(self):
+        """
+        Returns a dictionary summarizing each stage over all recorded steps:
+        the mean, median and total time in seconds, and the fraction of the
+        total step time spent in the stage. Steps missing a stage count as 0.
+        """
+        if not self.steps:
+            return {"num_steps": 0, "stages": {}}
+        step_total = np.asarray([s["step-total"] for s in self.steps])
+        stages = {}
+        for name in self.stage_names() + ["step-total"]:
+            values = np.asarray([s.get(name, 0.) for s in self.steps])
+            stages[name] = {"mean": float(values.mean()),
+                            "median": float(np.median(values)),
+                            "total": float(values.sum()),
+                            "fraction": float(values.sum() / step_total.sum())}
+        summary = {"num_steps": len(self.steps), "stages": stages}
+        num_res = [s["num-res"] for s in self.steps if "num-res" in s]
+        if num_res:
+            summary["res_per_sec"] = float(np.sum(num_res) / step_total.sum())
+        return summary
+
+    def save(self):
+        """
+        Writes the per-step timings to '<name>.steps.csv' and the summary to
+        '<name>.summary.json' within out_dir. Returns the summary.
+        """
+        if not self.enabled:
+            return None
+        self._stop_trace_if_needed(force=True)
+        summary = self.summary()
+        os.makedirs(self.out_dir, exist_ok=True)
+        columns = ["step", "num-res"] + self.stage_names() + ["step-total"]
+        with open(os.path.join(self.out_dir, f"{self.name}.steps.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns, restval="")
+            writer.writeheader()
+            writer.writerows(self.steps)
+        with open(os.path.join(self.out_dir, f"{self.name}.summary.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def print_summary(self):
+        """ Prints a table of the mean time spent in each stage per step. """
+        summary = self.summary()
+        if not summary["stages"]:
+            return
+        print(f"[Profile] {summary['num_steps']} steps")
+        for name, s in summary["stages"].items():
+            print(f"    {name:<16} {s['mean'] * 1000:9.2f} ms/step  {s['fraction'] * 100:6.1f}%")
@@ -1,8 +1,5 @@
 import numpy as np
-import pymol
 import torch
-import wandb
-from prody import calcTransformation
 
 from protein_transformer.protein.Sequence import ONE_TO_THREE_LETTER_MAP
 import protein_transformer
@@ -140,8 +137,10 @@ class PDB_Creator(object):
     @staticmethod
     def _make_header(title):
         """
-        Returns the PDB header.
+        Returns the PDB header. Line breaks in title are replaced with spaces
+        so that the header is always a single line.
         """
+        title = " ".join(str(title).splitlines())
         return f"REMARK  {title}"
 
     @staticmethod
@@ -161,21 +160,30 @@ class PDB_Creator(object):
             mapping.append((residue, ATOM_MAP_14[residue]))
         return mapping
 
+    def get_pdb_string(self, title="test"):
+        """
+        Given a title, this function generates the PDB lines and returns them
+        as a single string.
+        """
+        self._get_lines_for_protein()
+        self.lines = [self._make_header(title)] + self.lines + [self._make_footer()]
+        return "\n".join(self.lines)
+
     def save_pdb(self, path, title="test"):
         """
         Given a file path and title, this function generates the PDB lines,
         then writes them to a file.
         """
-        self._get_lines_for_protein()
-        self.lines = [self._make_header(title)] + self.lines + [self._make_footer()]
+        pdb_string = self.get_pdb_string(title)
         with open(path, "w") as outfile:
-            outfile.write("\n".join(self.lines))
+            outfile.write(pdb_string)
 
     def save_gltf(self, path, title="test", create_pdb=False):
         """
         This function first creates a PDB file, then converts it to a GLTF
         (3D Object) file. Used for visualizign with Weights and Biases. """
         assert ".gltf" in path, "requested filepath must end with '.gtlf'."
+        import pymol
         if create_pdb:
             self.save_pdb(path.replace(".gltf", ".pdb"), title)
         pymol.cmd.load(path.replace(".gltf", ".pdb"), title)
@@ -188,6 +196,8 @@ class PDB_Creator(object):
         This function first creates a PDB file, then converts it to a GLTF
         (3D Object) file. Used for visualizign with Weights and Biases. """
         assert ".pdb" in path1, "requested filepaths must end with '.pdb'."
+        import pymol
+        import wandb
         pymol.cmd.load(path1, "true")
         pymol.cmd.load(path2, "pred")
         pymol.cmd.color("marine", "true")
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class ProteinVocabulary(object):
     """
     Represents the 'vocabulary' of amino acids for encoding a protein sequence.
@@ -12,6 +15,9 @@ class ProteinVocabulary(object):
 
         self._char2int = dict()
         self._int2char = dict()
+        self._byte2id = None
+        self._id2byte = None
+        self._skip_ids = None
 
         # Extract the ordered list of 1-letter amino acid codes from the project-level AA_MAP.
         self.stdaas = map(lambda x: x[0], sorted(list(AA_MAP.items()), key=lambda x: x[1]))
@@ -54,24 +60,104 @@ class ProteinVocabulary(object):
         if aa not in self:
             aaid = self._char2int[aa] = len(self)
             self._int2char[aaid] = aa
+            self._byte2id = None  # Lookup tables are rebuilt when next needed
             return aaid
         else:
             return self[aa]
 
-    def str2ints(self, seq, add_sos_eos=True):
+    def _build_lookup_tables(self):
+        """
+        Builds a 256-entry table mapping each byte (ASCII character) to its id,
+        where unknown characters map to the unknown id, and an array mapping
+        each id back to its byte.
+        """
+        self._byte2id = np.full(256, self[self.unk_char], dtype=np.int64)
+        self._id2byte = np.zeros(len(self), dtype=np.uint8)
+        for aa, aaid in self._char2int.items():
+            self._byte2id[ord(aa)] = aaid
+            self._id2byte[aaid] = ord(aa)
+        self._skip_ids = np.asarray([self._char2int[c] for c in [self.sos_char, self.eos_char, self.pad_char]
+                                     if c in self._char2int])
+
+    @property
+    def byte2id(self):
+        if self._byte2id is None:
+            self._build_lookup_tables()
+        return self._byte2id
+
+    @property
+    def id2byte(self):
+        if self._byte2id is None:
+            self._build_lookup_tables()
+        return self._id2byte
+
+    def encode(self, seq, add_sos_eos=True, dtype=np.int64):
+        """ Returns a sequence (string) as an array of ids. """
+        ids = self.byte2id[np.frombuffer(seq.encode("ascii", errors="replace"), dtype=np.uint8)]
         if add_sos_eos:
-            return [self["<"]] + [self[aa] for aa in seq] + [self[">"]]
-        else:
-            return [self[aa] for aa in seq]
+            ids = np.concatenate(([self.sos_id], ids, [self.eos_id]))
+        return ids.astype(dtype, copy=False)
+
+    def encode_batch(self, seqs, add_sos_eos=True, padded=True, dtype=np.int64):
+        """
+        Encodes a list of sequences (strings) with a single table lookup. If
+        padded, returns a (B x L) array padded with pad_id, where L is the
+        length of the longest (encoded) sequence. Otherwise, returns a list of
+        1D arrays, one per sequence.
+        """
+        lens = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        flat = self.byte2id[np.frombuffer("".join(seqs).encode("ascii", errors="replace"), dtype=np.uint8)]
+        flat = flat.astype(dtype, copy=False)
+        if not padded:
+            ids = np.split(flat, np.cumsum(lens)[:-1]) if len(seqs) else []
+            if add_sos_eos:
+                ids = [np.concatenate(([self.sos_id], s, [self.eos_id])).astype(dtype, copy=False) for s in ids]
+            return ids
+        offset = 1 if add_sos_eos else 0
+        max_len = lens.max() if len(seqs) else 0
+        batch = np.full((len(seqs), max_len + 2 * offset), self.pad_id, dtype=dtype)
+        batch[:, offset:offset + max_len][np.arange(max_len) < lens[:, None]] = flat
+        if add_sos_eos:
+            batch[:, 0] = self.sos_id
+            batch[np.arange(len(seqs)), lens + 1] = self.eos_id
+        return batch
+
+    @staticmethod
+    def _as_id_array(ints):
+        """ Returns a list, generator, array or Tensor of ids as a numpy array. """
+        if hasattr(ints, "detach"):
+            ints = ints.detach().cpu().numpy()
+        elif not hasattr(ints, "__len__"):
+            ints = list(ints)
+        return np.asarray(ints, dtype=np.int64)
+
+    def decode(self, ints, include_sos_eos=False):
+        """ Returns an array of ids as a string, skipping sos, eos and pad unless include_sos_eos. """
+        ints = self._as_id_array(ints)
+        chars = self.id2byte[ints]
+        if not include_sos_eos:
+            chars = chars[~np.isin(ints, self._skip_ids)]
+        return chars.tobytes().decode("ascii")
+
+    def decode_batch(self, ints, include_sos_eos=False):
+        """
+        Decodes a padded (B x L) array or Tensor of ids, or a list of id
+        sequences, into a list of strings.
+        """
+        if hasattr(ints, "shape") and len(ints.shape) == 2:
+            ints = self._as_id_array(ints)
+            chars = self.id2byte[ints]
+            if include_sos_eos:
+                return [row.tobytes().decode("ascii") for row in chars]
+            keep = ~np.isin(ints, self._skip_ids)
+            return [row[k].tobytes().decode("ascii") for row, k in zip(chars, keep)]
+        return [self.decode(s, include_sos_eos) for s in ints]
 
-    def ints2str(self, ints, include_sos_eos=False):
-        seq = ""
-        for i in ints:
-            c = self.int2char(i)
-            if include_sos_eos or (c not in [self.sos_char, self.eos_char, self.pad_char]):
-                seq += c
-        return seq
+    def str2ints(self, seq, add_sos_eos=True):
+        return self.encode(seq, add_sos_eos).tolist()
 
+    def ints2str(self, ints, include_sos_eos=False):
+        return self.decode(ints, include_sos_eos)
 
 ONE_TO_THREE_LETTER_MAP = {"R": "ARG", "H": "HIS", "K": "LYS", "D": "ASP", "E": "GLU", "S": "SER", "T": "THR",
                            "N": "ASN", "Q": "GLN", "C": "CYS", "G": "GLY", "P": "PRO", "A": "ALA", "V": "VAL",
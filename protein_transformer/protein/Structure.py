@@ -9,14 +9,16 @@ NUM_SC_ANGLES = NUM_PREDICTED_ANGLES - (NUM_BB_OTHER_ANGLES + NUM_BB_TORSION_ANG
 SC_ANGLES_START_POS = NUM_BB_OTHER_ANGLES + NUM_BB_TORSION_ANGLES
 
 
-def generate_coords(angles, input_seq, device):
+def generate_coords(angles, input_seq, device, backbone_only=False):
     """ Returns a protein's coordinates generated from its angles and sequence.
 
     Given a tensor of angles (L x NUM_PREDICTED_ANGLES), produces the entire
     set of cartesian coordinates using the NeRF method, (L x A` x 3),
     where A` is the number of atoms generated (depends on amino acid sequence).
+    If backbone_only is True, sidechain atoms are not placed and their
+    coordinates are left as padding.
     """
-    sb = StructureBuilder.StructureBuilder(input_seq, angles, device)
+    sb = StructureBuilder.StructureBuilder(input_seq, angles, device, backbone_only=backbone_only)
     return sb.build()
 
 
@@ -37,32 +39,90 @@ def nerf(a, b, c, l, theta, chi):
             chi : dihedral using a, b, c, d (in degrees)
         Returns:
             d: tuple of (x, y, z) in cartesian space
+
+    The placement itself is performed by NeRF, a single autograd Function with
+    an analytic backward pass. a, b, and c may be single coordinates (3) or
+    batches of coordinates (... x 3), in which case l, theta, and chi may be
+    scalars or have the matching batch shape (...).
     """
-    # calculate unit vectors AB and BC
-    assert -np.pi <= theta <= np.pi, "theta must be in radians and in [-pi, pi]. theta = " + str(theta)
-
-    W_hat = torch.nn.functional.normalize(b - a, dim=0)
-    x_hat = torch.nn.functional.normalize(c-b, dim=0)
-
-    # calculate unit normals n = AB x BC
-    # and p = n x BC
-    n_unit = torch.cross(W_hat, x_hat)
-    z_hat = torch.nn.functional.normalize(n_unit, dim=0)
-    y_hat = torch.cross(z_hat, x_hat)
-
-    # create rotation matrix [BC; p; n] (3x3)
-    M = torch.stack([x_hat, y_hat, z_hat], dim=1)
-
-    # calculate coord pre rotation matrix
-    d = torch.stack([torch.squeeze(-l * torch.cos(theta)),
-                     torch.squeeze(l * torch.sin(theta) * torch.cos(chi)),
-                     torch.squeeze(l * torch.sin(theta) * torch.sin(chi))])
-
-    # calculate with rotation as our final output
-    # TODO: is the squeezing necessary?
-    d = d.unsqueeze(1).to(torch.float32)
-    res = c + torch.mm(M, d).squeeze()
-    return res.squeeze()
+    if not torch.is_tensor(theta) or theta.dim() == 0:
+        assert -np.pi <= theta <= np.pi, "theta must be in radians and in [-pi, pi]. theta = " + str(theta)
+
+    l, theta, chi = (torch.as_tensor(v, device=c.device).to(c.dtype) for v in (l, theta, chi))
+    return NeRF.apply(a, b, c, l, theta, chi)
+
+
+class NeRF(torch.autograd.Function):
+    """
+    Places atom d given atoms a, b, and c, the bond length l (c-d), bond
+    angle theta (b-c-d) and dihedral chi (a-b-c-d). Recording this as one
+    autograd node (rather than the ~20 nodes created by normalizing, crossing,
+    stacking and multiplying the intermediate vectors) greatly reduces the
+    size of the graph and the memory needed to build a protein.
+
+    With u = c - b, v = b - a, x = u/|u|, w = v x u, z = w/|w|, y = z x x,
+    d = c + (-l cos(theta)) x + (l sin(theta) cos(chi)) y
+          + (l sin(theta) sin(chi)) z.
+    """
+
+    @staticmethod
+    def forward(ctx, a, b, c, l, theta, chi):
+        u = c - b
+        v = b - a
+        u_norm = torch.linalg.norm(u, dim=-1, keepdim=True)
+        x = u / u_norm
+        w = torch.linalg.cross(v, u, dim=-1)
+        w_norm = torch.linalg.norm(w, dim=-1, keepdim=True)
+        z = w / w_norm
+        y = torch.linalg.cross(z, x, dim=-1)
+
+        sin_theta, cos_theta = torch.sin(theta), torch.cos(theta)
+        sin_chi, cos_chi = torch.sin(chi), torch.cos(chi)
+        alpha = (-l * cos_theta).unsqueeze(-1)
+        beta = (l * sin_theta * cos_chi).unsqueeze(-1)
+        gamma = (l * sin_theta * sin_chi).unsqueeze(-1)
+
+        ctx.save_for_backward(u, v, x, y, z, u_norm, w_norm, l, theta, chi)
+        ctx.shapes = a.shape, b.shape, c.shape
+        return c + alpha * x + beta * y + gamma * z
+
+    @staticmethod
+    @torch.autograd.function.once_differentiable
+    def backward(ctx, grad):
+        u, v, x, y, z, u_norm, w_norm, l, theta, chi = ctx.saved_tensors
+        a_shape, b_shape, c_shape = ctx.shapes
+        sin_theta, cos_theta = torch.sin(theta), torch.cos(theta)
+        sin_chi, cos_chi = torch.sin(chi), torch.cos(chi)
+        alpha = (-l * cos_theta).unsqueeze(-1)
+        beta = (l * sin_theta * cos_chi).unsqueeze(-1)
+        gamma = (l * sin_theta * sin_chi).unsqueeze(-1)
+
+        # Gradients w.r.t. the placement coefficients along x, y, and z
+        g_alpha = (grad * x).sum(-1)
+        g_beta = (grad * y).sum(-1)
+        g_gamma = (grad * z).sum(-1)
+        g_l = -g_alpha * cos_theta + g_beta * sin_theta * cos_chi + g_gamma * sin_theta * sin_chi
+        g_theta = l * (g_alpha * sin_theta + g_beta * cos_theta * cos_chi + g_gamma * cos_theta * sin_chi)
+        g_chi = l * sin_theta * (-g_beta * sin_chi + g_gamma * cos_chi)
+
+        # Gradients w.r.t. the unit vectors, noting y = z x x
+        g_y = beta * grad
+        g_x = alpha * grad + torch.linalg.cross(g_y, z, dim=-1)
+        g_z = gamma * grad + torch.linalg.cross(x, g_y, dim=-1)
+
+        # Back through the normalizations, then w = v x u
+        g_u = (g_x - x * (x * g_x).sum(-1, keepdim=True)) / u_norm
+        g_w = (g_z - z * (z * g_z).sum(-1, keepdim=True)) / w_norm
+        g_v = torch.linalg.cross(u, g_w, dim=-1)
+        g_u = g_u + torch.linalg.cross(g_w, v, dim=-1)
+
+        # Finally, u = c - b and v = b - a
+        g_a = -g_v
+        g_b = g_v - g_u
+        g_c = grad + g_u
+
+        return (g_a.sum_to_size(a_shape), g_b.sum_to_size(b_shape), g_c.sum_to_size(c_shape),
+                g_l.sum_to_size(l.shape), g_theta.sum_to_size(theta.shape), g_chi.sum_to_size(chi.shape))
 
 
 def deg2rad(angle):
@@ -19,7 +19,7 @@ class StructureBuilder(object):
     really a terminal atom because it's tail is masked out?). It is simpler to
     ignore this atom for now.
     """
-    def __init__(self, seq, ang, device=torch.device("cpu")):
+    def __init__(self, seq, ang, device=torch.device("cpu"), backbone_only=False):
         """
         Initialize a StructureBuilder for a single protein.
 
@@ -31,12 +31,17 @@ class StructureBuilder(object):
             An angle tensor (L X NUM_PREDICTED_ANGLES) that contain's all of the protein's interior angles.
         device : device
             The device on which to build the structure.
+        backbone_only : bool
+            If True, only the backbone atoms (N, CA, C, O) are placed. Sidechain
+            coordinates are left as padding, so each residue still has
+            NUM_PREDICTED_COORDS coordinates.
         """
         if type(seq) == str:
             seq = torch.tensor([VOCAB._char2int[s] for s in seq])
         self.seq = seq
         self.ang = ang
         self.device = device
+        self.backbone_only = backbone_only
         self.coords = []
         self.prev_ang = None
         self.prev_bb = None
@@ -57,14 +62,17 @@ class StructureBuilder(object):
         resname_ang_iter = self.iter_resname_angs()
         first_resname, first_ang = next(resname_ang_iter)
         second_resname, second_ang = next(resname_ang_iter)
-        first_res = ResidueBuilder(first_resname, first_ang, prev_res=None, next_res=None)
-        second_res = ResidueBuilder(second_resname, second_ang, prev_res=first_res, next_res=None)
+        first_res = ResidueBuilder(first_resname, first_ang, prev_res=None, next_res=None,
+                                   backbone_only=self.backbone_only)
+        second_res = ResidueBuilder(second_resname, second_ang, prev_res=first_res, next_res=None,
+                                    backbone_only=self.backbone_only)
 
         # After building both backbones, use the second residue's N to build the first's CB
         first_res.build_bb()
         second_res.build()
         first_res.next_res = second_res
-        first_res.build_sc()
+        if not self.backbone_only:
+            first_res.build_sc()
 
         return first_res, second_res
 
@@ -83,7 +91,7 @@ class StructureBuilder(object):
         # Build the rest of the structure
         prev_res = second
         for i, (resname, ang) in enumerate(self.iter_resname_angs(start=2)):
-            res = ResidueBuilder(resname, ang, prev_res=prev_res, next_res=None)
+            res = ResidueBuilder(resname, ang, prev_res=prev_res, next_res=None, backbone_only=self.backbone_only)
             self.coords += res.build()
             prev_res = res
 
@@ -93,7 +101,7 @@ class StructureBuilder(object):
 
     def get_seq_as_str(self):
         if not self.seq_as_str:
-            self.seq_as_str = VOCAB.ints2str(map(int, self.seq))
+            self.seq_as_str = VOCAB.ints2str(self.seq)
         return self.seq_as_str
 
     def to_pdb(self, path, title="pred"):
@@ -110,7 +118,7 @@ class StructureBuilder(object):
 
 class ResidueBuilder(object):
 
-    def __init__(self, name, angles, prev_res, next_res, device=torch.device("cpu")):
+    def __init__(self, name, angles, prev_res, next_res, device=torch.device("cpu"), backbone_only=False):
         """Initialize a residue builder. If prev_{bb, ang} are None, then this
         is the first residue.
 
@@ -124,6 +132,8 @@ class ResidueBuilder(object):
             Coordinate tensor (3 x 3) of previous residue, upon which this residue is extending.
         prev_ang : Tensor, None
             Angle tensor (1 X NUM_PREDICTED_ANGLES) of previous reside, upon which this residue is extending.
+        backbone_only : bool
+            If True, build() does not place sidechain atoms.
         """
         assert type(name) == torch.Tensor, "Expected integer AA code." + str(name.shape) + str(type(name))
         if type(angles) == numpy.ndarray:
@@ -133,6 +143,7 @@ class ResidueBuilder(object):
         self.prev_res = prev_res
         self.next_res = next_res
         self.device = device
+        self.backbone_only = backbone_only
 
         self.bb = []
         self.sc = []
@@ -141,7 +152,8 @@ class ResidueBuilder(object):
 
     def build(self):
         self.build_bb()
-        self.build_sc()
+        if not self.backbone_only:
+            self.build_sc()
         return self.stack_coords()
 
     def build_bb(self):
@@ -0,0 +1,101 @@
+""" Batched dihedral and bond angle measurement for NumPy arrays and PyTorch tensors. """
+
+import numpy as np
+import torch
+
+
+def _ops(x):
+    """
+    Returns (cross, dot, norm, atan2, isfinite, where) functions that
+    operate along the last dimension for either NumPy arrays or PyTorch
+    tensors, depending on the type of x.
+    """
+    if isinstance(x, torch.Tensor):
+        return (lambda a, b: torch.linalg.cross(a, b, dim=-1),
+                lambda a, b: (a * b).sum(-1),
+                lambda a: torch.linalg.norm(a, dim=-1),
+                torch.atan2,
+                torch.isfinite,
+                torch.where)
+    return (lambda a, b: np.cross(a, b),
+            lambda a, b: (a * b).sum(-1),
+            lambda a: np.linalg.norm(a, axis=-1),
+            np.arctan2,
+            np.isfinite,
+            np.where)
+
+
+def calc_dihedrals(points, eps=1e-8, fill_value=np.nan):
+    """
+    Computes dihedral angles in radians for a batch of 4-point groups.
+
+    Uses the atan2 formulation, which is well defined over the entire range
+    of angles and never requires clamping an arccos input. Dihedrals that
+    cannot be measured are not raised as errors; instead they are flagged in
+    the returned mask and set to fill_value. This happens when any point is
+    missing (NaN or inf) or when 3 consecutive points are (nearly) collinear.
+    The sign convention matches ProDy's getDihedral.
+
+    Parameters
+    ----------
+    points : ndarray or Tensor
+        Coordinates with shape (... x 4 x 3).
+    eps : float
+        Groups whose plane normals have a norm product of at most eps are
+        considered degenerate.
+    fill_value : float
+        Value returned for dihedrals that could not be measured.
+
+    Returns
+    -------
+    (dihedrals, valid)
+        Arrays (or tensors) with shape (...) holding the dihedral angles and
+        a boolean mask that is True where the dihedral was well defined.
+    """
+    cross, dot, norm, atan2, isfinite, where = _ops(points)
+    b1 = points[..., 1, :] - points[..., 0, :]
+    b2 = points[..., 2, :] - points[..., 1, :]
+    b3 = points[..., 3, :] - points[..., 2, :]
+    n1 = cross(b1, b2)
+    n2 = cross(b2, b3)
+    x = dot(n1, n2)
+    y = norm(b2) * dot(b1, n2)
+    valid = isfinite(x) & isfinite(y) & (norm(n1) * norm(n2) > eps)
+    # Degenerate groups are measured as atan2(0, 1) so that no NaNs enter the computation (or its gradient)
+    dihedrals = where(valid, atan2(where(valid, y, 0.), where(valid, x, 1.)), fill_value)
+    return dihedrals, valid
+
+
+def calc_angles(points, eps=1e-8, fill_value=np.nan):
+    """
+    Computes the angles p0-p1-p2 in radians for a batch of 3-point groups.
+
+    Like calc_dihedrals, this uses an atan2 formulation, and angles that
+    cannot be measured (missing points or coincident points) are flagged in
+    the returned mask and set to fill_value rather than raising errors.
+
+    Parameters
+    ----------
+    points : ndarray or Tensor
+        Coordinates with shape (... x 3 x 3).
+    eps : float
+        Groups whose bond vectors have a norm product of at most eps are
+        considered degenerate.
+    fill_value : float
+        Value returned for angles that could not be measured.
+
+    Returns
+    -------
+    (angles, valid)
+        Arrays (or tensors) with shape (...) holding the angles and a boolean
+        mask that is True where the angle was well defined.
+    """
+    cross, dot, norm, atan2, isfinite, where = _ops(points)
+    v1 = points[..., 0, :] - points[..., 1, :]
+    v2 = points[..., 2, :] - points[..., 1, :]
+    x = dot(v1, v2)
+    y = norm(cross(v1, v2))
+    valid = isfinite(x) & isfinite(y) & (norm(v1) * norm(v2) > eps)
+    # Degenerate groups are measured as atan2(0, 1) so that no NaNs enter the computation (or its gradient)
+    angles = where(valid, atan2(where(valid, y, 0.), where(valid, x, 1.)), fill_value)
+    return angles, valid
@@ -3,16 +3,16 @@
 import re
 
 import numpy as np
-import prody as pr
 
 from protein_transformer.protein.SidechainBuildInfo import SC_BUILD_INFO
+from protein_transformer.protein.geometry import calc_angles, calc_dihedrals
 from protein_transformer.protein.structure_exceptions import \
     NonStandardAminoAcidError, IncompleteStructureError, SequenceError, \
     ContigMultipleMatchingError, ShortStructureError, MissingAtomsError, \
     NoneStructureError
 from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, \
-    NUM_BB_TORSION_ANGLES, NUM_BB_OTHER_ANGLES, NUM_PREDICTED_COORDS
-from protein_transformer.protein.Sequence import AA_MAP, AA_MAP_INV
+    NUM_BB_TORSION_ANGLES, NUM_BB_OTHER_ANGLES, NUM_PREDICTED_COORDS, SC_ANGLES_START_POS
+from protein_transformer.protein.Sequence import AA_MAP, AA_MAP_INV, THREE_TO_ONE_LETTER_MAP
 
 GLOBAL_PAD_CHAR = np.nan
 
@@ -23,7 +23,7 @@ def get_backbone_from_full_coords(crds, invert=False):
     this function returns the same coordinate tensor but excludes all the
     sidechain coordinates.
     """
-    mask = np.array([1, 1, 1] + [0] * (NUM_PREDICTED_COORDS - 3), dtype=np.bool)
+    mask = np.array([1, 1, 1] + [0] * (NUM_PREDICTED_COORDS - 3), dtype=bool)
     if invert:
         mask = np.invert(mask)
     if len(crds.shape) == 2:
@@ -66,6 +66,7 @@ def get_chain_from_astral_id(astral_id, d):
     pdbid, chain = d[astral_id]
     assert "," not in chain, f"Issue parsing {astral_id} with chain {chain} and pdbid {pdbid}."
     chain, resnums = chain.split(":")
+    import prody as pr
     a = pr.parsePDB(pdbid, chain=chain) # TODO maybe change this to CIF?
     if resnums != "":
         if resnums[0] == "-":
@@ -86,6 +87,7 @@ def get_header_seq_from_astral_id(astral_id, d):
     assert "," not in chain, f"Issue parsing {astral_id} with chain {chain} and pdbid {pdbid}."
     chain, resnums = chain.split(":")
     resnums = ''.join(i for i in resnums if (i.isdigit() or i == "-"))
+    import prody as pr
     a, h = pr.parsePDB(pdbid, chain=chain, header=True)
     if resnums == "":
         return h[chain].sequence
@@ -357,13 +359,17 @@ def update_contigs(contigs, current_contig, all_residues, res_id):
         current_contig = ""
     return contigs, current_contig
 
-def get_seq_and_masked_coords_and_angles(chain, true_seq):
+def get_seq_and_masked_coords_and_angles(chain, true_seq, vectorized=True):
     """
     Given a ProDy Chain object (from a Hierarchical View), return a tuple
     (angles, coords, sequence). Returns None if the PDB should be ignored due
     to weird artifacts. Also measures the bond angles along the peptide
     backbone, since they account for significant variation.
     i.e. [[phi, psi, omega, ncac, cacn, cnca, chi1, chi2,...chi12],[...] ...]
+
+    If vectorized is True, all measurements are made at once with
+    measure_chain_vectorized. Otherwise, each residue is measured in turn with
+    ProDy selections.
     """
     chain = chain.select("protein and not hetero")
     if chain is None:
@@ -372,6 +378,21 @@ def get_seq_and_masked_coords_and_angles(chain, true_seq):
         raise NonStandardAminoAcidError
     chain = chain.copy()
 
+    if vectorized:
+        dihedrals, coords, observed_sequence, contigs = measure_chain_vectorized(chain)
+        mask_seq, true_seq = use_contigs_to_compute_mask(contigs, true_seq, observed_sequence)
+        assert mask_seq.count("+") == len(coords), f"The number of coords ({len(coords)}) must match the " \
+            f"number of '+'s in mask_seq {mask_seq.count('+')}, {mask_seq}.\n{observed_sequence}\n{true_seq}"
+        assert len(mask_seq) == len(true_seq), "True sequence and coordinates must be same size at end of analysis"
+
+        # Use the mask to fill in missing residues
+        present = np.frombuffer(mask_seq.encode(), dtype=np.uint8) == ord("+")
+        dihedrals_np = np.full((len(mask_seq), NUM_PREDICTED_ANGLES), GLOBAL_PAD_CHAR)
+        dihedrals_np[present] = dihedrals
+        coords_np = np.full((len(mask_seq), NUM_PREDICTED_COORDS, 3), GLOBAL_PAD_CHAR)
+        coords_np[present] = coords
+        return dihedrals_np, coords_np.reshape(-1, 3), true_seq
+
     coords = []
     dihedrals = []
     observed_sequence = ""
@@ -431,6 +452,129 @@ def get_seq_and_masked_coords_and_angles(chain, true_seq):
     return dihedrals_np, coords_np, true_seq
 
 
+def _make_residue_slot_tables():
+    """
+    Returns (slot_map, sc_dihedral_slots). slot_map maps "RESNAME ATOMNAME" to
+    the position of that atom within the NUM_PREDICTED_COORDS coordinates
+    recorded for each residue. sc_dihedral_slots maps each residue name to an
+    integer array (NUM_SC_ANGLES - 1 x 4) of atom positions that define the
+    residue's sidechain dihedrals after the CB dihedral, or -1 where no
+    dihedral is recorded. Both follow the same conventions as
+    measure_res_coordinates and compute_sidechain_dihedrals.
+    """
+    num_sc_angles = NUM_PREDICTED_ANGLES - (NUM_BB_TORSION_ANGLES + NUM_BB_OTHER_ANGLES)
+    slot_map = {}
+    sc_dihedral_slots = {}
+    for resname, info in SC_BUILD_INFO.items():
+        atom_names = ["N", "CA", "C", "O"] + info["atom-names"]
+        for slot, an in enumerate(atom_names):
+            slot_map[f"{resname} {an}"] = slot
+        dihedral_slots = np.full((num_sc_angles - 1, 4), -1)
+        for i, (t_name, t_val) in enumerate(zip(info["torsion-names"][1:], info["torsion-vals"][1:])):
+            if t_val != "p":
+                break
+            dihedral_slots[i] = [atom_names.index(an) for an in t_name.split("-")]
+        sc_dihedral_slots[resname] = dihedral_slots
+    return slot_map, sc_dihedral_slots
+
+
+RESIDUE_ATOM_SLOTS, SC_DIHEDRAL_SLOTS = _make_residue_slot_tables()
+
+
+def measure_chain_vectorized(chain):
+    """
+    Given a ProDy AtomGroup containing a single protein chain, measures all of
+    its angles and coordinates at once. This is equivalent to measuring each
+    residue in turn with measure_phi_psi_omega, measure_bond_angles,
+    compute_sidechain_dihedrals and measure_res_coordinates, but avoids
+    making any per-residue ProDy selections.
+
+    Returns (dihedrals, coords, observed_sequence, contigs), where dihedrals
+    has shape (L x NUM_PREDICTED_ANGLES), coords has shape
+    (L x NUM_PREDICTED_COORDS x 3), and contigs is the list of contiguous
+    observed sequence portions that would be recorded by update_contigs.
+    """
+    # Each atom's residue index, following the ordering of chain.iterResidues()
+    resindices = chain.getResindices()
+    n_res = resindices.max() + 1
+    if n_res < 2:
+        raise ShortStructureError
+    _, first_atoms = np.unique(resindices, return_index=True)
+    resnames = chain.getResnames()[first_atoms]
+    resnums = chain.getResnums()[first_atoms]
+    try:
+        observed_sequence = "".join([THREE_TO_ONE_LETTER_MAP[rn] for rn in resnames])
+    except KeyError:
+        raise NonStandardAminoAcidError
+
+    # Gather coordinates into an (L x NUM_PREDICTED_COORDS + 1 x 3) array. The last position is always missing.
+    atom_keys, key_inverse = np.unique(np.char.add(np.char.add(chain.getResnames().astype(str), " "),
+                                                   chain.getNames().astype(str)), return_inverse=True)
+    slots = np.asarray([RESIDUE_ATOM_SLOTS.get(k, -1) for k in atom_keys])[key_inverse.reshape(-1)]
+    recorded = np.flatnonzero(slots >= 0)
+    # If an atom name is repeated in a residue, only the first occurrence is recorded
+    flat_positions, first = np.unique(resindices[recorded] * (NUM_PREDICTED_COORDS + 1) + slots[recorded],
+                                      return_index=True)
+    coords = np.full((n_res * (NUM_PREDICTED_COORDS + 1), 3), GLOBAL_PAD_CHAR)
+    coords[flat_positions] = chain.getCoords()[recorded[first]]
+    coords = coords.reshape(n_res, NUM_PREDICTED_COORDS + 1, 3)[:, :NUM_PREDICTED_COORDS]
+    dihedrals = measure_angles_from_coords(coords, resnames)
+    n, c = coords[:, 0], coords[:, 2]
+
+    # Residues are contiguous if the peptide bond is short enough, or, if atoms are missing, if resnums are adjacent
+    contiguous_threshold = 2
+    with np.errstate(invalid="ignore"):
+        contiguous = np.linalg.norm(c[:-1] - n[1:], axis=-1) <= contiguous_threshold
+    missing = np.isnan(c[:-1]).any(-1) | np.isnan(n[1:]).any(-1)
+    contiguous[missing] = (resnums[:-1] + 1 == resnums[1:])[missing]
+    breaks = np.flatnonzero(~contiguous) + 1
+    contigs = [observed_sequence[i:j] for i, j in zip(np.concatenate(([0], breaks)),
+                                                      np.concatenate((breaks, [n_res])))]
+
+    return dihedrals, coords, observed_sequence, contigs
+
+
+def measure_angles_from_coords(coords, resnames):
+    """
+    Measures all of the angles of a protein chain from its coordinates, using
+    the same conventions as measure_chain_vectorized. coords has shape
+    (L x NUM_PREDICTED_COORDS x 3) and uses GLOBAL_PAD_CHAR for missing atoms,
+    and resnames is the sequence of 3-letter residue names. Returns an array
+    of angles with shape (L x NUM_PREDICTED_ANGLES).
+    """
+    n_res = coords.shape[0]
+    # Add an always-missing atom position, used to measure sidechain dihedrals that do not exist
+    coords = np.concatenate((coords, np.full((n_res, 1, 3), GLOBAL_PAD_CHAR)), axis=1)
+    n, ca, c = coords[:, 0], coords[:, 1], coords[:, 2]
+
+    # Backbone torsion and bond angles, which depend on the previous and next residues
+    dihedrals = np.full((n_res, NUM_PREDICTED_ANGLES), GLOBAL_PAD_CHAR)
+    dihedrals[1:, 0] = calc_dihedrals(np.stack([c[:-1], n[1:], ca[1:], c[1:]], -2))[0]
+    dihedrals[1:, 0][np.isnan(ca[:-1]).any(-1)] = GLOBAL_PAD_CHAR  # calcPhi also requires the previous CA
+    dihedrals[:-1, 1] = calc_dihedrals(np.stack([n[:-1], ca[:-1], c[:-1], n[1:]], -2))[0]
+    dihedrals[:-1, 1][np.isnan(ca[1:]).any(-1)] = GLOBAL_PAD_CHAR  # calcPsi also requires the next CA
+    dihedrals[:-1, 2] = calc_dihedrals(np.stack([ca[:-1], c[:-1], n[1:], ca[1:]], -2))[0]
+    dihedrals[:, 3] = calc_angles(np.stack([n, ca, c], -2))[0]
+    dihedrals[:-1, 4] = calc_angles(np.stack([ca[:-1], c[:-1], n[1:]], -2))[0]
+    dihedrals[:-1, 5] = calc_angles(np.stack([c[:-1], n[1:], ca[1:]], -2))[0]
+
+    # The CB dihedral uses the previous residue's C, or the next residue's N for the first residue
+    cb_start = SC_ANGLES_START_POS
+    has_cb = np.asarray([len(SC_BUILD_INFO[rn]["torsion-names"]) > 0 for rn in resnames])
+    cb_dihedrals = np.empty(n_res)
+    cb_dihedrals[0] = calc_dihedrals(np.stack([n[1], c[0], ca[0], coords[0, 4]]))[0]
+    cb_dihedrals[1:] = calc_dihedrals(np.stack([c[:-1], n[1:], ca[1:], coords[1:, 4]], -2))[0]
+    dihedrals[has_cb, cb_start] = cb_dihedrals[has_cb]
+
+    # The remaining sidechain dihedrals are defined by atom positions within each residue
+    sc_slots = np.stack([SC_DIHEDRAL_SLOTS[rn] for rn in resnames])
+    sc_slots[sc_slots == -1] = NUM_PREDICTED_COORDS
+    sc_coords = coords[np.arange(n_res)[:, None, None], sc_slots]
+    dihedrals[:, cb_start + 1:] = calc_dihedrals(sc_coords)[0]
+
+    return dihedrals
+
+
 def residues_are_contiguous(resA, resB):
     """
      Returns True if resA is connected to resB.
@@ -486,6 +630,7 @@ def safecalcAngle(a, b, c, radian):
     Calculates the angle between 3 coordinates. If any of them are missing, the
     function raises a MissingAtomsError.
     """
+    import prody as pr
     try:
         angle = pr.calcAngle(a, b, c, radian=radian)[0]
     except ValueError:
@@ -510,6 +655,7 @@ def measure_phi_psi_omega(residue, include_OXT=False):
     Returns phi, psi, omega for a residue, replacing out-of-bounds angles
     with GLOBAL_PAD_CHAR.
     """
+    import prody as pr
     try:
         phi = pr.calcPhi(residue, radian=True, dist=None)
     except ValueError:
@@ -552,34 +698,12 @@ def compute_single_dihedral(atoms):
 
 def get_dihedral(coords1, coords2, coords3, coords4, radian=False):
     """
-    Returns the dihedral angle in degrees. Modified from
-    prody.measure.measure to use a numerically safe normalization method.
-    """
-    rad2deg = 180 / np.pi
-    eps = 1e-6
-
-    a1 = coords2 - coords1
-    a2 = coords3 - coords2
-    a3 = coords4 - coords3
-
-    v1 = np.cross(a1, a2)
-    v1 = v1 / (v1 * v1).sum(-1) ** 0.5
-    v2 = np.cross(a2, a3)
-    v2 = v2 / (v2 * v2).sum(-1) ** 0.5
-    porm = np.sign((v1 * a3).sum(-1))
-    arccos_input_raw = (v1 * v2).sum(-1) / ((v1 ** 2).sum(-1) * (v2 ** 2).sum(-1)) ** 0.5
-    if -1 <= arccos_input_raw <= 1:
-        arccos_input = arccos_input_raw
-    elif arccos_input_raw > 1 and arccos_input_raw - 1 < eps:
-        arccos_input = 1
-    elif arccos_input_raw < -1 and np.abs(arccos_input_raw) - 1 < eps:
-        arccos_input = -1
-    else:
-        raise ArithmeticError("Numerical issue with input to arccos.")
-    rad = np.arccos(arccos_input)
-    if not porm == 0:
-        rad = rad * porm
+    Returns the dihedral angle in degrees. Dihedrals that cannot be measured
+    (i.e. 3 collinear points) are returned as GLOBAL_PAD_CHAR rather than
+    raising an error. See geometry.calc_dihedrals.
+    """
+    rad, _ = calc_dihedrals(np.stack([coords1, coords2, coords3, coords4]), fill_value=GLOBAL_PAD_CHAR)
     if radian:
         return rad
     else:
-        return rad * rad2deg
+        return np.degrees(rad)
@@ -0,0 +1,460 @@
+""" An HTTP server that predicts protein structures with a trained model.
+
+    The model is loaded from its checkpoint once, when the server starts.
+    Single-sequence requests are queued and coalesced by a DynamicBatcher into
+    length-bucketed micro-batches: waiting requests are predicted together as
+    soon as max_batch_tokens residues are queued or the oldest request has
+    waited max_wait_ms. Prediction runs on a dedicated thread, so the event
+    loop keeps accepting requests while a batch is predicted, and coordinates
+    and PDB files are built by a pool of worker processes. With --cache_dir,
+    outputs are stored in a PredictionCache and requests for sequences that
+    were predicted before skip the model and the worker pool.
+
+    Endpoints:
+        POST /predict   {"sequence": "MKV...", "id": "optional", "output": "angles" | "coords" | "pdb"}
+                        Returns {"id", "sequence"} and one of "angles" (L x NUM_PREDICTED_ANGLES, in
+                        radians), "coords" (L*NUM_PREDICTED_COORDS x 3, null for missing atoms) or "pdb".
+        GET  /health    Returns {"status": "ok"} and a description of the model.
+        GET  /metrics   Returns request counts, batch sizes, latency percentiles and queue depth.
+
+    Usage:
+        python -m protein_transformer.server model_best.chkpt --port 8000 --build_workers 4
+        python scripts/load_test_server.py --port 8000 --concurrency 32
+"""
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+
+import numpy as np
+import torch
+
+from protein_transformer.inference import (load_model_from_checkpoint, predict_angles, build_coords,
+                                           bucket_by_length, get_max_len)
+from protein_transformer.prediction_cache import PredictionCache, model_digest
+from protein_transformer.protein.PDB_Creator import PDB_Creator
+from protein_transformer.protein.Sequence import VOCAB
+
+MAX_BODY_BYTES = 1 << 20
+OUTPUT_TYPES = ["angles", "coords", "pdb"]
+
+
+class BadRequest(Exception):
+    """ Raised when a request cannot be served. The message is returned to the client. """
+
+    def __init__(self, message, status=HTTPStatus.BAD_REQUEST):
+        super().__init__(message)
+        self.status = status
+
+
+def build_pdb(seq, angles, title, coords=None):
+    """
+    Returns the coordinates and PDB file contents of a sequence (string)
+    given its angles in radians, building the coordinates if not provided.
+    """
+    if coords is None:
+        coords = build_coords(seq, angles)
+    return coords, PDB_Creator(coords, seq).get_pdb_string(title)
+
+
+def _init_build_worker():
+    torch.set_num_threads(1)
+
+
+class ServerMetrics(object):
+    """ Records the requests and batches served, keeping the latencies of the most recent window requests. """
+
+    def __init__(self, window=10000):
+        self.start_time = time.time()
+        self.responses = collections.Counter()
+        self.num_batches = 0
+        self.num_batched_seqs = 0
+        self.num_residues = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+
+    def record_response(self, status, latency=None):
+        self.responses[int(status)] += 1
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def record_batch(self, seqs):
+        self.num_batches += 1
+        self.num_batched_seqs += len(seqs)
+        self.num_residues += sum(len(s) for s in seqs)
+        self.batch_sizes.append(len(seqs))
+
+    def summary(self, queue_depth=0, cache=None):
+        uptime = time.time() - self.start_time
+        latencies = np.asarray(self.latencies) * 1000
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) if len(latencies) else (None, None, None)
+        return {"uptime_seconds": uptime,
+                "responses": {str(k): v for k, v in sorted(self.responses.items())},
+                "num_predictions": self.num_batched_seqs,
+                "num_residues": self.num_residues,
+                "num_batches": self.num_batches,
+                "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+                "max_batch_size": int(np.max(self.batch_sizes)) if self.batch_sizes else None,
+                "latency_ms": {"p50": p50, "p90": p90, "p99": p99},
+                "predictions_per_second": self.num_batched_seqs / max(uptime, 1e-9),
+                "queue_depth": queue_depth,
+                "cache": cache.stats() if cache is not None else None}
+
+
+class DynamicBatcher(object):
+    """
+    Coalesces single-sequence predictions into batches.
+
+    Callers await predict(seq). The first queued sequence opens a batch,
+    which is closed once it holds max_batch_tokens residues or
+    max_batch_size sequences, or max_wait_ms after it was opened. The closed
+    batch is split into length buckets (see bucket_by_length) so that little
+    computation is spent on padding, and each bucket is predicted by
+    predict_fn (a function of a list of sequences returning a list of
+    angles) on a single dedicated thread.
+    """
+
+    def __init__(self, predict_fn, max_batch_tokens=16384, max_batch_size=64, max_wait_ms=10, max_len=None,
+                 metrics=None):
+        self.predict_fn = predict_fn
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_len = max_len
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="predict")
+
+    async def predict(self, seq):
+        """ Returns the predicted angles of seq once its batch has been predicted. """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((future, seq))
+        return await future
+
+    async def _collect(self):
+        """ Waits for a sequence, then returns all (future, sequence) items that join its batch. """
+        loop = asyncio.get_running_loop()
+        pending = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        num_tokens = len(pending[0][1])
+        while num_tokens < self.max_batch_tokens and len(pending) < self.max_batch_size:
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            pending.append(item)
+            num_tokens += len(item[1])
+        return pending
+
+    async def _predict_batch(self, batch):
+        batch = [(future, seq) for future, seq in batch if not future.done()]  # Skip cancelled requests
+        if not batch:
+            return
+        seqs = [seq for _, seq in batch]
+        try:
+            angles = await asyncio.get_running_loop().run_in_executor(self.executor, self.predict_fn, seqs)
+        except Exception as e:
+            for future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if self.metrics is not None:
+            self.metrics.record_batch(seqs)
+        for (future, _), ang in zip(batch, angles):
+            if not future.done():
+                future.set_result(ang)
+
+    async def run(self):
+        """ Predicts queued sequences until cancelled. """
+        try:
+            while True:
+                pending = await self._collect()
+                for batch in bucket_by_length(pending, self.max_batch_tokens, self.max_batch_size, self.max_len):
+                    await self._predict_batch(batch)
+        finally:
+            self.executor.shutdown(wait=False)
+
+
+class PredictionServer(object):
+    """
+    Serves predictions from a loaded model over HTTP/1.1 (see the module
+    docstring for the endpoints). Connections are kept alive unless the
+    client sends "Connection: close".
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        A model in evaluation mode, e.g. from load_model_from_checkpoint.
+    model_args : argparse.Namespace
+        The arguments the model was trained with, reported by /health.
+    build_workers : int
+        Number of processes that build coordinates and PDB files. 0 builds
+        them on a thread of the server's process.
+    max_request_len : int
+        Longest sequence accepted. Defaults to the model's maximum length
+        for encoder-decoder models and no limit for encoder-only models,
+        which predict long sequences with sliding windows.
+    cache : PredictionCache
+        Cache of previous predictions, which must have been created for
+        this model and prediction options (see model_digest).
+
+    The remaining parameters are passed to DynamicBatcher and predict_angles.
+    """
+
+    def __init__(self, model, model_args=None, max_batch_tokens=16384, max_batch_size=64, max_wait_ms=10,
+                 build_workers=0, max_request_len=None, refine_passes=None, window=None, overlap=None, cache=None):
+        self.model = model
+        self.model_args = model_args
+        self.model_max_len = get_max_len(model)
+        self.max_request_len = max_request_len
+        if hasattr(model, "decoder"):
+            self.max_request_len = min(max_request_len or self.model_max_len, self.model_max_len)
+        self.build_workers = build_workers
+        self.cache = cache
+        self.metrics = ServerMetrics()
+        self.batcher_kwargs = dict(max_batch_tokens=max_batch_tokens, max_batch_size=max_batch_size,
+                                   max_wait_ms=max_wait_ms, max_len=self.model_max_len, metrics=self.metrics)
+        self.predict_kwargs = dict(refine_passes=refine_passes, window=window, overlap=overlap)
+        self.standard_aas = set(VOCAB.stdaas)
+        self.batcher = None
+        self.build_pool = None
+        self.server = None
+        self._batcher_task = None
+
+    def _predict_fn(self, seqs):
+        return predict_angles(self.model, seqs, **self.predict_kwargs)
+
+    async def start(self, host="127.0.0.1", port=8000):
+        """ Starts serving on host:port (port 0 picks a free port) and returns the asyncio.Server. """
+        self.batcher = DynamicBatcher(self._predict_fn, **self.batcher_kwargs)
+        self._batcher_task = asyncio.create_task(self.batcher.run())
+        if self.build_workers:
+            self.build_pool = ProcessPoolExecutor(self.build_workers, initializer=_init_build_worker)
+        else:
+            self.build_pool = ThreadPoolExecutor(1, thread_name_prefix="build")
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
+
+    async def close(self):
+        """ Stops accepting connections and shuts down the batcher and worker pool. """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self._batcher_task is not None:
+            self._batcher_task.cancel()
+            try:
+                await self._batcher_task
+            except asyncio.CancelledError:
+                pass
+        if self.build_pool is not None:
+            self.build_pool.shutdown(wait=False, cancel_futures=True)
+
+    async def serve_forever(self, host="127.0.0.1", port=8000):
+        server = await self.start(host, port)
+        print(f"[Info] Serving predictions on http://{host}:{server.sockets[0].getsockname()[1]}")
+        try:
+            await server.serve_forever()
+        finally:
+            await self.close()
+
+    async def handle_connection(self, reader, writer):
+        """ Serves the requests sent over one connection. """
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except BadRequest as e:
+                    self.metrics.record_response(e.status)
+                    await write_response(writer, e.status, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                start = time.perf_counter()
+                try:
+                    status, payload = HTTPStatus.OK, await self.route(method, path, body)
+                except BadRequest as e:
+                    status, payload = e.status, {"error": str(e)}
+                except Exception as e:
+                    status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(e).__name__}: {e}"}
+                latency = time.perf_counter() - start if path == "/predict" and status == HTTPStatus.OK else None
+                self.metrics.record_response(status, latency)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        """ Returns the JSON-serializable response to a request, raising BadRequest for invalid ones. """
+        if path == "/predict":
+            if method != "POST":
+                raise BadRequest("Use POST for /predict.", HTTPStatus.METHOD_NOT_ALLOWED)
+            return await self.predict(body)
+        if path in ("/health", "/metrics"):
+            if method != "GET":
+                raise BadRequest(f"Use GET for {path}.", HTTPStatus.METHOD_NOT_ALLOWED)
+            return self.health() if path == "/health" else self.metrics.summary(self.batcher.queue.qsize(), self.cache)
+        raise BadRequest(f"Unknown path {path}.", HTTPStatus.NOT_FOUND)
+
+    def health(self):
+        return {"status": "ok",
+                "model": getattr(self.model_args, "model", type(self.model).__name__),
+                "max_len": self.model_max_len,
+                "max_request_len": self.max_request_len,
+                "build_workers": self.build_workers}
+
+    async def predict(self, body):
+        try:
+            request = json.loads(body)
+        except ValueError:
+            raise BadRequest("The request body must be a JSON object.")
+        if not isinstance(request, dict) or not isinstance(request.get("sequence"), str):
+            raise BadRequest('The request must have a "sequence" string.')
+        seq = request["sequence"].strip().upper()
+        output = request.get("output", "angles")
+        if output not in OUTPUT_TYPES:
+            raise BadRequest(f'"output" must be one of {", ".join(OUTPUT_TYPES)}.')
+        if not seq or not set(seq) <= self.standard_aas:
+            raise BadRequest("The sequence must be a non-empty string of the 20 standard amino acids.")
+        if self.max_request_len is not None and len(seq) > self.max_request_len:
+            raise BadRequest(f"The sequence is longer than {self.max_request_len} residues.",
+                             HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+        loop = asyncio.get_running_loop()
+        title = str(request.get("id") or "prediction")
+        cached = None
+        if self.cache is not None:
+            cached = await loop.run_in_executor(None, self.cache.get, seq, title)
+        cached = cached or {}
+        angles = cached.get("angles")
+        if angles is None:
+            angles = await self.batcher.predict(seq)
+        coords, pdb = cached.get("coords"), cached.get("pdb")
+
+        response = {"id": request.get("id"), "sequence": seq}
+        if output == "angles":
+            response["angles"] = angles.tolist()
+        elif output == "coords":
+            if coords is None:
+                coords = await loop.run_in_executor(self.build_pool, build_coords, seq, angles)
+            response["coords"] = np.where(np.isnan(coords), None, np.round(coords, 3)).tolist()
+        else:
+            if pdb is None:
+                coords, pdb = await loop.run_in_executor(self.build_pool, build_pdb, seq, angles, title, coords)
+            response["pdb"] = pdb
+
+        if self.cache is not None and (("angles" not in cached) or (coords is not None and "coords" not in cached)
+                                       or (pdb is not None and "pdb" not in cached and self.cache.store_pdb)):
+            await loop.run_in_executor(None, self.cache.put, seq, angles, coords, pdb)
+        return response
+
+
+async def read_request(reader):
+    """
+    Reads an HTTP/1.1 request and returns (method, path, headers, body),
+    where header names are lower-case, or None if the connection was closed.
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise BadRequest("Malformed request line.")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise BadRequest("Malformed Content-Length.")
+    if length > MAX_BODY_BYTES:
+        raise BadRequest(f"The request body is larger than {MAX_BODY_BYTES} bytes.",
+                         HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length) if length > 0 else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+
+async def write_response(writer, status, payload, keep_alive=True):
+    """ Writes payload as a JSON response with the given status. """
+    body = json.dumps(payload).encode()
+    status = HTTPStatus(status)
+    head = (f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+
+def main():
+    device = torch.device(args.device)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, model_args = load_model_from_checkpoint(args.checkpoint, device)
+    cache = None
+    if args.cache_dir:
+        digest = model_digest(model, model_args, refine_passes=args.refine_passes, window=args.window,
+                              overlap=args.overlap)
+        cache = PredictionCache(args.cache_dir, digest, max_bytes=int(args.cache_max_gb * 2 ** 30),
+                                store_pdb=args.cache_pdb)
+    server = PredictionServer(model, model_args, max_batch_tokens=args.max_batch_tokens,
+                              max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                              build_workers=args.build_workers, max_request_len=args.max_request_len,
+                              refine_passes=args.refine_passes, window=args.window, overlap=args.overlap,
+                              cache=cache)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves structure predictions from a trained model over HTTP.")
+    parser.add_argument("checkpoint", type=str, help="Path to a model checkpoint saved by train.py.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--device", type=str, default="cpu", help="Device used for prediction, e.g. cpu or cuda.")
+    parser.add_argument("--threads", type=int, default=None, help="Number of threads used by torch for prediction.")
+    parser.add_argument("--max_batch_tokens", type=int, default=16384,
+                        help="Maximum number of (padded) residues predicted in a batch.")
+    parser.add_argument("--max_batch_size", type=int, default=64, help="Maximum number of sequences in a batch.")
+    parser.add_argument("--max_wait_ms", type=float, default=10,
+                        help="Maximum time a request waits for others to join its batch.")
+    parser.add_argument("--build_workers", type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                        help="Number of processes used to build coordinates and PDB files. 0 builds them on a "
+                             "thread of the server.")
+    parser.add_argument("--max_request_len", type=int, default=None,
+                        help="Longest sequence accepted. Defaults to no limit for encoder-only models.")
+    parser.add_argument("--refine_passes", type=int, default=None,
+                        help="For enc-dec models, decode with this many refinement passes instead of "
+                             "autoregressively.")
+    parser.add_argument("--window", type=int, default=None,
+                        help="Window length for sequences longer than the model's maximum length.")
+    parser.add_argument("--overlap", type=int, default=None, help="Overlap between windows.")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Directory of a prediction cache, used to skip sequences predicted before.")
+    parser.add_argument("--cache_max_gb", type=float, default=10,
+                        help="Size of the prediction cache, beyond which the least recently used entries are "
+                             "evicted.")
+    parser.add_argument("--cache_pdb", action="store_true", help="Also store PDB files in the prediction cache.")
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,17 @@
+import numpy as np
+import torch
+
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES
+from protein_transformer.train import create_parser, make_model
+
+
+def make_small_model(model_type="enc-only", seed=0):
+    """
+    Returns a small, randomly initialized model of type model_type, and the
+    training arguments that describe it, for tests that save or load models.
+    """
+    torch.manual_seed(seed)
+    args = create_parser().parse_args(["-dm", "16", "-nh", "2", "-dih", "32", "-nl", "1"])
+    args.model = model_type
+    angle_means = np.random.RandomState(seed).uniform(-.9, .9, NUM_PREDICTED_ANGLES * 2)
+    return make_model(args, torch.device("cpu"), angle_means), args
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import torch
+
+from protein_transformer.models.encoder_only import EncoderOnlyTransformer
+from protein_transformer.models.transformer.Attention import MultiHeadedAttention, LocalMultiHeadedAttention
+from protein_transformer.protein.Sequence import VOCAB
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES
+
+
+@pytest.mark.parametrize("L,window,n_global", [(37, 5, 0), (37, 5, 3), (10, 20, 0), (64, 8, 2), (1, 3, 1)])
+def test_local_attention_matches_banded_full_attention(L, window, n_global):
+    torch.manual_seed(0)
+    full = MultiHeadedAttention(32, 4, dropout=0)
+    local = LocalMultiHeadedAttention(32, 4, window, n_global, dropout=0)
+    local.load_state_dict(full.state_dict())
+    x = torch.randn(3, L, 32)
+    key_mask = torch.ones(3, L, dtype=torch.bool)
+    key_mask[1, max(1, L * 2 // 3):] = False
+
+    # Equivalent full attention mask: within the band, or to/from a global token, and never to padding
+    i = torch.arange(L)
+    band = ((i[:, None] - i[None]).abs() <= window) | (i[:, None] < n_global) | (i[None] < n_global)
+    expected = full(x, x, x, mask=band[None] & key_mask[:, None, :])
+    out = local(x, x, x, mask=key_mask.unsqueeze(-2))
+
+    assert not torch.isnan(out).any()
+    assert torch.allclose(out[key_mask], expected[key_mask], atol=1e-5)
+
+
+def test_local_attention_gradients():
+    local = LocalMultiHeadedAttention(16, 2, window=4, n_global=1, dropout=0)
+    x = torch.randn(2, 21, 16, requires_grad=True)
+    local(x, x, x).sum().backward()
+    assert torch.isfinite(x.grad).all()
+
+
+def test_encoder_with_mixed_attention_layers():
+    model = EncoderOnlyTransformer(nlayers=3, nhead=2, dmodel=16, dff=32, max_seq_len=100, vocab=VOCAB,
+                                   angle_means=np.zeros(NUM_PREDICTED_ANGLES * 2), use_tanh_out=True,
+                                   attn_types=["local", "local", "full"], attn_window=4)
+    assert [type(l.self_attn) for l in model.encoder.enc_layers] == [LocalMultiHeadedAttention] * 2 + \
+        [MultiHeadedAttention]
+    seqs = torch.randint(0, 20, (2, 50))
+    seqs[1, 30:] = VOCAB.pad_id
+    out = model(seqs)
+    assert out.shape == (2, 50, NUM_PREDICTED_ANGLES * 2) and not torch.isnan(out).any()
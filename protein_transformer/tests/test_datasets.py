@@ -3,7 +3,9 @@ import torch
 from pytest import approx
 import pytest
 
-from protein_transformer.dataset import BinnedProteinDataset, paired_collate_fn, SimilarLengthBatchSampler
+from protein_transformer.dataset import BinnedProteinDataset, paired_collate_fn, SimilarLengthBatchSampler, \
+    ProteinDataset, precompute_sequence_data, crop_protein, sample_crop_start
+from protein_transformer.protein.Sequence import VOCAB
 
 from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, \
     NUM_PREDICTED_COORDS
@@ -31,6 +33,95 @@ def test_BinnedProteinDataset():
     assert len(seqs) - 1 in bpd.bin_map[max(bpd.bin_map.keys())] # last seq in last bin
 
 
+def make_proteins(lengths, missing=()):
+    seqs = ["".join(np.random.choice(list("ACDEFGHIKLMNPQRSTVWY"), l)) for l in lengths]
+    angs = [np.random.rand(l, NUM_PREDICTED_ANGLES * 2) for l in lengths]
+    crds = [np.random.rand(l * NUM_PREDICTED_COORDS, 3) for l in lengths]
+    for i in missing:
+        angs[i][1] = np.nan
+    return seqs, angs, crds
+
+
+def test_precompute_sequence_data():
+    seqs, angs, _ = make_proteins([5, 8, 13], missing=[1])
+    pre = precompute_sequence_data(seqs, angs)
+    assert all(s.dtype == np.int8 for s in pre["seq_ints"])
+    assert [list(s) for s in pre["seq_ints"]] == [VOCAB.str2ints(s, add_sos_eos=False) for s in seqs]
+    assert list(pre["has_missing"]) == [False, True, False]
+    assert list(pre["lens"]) == [5, 8, 13]
+
+
+@pytest.mark.parametrize("add_sos_eos", [True, False])
+def test_ProteinDataset_precomputed(add_sos_eos):
+    seqs, angs, crds = make_proteins([7, 12, 3, 12, 9], missing=[4])
+    plain = ProteinDataset(seqs, angs, crds, add_sos_eos=add_sos_eos)
+    pre = ProteinDataset(seqs, angs, crds, add_sos_eos=add_sos_eos, **precompute_sequence_data(seqs, angs))
+    assert len(plain) == len(pre) == 4
+    for i in range(len(plain)):
+        a, b = plain[i], pre[i]
+        assert list(a[0]) == list(b[0]) and a[1] is b[1] and a[2] is b[2]
+    # Longest first, ties kept in their original order, and the protein with a missing residue skipped
+    assert [len(pre[i][1]) for i in range(len(pre))] == [12, 12, 7, 3]
+    assert pre[0][1] is angs[1] and pre[1][1] is angs[3]
+    expected = VOCAB.str2ints(seqs[1], add_sos_eos=add_sos_eos)
+    assert list(pre[0][0]) == expected
+    assert len(ProteinDataset(seqs, angs, crds, skip_missing_residues=False)) == 5
+
+
+def test_BinnedProteinDataset_bin_data():
+    lengths = [10, 11, 20, 21, 22, 40, 41, 80]
+    seqs, angs, crds = make_proteins(lengths, missing=[3])
+    hist_counts, hist_bins = np.histogram(lengths, bins="auto")
+    bin_data = {"hist_counts": hist_counts, "hist_bins": hist_bins[1:], "bin_probs": hist_counts / hist_counts.sum(),
+                "bin_max_len": 500}
+    bpd = BinnedProteinDataset(seqs, angs, crds, bin_data=bin_data, **precompute_sequence_data(seqs, angs))
+
+    assert len(bpd) == len(lengths) - 1
+    assert np.array_equal(bpd.hist_bins, bin_data["hist_bins"])
+    assert approx(bpd.bin_probs.sum()) == 1
+    assert sorted(np.concatenate(list(bpd.bin_map.values()))) == list(range(len(bpd)))
+    for b, idx in bpd.bin_map.items():
+        assert bpd.hist_counts[b] == len(idx)
+        for i in idx:
+            length = len(bpd[i][1])
+            assert length <= bpd.hist_bins[b] and (b == 0 or length > bpd.hist_bins[b - 1])
+    # Sequence lengths used for dynamic batching include <sos>/<eos>
+    assert list(bpd.lens) == [l + 2 for i, l in enumerate(lengths) if i != 3]
+
+
+def test_crop_protein_consistent():
+    seqs, angs, crds = make_proteins([50])
+    seq = VOCAB.encode(seqs[0], add_sos_eos=False)
+    for _ in range(20):
+        cseq, cang, ccrd = crop_protein(seq, angs[0], crds[0], 16)
+        assert len(cseq) == len(cang) == 16 and len(ccrd) == 16 * NUM_PREDICTED_COORDS
+        start = int(np.flatnonzero((angs[0] == cang[0]).all(axis=-1))[0])
+        assert np.array_equal(cseq, seq[start:start + 16])
+        assert np.array_equal(ccrd, crds[0][start * NUM_PREDICTED_COORDS:(start + 16) * NUM_PREDICTED_COORDS])
+    # Short proteins are returned as is
+    assert crop_protein(seq, angs[0], crds[0], 100)[1] is angs[0]
+
+
+def test_sample_crop_start_observed_bias():
+    np.random.seed(0)
+    ang = np.random.rand(100, NUM_PREDICTED_ANGLES * 2)
+    ang[:80] = np.nan
+    starts = [sample_crop_start(ang, 20, observed_bias=1) for _ in range(100)]
+    assert min(starts) >= 61  # every window must contain at least one observed residue
+    uniform = [sample_crop_start(ang, 20) for _ in range(200)]
+    assert min(uniform) < 61 and max(uniform) <= 80
+
+
+def test_BinnedProteinDataset_crop():
+    lengths = [10, 30, 400, 900]
+    seqs, angs, crds = make_proteins(lengths)
+    bpd = BinnedProteinDataset(seqs, angs, crds, add_sos_eos=False, crop_len=64)
+    assert list(bpd.lens) == [10, 30, 64, 64]
+    batch = paired_collate_fn([bpd[i] for i in range(len(bpd))])
+    assert batch[0].shape == (4, 64) and batch[1].shape == (4, 64, NUM_PREDICTED_ANGLES * 2)
+    assert batch[2].shape == (4, 64 * NUM_PREDICTED_COORDS, 3)
+
+
 # def test_BinnedProteinDataset_200122dataset(casp12_dataset_ex):
 #     d = casp12_dataset_ex
 #     seqs, angs, crds = d["train"]["seq"], d["train"]["ang"], d["train"]["crd"]
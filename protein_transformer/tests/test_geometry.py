@@ -0,0 +1,94 @@
+import numpy as np
+import prody as pr
+import pytest
+import torch
+
+from protein_transformer.protein.geometry import calc_angles, calc_dihedrals
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, NUM_PREDICTED_COORDS
+from protein_transformer.protein.StructureBuilder import StructureBuilder
+from protein_transformer.protein.structure_utils import get_dihedral
+
+
+def angle_diff(a, b):
+    """ Returns the absolute difference between two angles in radians, accounting for periodicity. """
+    return np.abs(np.arctan2(np.sin(a - b), np.cos(a - b)))
+
+
+def test_dihedrals_match_prody():
+    points = np.random.RandomState(0).normal(size=(100, 4, 3))
+    dihedrals, valid = calc_dihedrals(points)
+    expected = pr.measure.measure.getDihedral(points[:, 0], points[:, 1], points[:, 2], points[:, 3], radian=True)
+    assert valid.all()
+    assert np.allclose(dihedrals, expected)
+    assert np.allclose(get_dihedral(*points[0], radian=True), expected[0])
+
+
+def test_angles_match_prody():
+    points = np.random.RandomState(0).normal(size=(100, 3, 3))
+    angles, valid = calc_angles(points)
+    expected = pr.measure.measure.getAngle(points[:, 0], points[:, 1], points[:, 2], radian=True)
+    assert valid.all()
+    assert np.allclose(angles, expected)
+
+
+def test_numpy_and_torch_agree():
+    points = np.random.RandomState(1).normal(size=(10, 7, 4, 3))
+    np_dihedrals, np_valid = calc_dihedrals(points)
+    t_dihedrals, t_valid = calc_dihedrals(torch.tensor(points))
+    assert t_dihedrals.shape == (10, 7)
+    assert np.allclose(np_dihedrals, t_dihedrals.numpy())
+    assert (np_valid == t_valid.numpy()).all()
+    np_angles, _ = calc_angles(points[..., :3, :])
+    t_angles, _ = calc_angles(torch.tensor(points[..., :3, :]))
+    assert np.allclose(np_angles, t_angles.numpy())
+
+
+@pytest.mark.parametrize("convert", [np.asarray, torch.tensor])
+def test_anomalies_are_flagged(convert):
+    points = np.random.RandomState(2).normal(size=(4, 4, 3))
+    points[1, 3] = np.nan                                # Missing point
+    points[2, 2] = points[2, 1] + (points[2, 1] - points[2, 0])  # Collinear points
+    points[3, 1] = points[3, 0]                          # Coincident points
+    dihedrals, valid = calc_dihedrals(convert(points))
+    assert list(np.asarray(valid)) == [True, False, False, False]
+    assert np.isnan(np.asarray(dihedrals)[1:]).all()
+    points[0, 2] = np.nan
+    angles, valid = calc_angles(convert(points[:, :3]), fill_value=0)
+    assert list(np.asarray(valid)) == [False, True, True, False]
+    assert np.asarray(angles)[[0, 3]].tolist() == [0, 0]
+    assert np.isclose(np.asarray(angles)[2], np.pi)
+
+
+def test_torch_gradients_are_finite_with_anomalies():
+    points = torch.tensor(np.random.RandomState(3).normal(size=(3, 4, 3)), requires_grad=True)
+    with torch.no_grad():
+        points[1, 2] = points[1, 1]
+    dihedrals, valid = calc_dihedrals(points, fill_value=0.)
+    dihedrals.sum().backward()
+    assert torch.isfinite(points.grad).all()
+
+
+def test_angle_round_trip():
+    """ Measuring a structure built from a set of angles should recover those angles. """
+    seq = "ACDEFGHIKLMNPQRSTVWY"
+    rng = np.random.RandomState(4)
+    angles = rng.uniform(-np.pi, np.pi, (len(seq), NUM_PREDICTED_ANGLES))
+    angles[:, 3:6] = rng.uniform(1.9, 2.2, (len(seq), 3))
+    coords = StructureBuilder(seq, torch.tensor(angles, dtype=torch.float32)).build().double()
+    coords = coords.reshape(len(seq), NUM_PREDICTED_COORDS, 3)
+    n, ca, c = coords[:, 0], coords[:, 1], coords[:, 2]
+
+    phi, _ = calc_dihedrals(torch.stack([c[:-1], n[1:], ca[1:], c[1:]], -2))
+    psi, _ = calc_dihedrals(torch.stack([n[:-1], ca[:-1], c[:-1], n[1:]], -2))
+    omega, _ = calc_dihedrals(torch.stack([ca[:-1], c[:-1], n[1:], ca[1:]], -2))
+    ncac, _ = calc_angles(torch.stack([n, ca, c], -2))
+    cacn, _ = calc_angles(torch.stack([ca[:-1], c[:-1], n[1:]], -2))
+    cnca, _ = calc_angles(torch.stack([c[:-1], n[1:], ca[1:]], -2))
+
+    atol = 1e-3
+    assert (angle_diff(phi.numpy(), angles[1:, 0]) < atol).all()
+    assert (angle_diff(psi.numpy(), angles[:-1, 1]) < atol).all()
+    assert (angle_diff(omega.numpy(), angles[:-1, 2]) < atol).all()
+    assert (angle_diff(ncac.numpy(), angles[:, 3]) < atol).all()
+    assert (angle_diff(cacn.numpy(), angles[:-1, 4]) < atol).all()
+    assert (angle_diff(cnca.numpy(), angles[:-1, 5]) < atol).all()
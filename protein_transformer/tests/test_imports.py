@@ -0,0 +1,28 @@
+import subprocess
+import sys
+
+import pytest
+
+# Heavy optional dependencies that should only be imported when they are first used
+HEAVY_MODULES = ["prody", "wandb", "pymol"]
+
+
+def modules_imported_with(module):
+    """ Returns the heavy modules that are imported, in a fresh interpreter, by importing module. """
+    code = (f"import sys, {module}; "
+            f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    completed = subprocess.run([sys.executable, "-c", code], capture_output=True, encoding="utf-8", check=True)
+    return completed.stdout.split()
+
+
+@pytest.mark.parametrize("module", ["protein_transformer.losses",
+                                    "protein_transformer.dataset",
+                                    "protein_transformer.protein.structure_utils",
+                                    "protein_transformer.protein.PDB_Creator",
+                                    "protein_transformer.models.encoder_only"])
+def test_no_heavy_imports(module):
+    assert modules_imported_with(module) == []
+
+
+def test_log_does_not_import_structure_tools():
+    assert modules_imported_with("protein_transformer.log") == ["wandb"]
@@ -0,0 +1,113 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from protein_transformer.inference import (get_windows, predict_windowed, predict_structure_windowed, predict_angles,
+                                           bucket_by_length, export_inference_checkpoint, load_model_from_checkpoint)
+from protein_transformer.models.encoder_only import EncoderOnlyTransformer
+from protein_transformer.protein.Sequence import VOCAB
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, NUM_PREDICTED_COORDS
+from protein_transformer.tests.helpers import make_small_model
+
+
+class PerResidueModel(torch.nn.Module):
+    """ Predicts each residue's angles from its identity alone, so windowing must not change predictions. """
+    def __init__(self):
+        super().__init__()
+        self.embedding = torch.nn.Embedding(len(VOCAB), NUM_PREDICTED_ANGLES * 2)
+
+    def forward(self, enc_input, dec_input=None):
+        return torch.tanh(self.embedding(enc_input))
+
+
+def random_seq(length, seed=0):
+    return torch.tensor(np.random.RandomState(seed).randint(0, 20, length))
+
+
+@pytest.mark.parametrize("length,window,overlap", [(10, 20, 5), (100, 20, 5), (101, 30, 29), (64, 32, 0)])
+def test_get_windows(length, window, overlap):
+    windows = get_windows(length, window, overlap)
+    covered = np.zeros(length, dtype=int)
+    for s, e in windows:
+        assert e - s == min(window, length)
+        covered[s:e] += 1
+    assert (covered > 0).all() and windows[-1][1] == length
+    for (s1, e1), (s2, e2) in zip(windows[:-1], windows[1:]):
+        assert e1 - s2 >= overlap
+
+
+def test_predict_windowed_matches_full_prediction():
+    model = PerResidueModel()
+    seq = random_seq(1000)
+    full = model(seq.unsqueeze(0))[0].detach()
+    assert torch.allclose(predict_windowed(model, seq, window=100, overlap=20), full, atol=1e-6)
+    assert torch.allclose(predict_windowed(model, seq, window=100, overlap=20, batch_size=3), full, atol=1e-6)
+    assert torch.allclose(predict_windowed(model, seq[:50], window=100), full[:50], atol=1e-6)
+
+
+def test_predict_structure_windowed_beyond_max_seq_len():
+    model = EncoderOnlyTransformer(nlayers=1, nhead=2, dmodel=16, dff=32, max_seq_len=64, vocab=VOCAB,
+                                   angle_means=np.random.RandomState(0).uniform(-.9, .9, NUM_PREDICTED_ANGLES * 2),
+                                   use_tanh_out=True)
+    model.eval()
+    seq = random_seq(200)
+    with pytest.raises(RuntimeError):
+        model(seq.unsqueeze(0))  # The positional encoding only covers 64 residues
+    angles, coords = predict_structure_windowed(model, seq)
+    assert angles.shape == (200, NUM_PREDICTED_ANGLES)
+    assert coords.shape == (200 * NUM_PREDICTED_COORDS, 3)
+    assert not torch.isnan(coords[:, 0]).all()
+
+
+def test_predict_angles_matches_single_predictions():
+    model = EncoderOnlyTransformer(nlayers=1, nhead=2, dmodel=16, dff=32, max_seq_len=64, vocab=VOCAB,
+                                   angle_means=np.random.RandomState(0).uniform(-.9, .9, NUM_PREDICTED_ANGLES * 2),
+                                   use_tanh_out=True)
+    model.eval()
+    seqs = [VOCAB.ints2str(random_seq(length, seed=length).numpy()) for length in (5, 64, 30, 150)]
+    angles = predict_angles(model, seqs)
+    assert [a.shape for a in angles] == [(len(s), NUM_PREDICTED_ANGLES) for s in seqs]
+    for seq, ang in zip(seqs, angles):
+        assert np.allclose(predict_angles(model, [seq])[0], ang, atol=1e-5)
+
+
+def test_bucket_by_length():
+    records = [(i, "A" * length) for i, length in enumerate([10, 3, 50, 7, 12, 200])]
+    batches = list(bucket_by_length(records, max_tokens=40, max_batch_size=3, max_len=100))
+    assert sorted(r for b in batches for r in b) == sorted(records)
+    assert [[i for i, _ in b] for b in batches] == [[1, 3, 0], [4], [5], [2]]
+
+
+@pytest.mark.parametrize("model_type", ["enc-only", "conv-enc", "enc-dec"])
+def test_export_inference_checkpoint(tmp_path, model_type):
+    model, args = make_small_model(model_type)
+    model.eval()
+    export_inference_checkpoint(model, args, str(tmp_path))
+    with open(tmp_path / "model.json") as f:
+        tensors = json.load(f)["tensors"]
+    assert all(t["offset"] % 64 == 0 for t in tensors.values())
+    assert os.path.getsize(tmp_path / "weights.bin") == max(t["offset"] + t["nbytes"] for t in tensors.values())
+
+    loaded, loaded_args = load_model_from_checkpoint(str(tmp_path))
+    assert type(loaded) is type(model) and not loaded.training and vars(loaded_args) == vars(args)
+    for (name, a), b in zip(model.state_dict().items(), loaded.state_dict().values()):
+        assert torch.equal(a, b), name
+    seqs = [VOCAB.ints2str(random_seq(length, seed=length).numpy()) for length in (5, 40)]
+    kwargs = {"refine_passes": 2} if model_type == "enc-dec" else {}
+    for a, b in zip(predict_angles(model, seqs, **kwargs), predict_angles(loaded, seqs, **kwargs)):
+        assert np.allclose(a, b)
+
+
+def test_load_inference_checkpoint_checks_vocabulary(tmp_path):
+    model, args = make_small_model()
+    export_inference_checkpoint(model, args, str(tmp_path))
+    with open(tmp_path / "model.json") as f:
+        config = json.load(f)
+    config["vocab"] = config["vocab"][::-1]
+    with open(tmp_path / "model.json", "w") as f:
+        json.dump(config, f)
+    with pytest.raises(ValueError):
+        load_model_from_checkpoint(str(tmp_path))
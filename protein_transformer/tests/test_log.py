@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+
+from protein_transformer.log import MetricAccumulator
+from protein_transformer.protein.Sequence import VOCAB
+
+
+def make_losses(i):
+    return {"loss": torch.tensor(0.1 * i, requires_grad=True) * 1,
+            "drmsd-full": 2.0 * i,
+            "lndrmsd-full": torch.tensor(0.01 * i),
+            "drmsd-bb": 1.0 * i if i % 2 else float("nan"),
+            "lndrmsd-bb": torch.tensor(0.02 * i if i % 2 else float("nan")),
+            "combined-full": torch.tensor(0.5 * i),
+            "mse-full": torch.tensor(0.3 * i, dtype=torch.float64),
+            "mse-bb": torch.tensor(0.2 * i),
+            "mse-sc": torch.tensor(0.4 * i),
+            "rmsd-full": None}
+
+
+def test_metric_accumulator_flush():
+    acc = MetricAccumulator()
+    src_seq = torch.tensor([[0, 1, 2, VOCAB.pad_id], [3, 4, VOCAB.pad_id, VOCAB.pad_id]])
+    for i in range(4):
+        acc.add(make_losses(i), src_seq, lr=0.1 * i, batch_size=2)
+    assert len(acc) == 4
+    # Only running sums are kept, not every batch
+    assert all(v.dim() == 0 for v in list(acc.sums.values()) + list(acc.counts.values()))
+
+    summary = acc.flush()
+    assert len(acc) == 0 and acc.flush() is None
+    assert summary["num-batches"] == 4 and summary["num-res"] == 20 and summary["finite"]
+    assert summary["lr"] == 0.1 * 3 and summary["batch_size"] == 2
+    means = summary["means"]
+    assert means["rmsd-full"] is None
+    for k in ["loss", "drmsd-full", "lndrmsd-full", "combined-full", "mse-full", "mse-bb", "mse-sc"]:
+        assert type(means[k]) is float
+        assert np.isclose(means[k], np.mean([float(make_losses(i)[k]) for i in range(4)]))
+    # Metrics that were not computed for every batch are averaged over the batches that computed them
+    assert np.isclose(means["drmsd-bb"], 2.0) and np.isclose(means["lndrmsd-bb"], 0.04)
+
+
+def test_metric_accumulator_non_finite_loss():
+    acc = MetricAccumulator()
+    src_seq = torch.tensor([[0, 1, 2]])
+    for loss in [1., float("inf"), 2.]:
+        acc.add(dict(make_losses(1), loss=torch.tensor(loss)), src_seq)
+    summary = acc.flush()
+    assert not summary["finite"] and np.isclose(summary["means"]["loss"], 1.5)
+
+    acc.add(make_losses(1), src_seq)
+    assert acc.flush()["finite"]
@@ -226,4 +226,146 @@ def test_drmsd_value_nonsymmetric_distances(a, b):
     mse = ((a_dists - b_dists)**2).mean()
     expected_drmsd = np.sqrt(mse)
 
-    assert drmsd(torch.tensor(a), torch.tensor(b)).item() == approx(expected_drmsd)
\ No newline at end of file
+    assert drmsd(torch.tensor(a), torch.tensor(b)).item() == approx(expected_drmsd)
+
+######### Backbone-only building and dRMSD variants #########
+
+def random_drmsd_inputs(seq="ACDEFGHIKLMNPQRSTVWY", seed=0):
+    rng = np.random.RandomState(seed)
+    ang = rng.uniform(-np.pi, np.pi, (len(seq), NUM_PREDICTED_ANGLES))
+    ang[:, 3:6] = rng.uniform(1.9, 2.2, (len(seq), 3))
+    ang = torch.tensor(ang, dtype=torch.float32)
+    seq_ints = torch.tensor(VOCAB.str2ints(seq, add_sos_eos=False))
+    true_crd = angles_to_coords(ang + 0.1, seq_ints).detach().numpy()
+    return ang.numpy(), true_crd, seq_ints.numpy()
+
+
+def test_backbone_only_build_matches_full_build():
+    ang, _, seq = random_drmsd_inputs()
+    full = angles_to_coords(torch.tensor(ang), torch.tensor(seq))
+    bb = angles_to_coords(torch.tensor(ang), torch.tensor(seq), backbone_only=True)
+    assert full.shape == bb.shape
+    full, bb = full.reshape(-1, NUM_PREDICTED_COORDS, 3), bb.reshape(-1, NUM_PREDICTED_COORDS, 3)
+    assert torch.allclose(full[:, :4], bb[:, :4])
+    assert (bb[:, 4:] == 0).all()
+
+
+def test_drmsd_work_backbone_only_matches_bb_drmsd():
+    ang, crd, seq = random_drmsd_inputs()
+    grad, l, ln, bb_l, bb_ln = drmsd_work(ang, crd, seq, return_rmsd=False, do_backward=True)
+    bb_grad, bbo_l, bbo_ln, bbo_bb_l, bbo_bb_ln = drmsd_work(ang, crd, seq, return_rmsd=False, do_backward=True,
+                                                             backbone_only=True)
+    assert bbo_l == approx(bb_l) and bbo_ln == approx(bb_ln)
+    assert bbo_bb_l == bbo_l and bbo_bb_ln == bbo_ln
+    assert grad.shape == bb_grad.shape
+    assert (bb_grad[:, SC_ANGLES_START_POS:] == 0).all()
+
+
+def test_drmsd_work_variants():
+    ang, crd, seq = random_drmsd_inputs()
+    _, l, ln, bb_l, bb_ln = drmsd_work(ang, crd, seq, return_rmsd=False, do_backward=False)
+    _, v_l, v_ln, v_bb_l, v_bb_ln = drmsd_work(ang, crd, seq, return_rmsd=False, do_backward=False,
+                                               variants=("lndrmsd-bb",))
+    assert np.isnan(v_l) and np.isnan(v_ln)
+    assert v_bb_l == approx(bb_l) and v_bb_ln == approx(bb_ln)
+
+
+def random_batch_drmsd_inputs(batch_size=3):
+    """ Returns a batch of sin/cos angle predictions, true coordinates, and sequences with batch padding. """
+    seqs, crds = [], []
+    lengths = [12, 9, 7][:batch_size]
+    for i, length in enumerate(lengths):
+        ang, crd, seq = random_drmsd_inputs("ACDEFGHIKLMNPQRSTVWY"[i:i + length], seed=i)
+        seqs.append(seq)
+        crds.append(crd)
+    max_len = max(len(s) for s in seqs)
+    seq_batch = torch.tensor([np.pad(s, (0, max_len - len(s)), constant_values=VOCAB.pad_id) for s in seqs])
+    crd_batch = torch.tensor([np.pad(c, ((0, max_len * NUM_PREDICTED_COORDS - len(c)), (0, 0)))
+                              for c in crds])
+    pred = torch.tensor(np.random.RandomState(5).uniform(-1, 1, (len(seqs), max_len, NUM_PREDICTED_ANGLES * 2)),
+                        dtype=torch.float32)
+    return pred, crd_batch, seq_batch
+
+
+def test_deferred_drmsd_backward_matches_immediate_backward():
+    pred, crds, seqs = random_batch_drmsd_inputs()
+
+    pred_a = pred.clone().requires_grad_()
+    _, ln_a, _, _ = compute_batch_drmsd(pred_a, crds, seqs, do_backward=True)
+
+    pred_b = pred.clone().requires_grad_()
+    _, ln_b, _, _ = compute_batch_drmsd(pred_b, crds, seqs, do_backward=True, defer_backward=True)
+    assert pred_b.grad is None
+    assert ln_b.item() == approx(ln_a)
+    ln_b.backward()
+    assert torch.allclose(pred_b.grad * pred.shape[0], pred_a.grad, atol=1e-6)
+
+
+def test_compute_batch_drmsd_variants():
+    pred, crds, seqs = random_batch_drmsd_inputs()
+    l, ln, bb_l, bb_ln = compute_batch_drmsd(pred, crds, seqs)
+    v_l, v_ln, v_bb_l, v_bb_ln = compute_batch_drmsd(pred, crds, seqs, variants=("drmsd-full", "lndrmsd-full"))
+    assert v_l == approx(l) and v_ln == approx(ln)
+    assert np.isnan(v_bb_l) and np.isnan(v_bb_ln)
+
+
+def test_compute_batch_drmsd_timings():
+    pred, crds, seqs = random_batch_drmsd_inputs()
+    pred = pred.requires_grad_()
+    _, ln, _, _ = compute_batch_drmsd(pred, crds, seqs, do_backward=True)
+    grad, pred.grad = pred.grad, None
+
+    timings = {}
+    _, ln_timed, _, _ = compute_batch_drmsd(pred, crds, seqs, do_backward=True, timings=timings)
+    assert ln_timed == approx(ln)
+    assert torch.allclose(pred.grad, grad)
+    assert set(timings) == {"drmsd", "drmsd-queue", "drmsd-build", "drmsd-backward", "backward"}
+    assert all(v >= 0 for v in timings.values())
+    assert timings["drmsd-build"] + timings["drmsd-backward"] <= timings["drmsd"]
+
+    timings = {}
+    compute_batch_drmsd(pred, crds, seqs, do_backward=True, defer_backward=True, timings=timings)
+    assert "drmsd" in timings and "backward" not in timings
+
+def test_combined_loss_single_backward_weighting():
+    pred, crds, seqs = random_batch_drmsd_inputs()
+    tgt_ang = torch.tensor(np.random.RandomState(6).uniform(-1, 1, pred.shape), dtype=torch.float32)
+    w = 0.3
+
+    pred_a = pred.clone().requires_grad_()
+    compute_batch_drmsd(pred_a, crds, seqs, do_backward=True)
+    drmsd_grad = pred_a.grad / pred.shape[0]
+    pred_a.grad = None
+    mse_over_angles(pred_a, tgt_ang).backward()
+    expected = combine_drmsd_mse(drmsd_grad, pred_a.grad, w=w, log=False)
+
+    pred_b = pred.clone().requires_grad_()
+    _, ln_b, _, _ = compute_batch_drmsd(pred_b, crds, seqs, do_backward=True, defer_backward=True)
+    combine_drmsd_mse(ln_b, mse_over_angles(pred_b, tgt_ang), w=w, log=False).backward()
+    assert torch.allclose(pred_b.grad, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("n_angles", [NUM_PREDICTED_ANGLES, NUM_PREDICTED_ANGLES * 2])
+def test_mse_over_angles_fused(n_angles):
+    rng = np.random.RandomState(7)
+    pred = torch.tensor(rng.uniform(-1, 1, (4, 10, n_angles)), requires_grad=True)
+    true = torch.tensor(rng.uniform(-1, 1, (4, 10, n_angles)))
+    true[rng.uniform(size=true.shape) < .2] = np.nan  # Missing angles
+    true[2, 3] = np.nan
+    true[1, 6:] = 0                                    # Batch padding
+
+    full, bb, sc, per_angle = mse_over_angles_fused(pred, true)
+    assert full.item() == approx(mse_over_angles(pred, true).item())
+    assert bb.item() == approx(mse_over_angles(pred, true, bb_only=True).item())
+    assert sc.item() == approx(mse_over_angles(pred, true, sc_only=True).item())
+    assert per_angle.shape == (NUM_PREDICTED_ANGLES,)
+    step = n_angles // NUM_PREDICTED_ANGLES
+    for i in range(NUM_PREDICTED_ANGLES):
+        assert per_angle[i].item() == approx(mse_over_angles(pred[..., i*step:(i+1)*step],
+                                                             true[..., i*step:(i+1)*step]).item())
+
+    full.backward()
+    grad = pred.grad.clone()
+    pred.grad = None
+    mse_over_angles(pred, true).backward()
+    assert torch.allclose(grad, pred.grad)
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import torch
+
+from protein_transformer.models.encoder_only import EncoderOnlyTransformer
+from protein_transformer.prediction_cache import PredictionCache, model_digest
+from protein_transformer.protein.PDB_Creator import PDB_Creator
+from protein_transformer.protein.Sequence import VOCAB
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, NUM_PREDICTED_COORDS
+
+
+def make_model(seed=0):
+    torch.manual_seed(seed)
+    return EncoderOnlyTransformer(nlayers=1, nhead=2, dmodel=16, dff=32, max_seq_len=64, vocab=VOCAB,
+                                  angle_means=np.zeros(NUM_PREDICTED_ANGLES * 2), use_tanh_out=True)
+
+
+def random_prediction(length, seed=0):
+    rng = np.random.RandomState(seed)
+    return (rng.uniform(-np.pi, np.pi, (length, NUM_PREDICTED_ANGLES)).astype(np.float32),
+            rng.normal(size=(length * NUM_PREDICTED_COORDS, 3)).astype(np.float32))
+
+
+def test_model_digest():
+    model = make_model()
+    assert model_digest(model) == model_digest(make_model())
+    assert model_digest(model) != model_digest(make_model(seed=1))
+    assert model_digest(model, refine_passes=None) != model_digest(model, refine_passes=4)
+
+
+def test_put_and_get(tmp_path):
+    cache = PredictionCache(str(tmp_path), "model", store_pdb=True)
+    angles, coords = random_prediction(10)
+    assert cache.get("MKVAAAAAAA") is None
+    cache.put("MKVAAAAAAA", angles, coords, pdb="REMARK  first\nATOM ...")
+    entry = cache.get("MKVAAAAAAA", title="second")
+    assert np.array_equal(entry["angles"], angles) and np.array_equal(entry["coords"], coords)
+    assert entry["pdb"] == "REMARK  second\nATOM ..."
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+    # Entries are specific to a model, and persist across instances
+    assert PredictionCache(str(tmp_path), "other model").get("MKVAAAAAAA") is None
+    entry = PredictionCache(str(tmp_path), "model").get("MKVAAAAAAA")
+    assert np.array_equal(entry["angles"], angles)
+
+
+def test_multiline_titles(tmp_path):
+    cache = PredictionCache(str(tmp_path), "model", store_pdb=True)
+    angles, coords = random_prediction(3)
+    cache.put("MKV", angles, coords, pdb=PDB_Creator(coords, "MKV").get_pdb_string("first\nline"))
+    pdb = cache.get("MKV", title="second\r\nline")["pdb"]
+    assert pdb == PDB_Creator(coords, "MKV").get_pdb_string("second line")
+    assert pdb.startswith("REMARK  second line\nATOM")
+
+
+def test_pdb_is_optional(tmp_path):
+    cache = PredictionCache(str(tmp_path), "model")
+    angles, coords = random_prediction(10)
+    cache.put("MKVAAAAAAA", angles, pdb="REMARK  first\nATOM ...")
+    assert set(cache.get("MKVAAAAAAA")) == {"angles"}
+
+
+def test_lru_eviction(tmp_path):
+    cache = PredictionCache(str(tmp_path), "model", max_bytes=10 ** 9)
+    seqs = ["A" * 20 + aa for aa in "CDEFG"]
+    for i, seq in enumerate(seqs):
+        cache.put(seq, *random_prediction(len(seq), i))
+    entry_bytes = cache.stats()["bytes"] / len(seqs)
+    cache.get(seqs[0])  # Now the most recently used
+    cache.max_bytes = 3.5 * entry_bytes
+    cache.put("A" * 20 + "H", *random_prediction(len(seqs[0]), 5))
+    assert cache.stats()["entries"] == 3 and cache.stats()["bytes"] <= cache.max_bytes
+    assert [cache.get(s) is not None for s in seqs] == [True, False, False, False, True]
+
+    # The index is rebuilt from disk in least recently used order
+    reopened = PredictionCache(str(tmp_path), "model", max_bytes=cache.max_bytes)
+    assert reopened.stats()["entries"] == 3
+    assert sum(len(files) for _, _, files in os.walk(tmp_path)) == 3
+
+
+def test_corrupt_entries_are_misses(tmp_path):
+    cache = PredictionCache(str(tmp_path), "model")
+    cache.put("MKV", *random_prediction(3))
+    path = cache._cache_path("MKV")
+    with open(path, "wb") as f:
+        f.write(b"not an npz file")
+    assert cache.get("MKV") is None and not os.path.exists(path)
+    assert cache.stats()["entries"] == 0 and cache.stats()["bytes"] == 0
@@ -0,0 +1,63 @@
+import csv
+import json
+import os
+import time
+
+import pytest
+
+from protein_transformer.profiling import StepProfiler
+
+
+def test_step_profiler_records_stages(tmp_path):
+    profiler = StepProfiler(enabled=True, out_dir=str(tmp_path), name="run")
+    profiler.reset_data_wait()
+    for step in range(3):
+        time.sleep(0.002)
+        profiler.start_step(num_res=10)
+        with profiler.stage("forward"):
+            time.sleep(0.002)
+        with profiler.stage("forward"):
+            pass
+        profiler.record("drmsd-build", 0.5)
+        profiler.end_step()
+
+    summary = profiler.save()
+    assert summary["num_steps"] == 3
+    assert list(summary["stages"]) == ["data-wait", "forward", "drmsd-build", "step-total"]
+    assert summary["stages"]["drmsd-build"]["total"] == pytest.approx(1.5)
+    assert summary["stages"]["forward"]["mean"] >= 0.002
+    assert summary["stages"]["data-wait"]["mean"] >= 0.002
+    assert summary["stages"]["step-total"]["fraction"] == pytest.approx(1)
+    assert summary["res_per_sec"] > 0
+
+    with open(os.path.join(tmp_path, "run.summary.json")) as f:
+        assert json.load(f) == summary
+    with open(os.path.join(tmp_path, "run.steps.csv")) as f:
+        rows = list(csv.DictReader(f))
+    assert [int(r["step"]) for r in rows] == [0, 1, 2]
+    assert float(rows[1]["drmsd-build"]) == pytest.approx(0.5)
+
+
+def test_step_profiler_disabled(tmp_path):
+    profiler = StepProfiler(enabled=False, out_dir=str(tmp_path))
+    profiler.start_step()
+    with profiler.stage("forward"):
+        pass
+    profiler.record("backward", 1.)
+    profiler.end_step()
+    assert profiler.steps == []
+    assert profiler.save() is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_step_profiler_chrome_trace(tmp_path):
+    import torch
+    profiler = StepProfiler(enabled=True, out_dir=str(tmp_path), name="run", trace_steps=(1, 2))
+    for step in range(4):
+        profiler.start_step()
+        with profiler.stage("forward"):
+            torch.ones(8, 8) @ torch.ones(8, 8)
+        profiler.end_step()
+    assert os.listdir(tmp_path) == ["run.steps1-2.trace.json"]
+    with open(os.path.join(tmp_path, "run.steps1-2.trace.json")) as f:
+        assert "forward" in f.read()
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import torch
+
+from protein_transformer.protein.Sequence import ProteinVocabulary, VOCAB
+
+
+def reference_str2ints(vocab, seq, add_sos_eos=True):
+    ints = [vocab[aa] for aa in seq]
+    return [vocab["<"]] + ints + [vocab[">"]] if add_sos_eos else ints
+
+
+def reference_ints2str(vocab, ints, include_sos_eos=False):
+    chars = [vocab.int2char(int(i)) for i in ints]
+    return "".join(c for c in chars if include_sos_eos or c not in [vocab.sos_char, vocab.eos_char, vocab.pad_char])
+
+
+@pytest.mark.parametrize("vocab", [VOCAB, ProteinVocabulary(add_sos_eos=True)])
+@pytest.mark.parametrize("add_sos_eos", [True, False])
+def test_encode_decode_match_reference(vocab, add_sos_eos):
+    seqs = ["ACDEFGHIKLMNPQRSTVWY", "XBZ?", "", "MKV_"]
+    for seq in seqs:
+        assert vocab.str2ints(seq, add_sos_eos) == reference_str2ints(vocab, seq, add_sos_eos)
+        ints = reference_str2ints(vocab, seq, add_sos_eos)
+        for include in [True, False]:
+            assert vocab.ints2str(ints, include) == reference_ints2str(vocab, ints, include)
+            assert vocab.ints2str(torch.tensor(ints, dtype=torch.long), include) == \
+                reference_ints2str(vocab, ints, include)
+
+
+@pytest.mark.parametrize("vocab", [VOCAB, ProteinVocabulary(add_sos_eos=True)])
+def test_encode_batch(vocab):
+    seqs = ["ACD", "MKVLAG", "W"]
+    batch = vocab.encode_batch(seqs)
+    assert batch.shape == (3, 8) and batch.dtype == np.int64
+    for row, seq in zip(batch, seqs):
+        expected = reference_str2ints(vocab, seq)
+        assert list(row[:len(expected)]) == expected
+        assert (row[len(expected):] == vocab.pad_id).all()
+
+    unpadded = vocab.encode_batch(seqs, add_sos_eos=False, padded=False, dtype=np.int8)
+    assert [list(s) for s in unpadded] == [reference_str2ints(vocab, s, False) for s in seqs]
+    assert all(s.dtype == np.int8 for s in unpadded)
+    assert vocab.encode_batch([]).shape == (0, 2)
+
+
+def test_decode_batch():
+    seqs = ["ACD", "MKVLAG", "W"]
+    padded = VOCAB.encode_batch(seqs, add_sos_eos=False)
+    assert VOCAB.decode_batch(torch.tensor(padded)) == seqs
+    assert VOCAB.decode_batch(padded, include_sos_eos=True)[0] == "ACD___"
+    assert VOCAB.decode_batch([VOCAB.str2ints(s, False) for s in seqs]) == seqs
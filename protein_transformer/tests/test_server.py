@@ -0,0 +1,129 @@
+import asyncio
+import http.client
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+
+from protein_transformer.inference import predict_angles
+from protein_transformer.models.encoder_only import EncoderOnlyTransformer
+from protein_transformer.protein.Sequence import VOCAB
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, NUM_PREDICTED_COORDS
+from protein_transformer.prediction_cache import PredictionCache
+from protein_transformer.server import DynamicBatcher, PredictionServer
+
+
+def random_seq(length, seed=0):
+    return "".join(np.random.RandomState(seed).choice(list(VOCAB.stdaas), length))
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    model = EncoderOnlyTransformer(nlayers=1, nhead=2, dmodel=16, dff=32, max_seq_len=64, vocab=VOCAB,
+                                   angle_means=np.random.RandomState(0).uniform(-.9, .9, NUM_PREDICTED_ANGLES * 2),
+                                   use_tanh_out=True)
+    model.eval()
+    return model
+
+
+@pytest.fixture(params=[False, True], ids=["no_cache", "cache"])
+def server(model, tmp_path, request):
+    """ Runs a PredictionServer on a background event loop and yields it with its port. """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    cache = PredictionCache(str(tmp_path), "model", store_pdb=True) if request.param else None
+    server = PredictionServer(model, max_batch_tokens=4096, max_wait_ms=200, cache=cache)
+    port = asyncio.run_coroutine_threadsafe(server.start("127.0.0.1", 0), loop).result().sockets[0].getsockname()[1]
+    yield server, port
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def request(port, method, path, payload=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    conn.request(method, path, body=json.dumps(payload) if payload is not None else None)
+    response = conn.getresponse()
+    result = response.status, json.loads(response.read())
+    conn.close()
+    return result
+
+
+def test_predict_outputs(server, model):
+    srv, port = server
+    seq = random_seq(20)
+    status, result = request(port, "POST", "/predict", {"sequence": seq, "id": "P1"})
+    assert status == 200 and result["id"] == "P1"
+    assert np.allclose(result["angles"], predict_angles(model, [seq])[0], atol=1e-5)
+
+    status, result = request(port, "POST", "/predict", {"sequence": seq, "output": "coords"})
+    assert status == 200 and np.array(result["coords"]).shape == (20 * NUM_PREDICTED_COORDS, 3)
+
+    status, result = request(port, "POST", "/predict", {"sequence": seq, "output": "pdb", "id": "P1"})
+    assert status == 200 and result["pdb"].count("ATOM") > 20 * 4
+
+    status, repeated = request(port, "POST", "/predict", {"sequence": seq, "output": "pdb", "id": "P2"})
+    assert repeated["pdb"].split("\n", 1)[1] == result["pdb"].split("\n", 1)[1]
+    num_predictions = request(port, "GET", "/metrics")[1]["num_predictions"]
+    if srv.cache is not None:
+        assert repeated["pdb"].startswith("REMARK  P2")
+        assert num_predictions == 1 and srv.cache.stats()["hits"] == 3
+    else:
+        assert num_predictions == 4
+
+    # Identifiers are always written as a one-line header
+    status, multiline = request(port, "POST", "/predict", {"sequence": seq, "output": "pdb", "id": "P3\nATOM"})
+    assert status == 200 and multiline["pdb"].startswith("REMARK  P3 ATOM\n")
+    assert multiline["pdb"].split("\n", 1)[1] == result["pdb"].split("\n", 1)[1]
+
+
+def test_concurrent_requests_are_batched(server, model):
+    _, port = server
+    seqs = [random_seq(length, seed) for seed, length in enumerate([5, 40, 12, 64, 100, 33, 8, 20])]
+    with ThreadPoolExecutor(len(seqs)) as executor:
+        responses = list(executor.map(lambda s: request(port, "POST", "/predict", {"sequence": s}), seqs))
+    for seq, (status, result) in zip(seqs, responses):
+        assert status == 200
+        assert np.allclose(result["angles"], predict_angles(model, [seq])[0], atol=1e-5)
+
+    status, metrics = request(port, "GET", "/metrics")
+    assert status == 200
+    assert metrics["num_predictions"] == len(seqs) and metrics["num_batches"] < len(seqs)
+    assert metrics["responses"] == {"200": len(seqs)} and metrics["latency_ms"]["p99"] > 0
+
+
+def test_invalid_requests(server):
+    _, port = server
+    assert request(port, "GET", "/health")[1]["status"] == "ok"
+    assert request(port, "POST", "/predict", {"sequence": "MKVX"})[0] == 400
+    assert request(port, "POST", "/predict", {"sequence": "MKV", "output": "mmcif"})[0] == 400
+    assert request(port, "POST", "/predict", ["MKV"])[0] == 400
+    assert request(port, "GET", "/predict")[0] == 405
+    assert request(port, "GET", "/nothing")[0] == 404
+
+
+def test_dynamic_batcher_deadline():
+    batches = []
+
+    def predict_fn(seqs):
+        batches.append(seqs)
+        return [len(s) for s in seqs]
+
+    async def run():
+        batcher = DynamicBatcher(predict_fn, max_batch_tokens=100, max_batch_size=4, max_wait_ms=50)
+        task = asyncio.create_task(batcher.run())
+        first = await asyncio.gather(*[batcher.predict("A" * n) for n in (3, 40, 5)])
+        second = await asyncio.gather(*[batcher.predict("A" * n) for n in range(1, 7)])
+        task.cancel()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == [3, 40, 5] and second == list(range(1, 7))
+    assert batches[0] == ["A" * 3, "A" * 5] and batches[1] == ["A" * 40]  # Bucketed by length
+    assert [len(b) for b in batches[2:]] == [4, 2]  # Capped at max_batch_size
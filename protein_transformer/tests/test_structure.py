@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import torch
+
+from protein_transformer.protein.geometry import calc_angles, calc_dihedrals
+from protein_transformer.protein.Structure import NeRF, nerf
+
+
+def nerf_reference(a, b, c, l, theta, chi):
+    """ The original, unfused implementation of NeRF for a single atom. """
+    W_hat = torch.nn.functional.normalize(b - a, dim=0)
+    x_hat = torch.nn.functional.normalize(c - b, dim=0)
+    n_unit = torch.linalg.cross(W_hat, x_hat)
+    z_hat = torch.nn.functional.normalize(n_unit, dim=0)
+    y_hat = torch.linalg.cross(z_hat, x_hat)
+    M = torch.stack([x_hat, y_hat, z_hat], dim=1)
+    d = torch.stack([-l * torch.cos(theta), l * torch.sin(theta) * torch.cos(chi),
+                     l * torch.sin(theta) * torch.sin(chi)])
+    return c + torch.mm(M, d.unsqueeze(1)).squeeze()
+
+
+def random_nerf_inputs(batch_shape=(), seed=0):
+    rng = np.random.RandomState(seed)
+    a, b, c = (torch.tensor(rng.normal(size=batch_shape + (3,)), requires_grad=True) for _ in range(3))
+    l = torch.tensor(rng.uniform(1, 2, batch_shape), requires_grad=True)
+    theta = torch.tensor(rng.uniform(1.5, 2.5, batch_shape), requires_grad=True)
+    chi = torch.tensor(rng.uniform(-np.pi, np.pi, batch_shape), requires_grad=True)
+    return a, b, c, l, theta, chi
+
+
+def test_nerf_matches_reference():
+    inputs = random_nerf_inputs()
+    d = nerf(*inputs)
+    d_ref = nerf_reference(*inputs)
+    assert torch.allclose(d, d_ref)
+    grads = torch.autograd.grad(d.sum(), inputs)
+    ref_grads = torch.autograd.grad(d_ref.sum(), inputs)
+    for g, g_ref in zip(grads, ref_grads):
+        assert torch.allclose(g, g_ref)
+
+
+def test_nerf_places_atom_with_requested_geometry():
+    a, b, c, l, theta, chi = (t.detach() for t in random_nerf_inputs((50,)))
+    d = nerf(a, b, c, l, theta, chi)
+    assert torch.allclose(torch.linalg.norm(d - c, dim=-1), l)
+    assert torch.allclose(calc_angles(torch.stack([b, c, d], -2))[0], theta)
+    assert torch.allclose(calc_dihedrals(torch.stack([a, b, c, d], -2))[0], chi)
+
+
+@pytest.mark.parametrize("batch_shape", [(), (5,), (2, 3)])
+def test_nerf_gradcheck(batch_shape):
+    assert torch.autograd.gradcheck(NeRF.apply, random_nerf_inputs(batch_shape))
+
+
+def test_nerf_gradcheck_broadcast_scalars():
+    a, b, c, _, _, _ = random_nerf_inputs((4,))
+    l, theta, chi = (torch.tensor(v, dtype=torch.float64, requires_grad=True) for v in (1.5, 2.0, -1.0))
+    assert torch.autograd.gradcheck(NeRF.apply, (a, b, c, l, theta, chi))
+
+
+def test_nerf_accepts_python_scalars():
+    a, b, c = (torch.randn(3) for _ in range(3))
+    d = nerf(a, b, c, 1.5, 2.0, torch.tensor(0.5))
+    assert d.shape == (3,) and d.dtype == torch.float32
@@ -0,0 +1,59 @@
+import numpy as np
+import prody as pr
+import pytest
+import torch
+
+from protein_transformer.protein.Sequence import ONE_TO_THREE_LETTER_MAP
+from protein_transformer.protein.SidechainBuildInfo import SC_BUILD_INFO
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, NUM_PREDICTED_COORDS
+from protein_transformer.protein.StructureBuilder import StructureBuilder
+from protein_transformer.protein.structure_utils import get_seq_and_masked_coords_and_angles
+
+
+def make_chain(seq, seed=0, skip_residues=(), skip_atoms=()):
+    """
+    Builds a ProDy AtomGroup for seq from random angles. Residues whose
+    indices are in skip_residues are left out of the structure, as are the
+    (residue index, atom name) pairs in skip_atoms.
+    """
+    rng = np.random.RandomState(seed)
+    angles = rng.uniform(-np.pi, np.pi, (len(seq), NUM_PREDICTED_ANGLES))
+    angles[:, 3:6] = rng.uniform(1.9, 2.2, (len(seq), 3))
+    coords = StructureBuilder(seq, torch.tensor(angles, dtype=torch.float32)).build().numpy().astype(np.float64)
+    coords = coords.reshape(len(seq), NUM_PREDICTED_COORDS, 3)
+
+    crds, names, resnames, resnums = [], [], [], []
+    for i, aa in enumerate(seq):
+        if i in skip_residues:
+            continue
+        resname = ONE_TO_THREE_LETTER_MAP[aa]
+        for j, an in enumerate(["N", "CA", "C", "O"] + SC_BUILD_INFO[resname]["atom-names"]):
+            if (i, an) in skip_atoms:
+                continue
+            crds.append(coords[i, j])
+            names.append(an)
+            resnames.append(resname)
+            resnums.append(i + 1)
+    chain = pr.AtomGroup("test")
+    chain.setCoords(np.asarray(crds))
+    chain.setNames(names)
+    chain.setResnames(resnames)
+    chain.setResnums(resnums)
+    chain.setChids(["A"] * len(names))
+    return chain
+
+
+@pytest.mark.parametrize("seq, skip_residues, skip_atoms", [
+    ("ACDEFGHIKLMNPQRSTVWY", (), ()),
+    ("ACDEFGHIKLMNPQRSTVWY", (8, 9), ()),
+    ("ACDEFGHIKLMNPQRSTVWY", (), ((0, "CB"), (4, "CD1"), (11, "N"), (12, "CA"))),
+    ("WYGGRKEPHSAMLQ", (5,), ((1, "C"), (2, "N"), (13, "O"))),
+])
+def test_vectorized_extraction_matches_per_residue(seq, skip_residues, skip_atoms):
+    chain = make_chain(seq, skip_residues=skip_residues, skip_atoms=skip_atoms)
+    ang, crd, true_seq = get_seq_and_masked_coords_and_angles(chain, seq, vectorized=False)
+    vang, vcrd, vtrue_seq = get_seq_and_masked_coords_and_angles(chain, seq, vectorized=True)
+    assert vtrue_seq == true_seq
+    assert vang.shape == ang.shape and vcrd.shape == crd.shape
+    assert np.allclose(vang, ang, atol=1e-6, equal_nan=True)
+    assert np.allclose(vcrd, crd, equal_nan=True)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import torch
+
+from protein_transformer.models.transformer.Transformer import Transformer
+from protein_transformer.protein.Sequence import VOCAB
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES
+
+MISSING_COORD_FILLER = 0
+
+
+def make_transformer(fraction_subseq_tf, scheduled_sampling="parallel"):
+    torch.manual_seed(0)
+    model = Transformer(dm=16, dff=32, din=len(VOCAB), dout=NUM_PREDICTED_ANGLES * 2, n_heads=2, n_enc_layers=1,
+                        n_dec_layers=1, max_seq_len=50, pad_char=VOCAB.pad_id,
+                        missing_coord_filler=MISSING_COORD_FILLER, device=torch.device("cpu"), dropout=0,
+                        fraction_complete_tf=0, fraction_subseq_tf=fraction_subseq_tf,
+                        angle_means=np.zeros(NUM_PREDICTED_ANGLES * 2), scheduled_sampling=scheduled_sampling)
+    torch.nn.init.normal_(model.output_projection.weight)
+    return model
+
+
+def make_batch(length=20):
+    enc_input = torch.randint(0, 20, (2, length))
+    dec_input = torch.rand(2, length, NUM_PREDICTED_ANGLES * 2) * 2 - 1
+    return enc_input, dec_input
+
+
+def count_decoder_calls(model):
+    calls = []
+    model.decoder.register_forward_hook(lambda *args: calls.append(1))
+    return calls
+
+
+@pytest.mark.parametrize("fraction_subseq_tf", [0, 0.5])
+def test_parallel_scheduled_sampling_runs_decoder_twice(fraction_subseq_tf):
+    model = make_transformer(fraction_subseq_tf)
+    calls = count_decoder_calls(model)
+    enc_input, dec_input = make_batch()
+    out = model(enc_input, dec_input)
+    assert out.shape == dec_input.shape and len(calls) == 2
+    out.sum().backward()
+    assert model.output_projection.weight.grad is not None
+
+
+def test_parallel_scheduled_sampling_feeds_first_pass_predictions():
+    model = make_transformer(fraction_subseq_tf=0)
+    model.eval()
+    enc_input, dec_input = make_batch()
+    out = model(enc_input, dec_input.clone())
+
+    # With fraction_subseq_tf = 0, the second pass decodes the teacher forced predictions, shifted by one position
+    shifted = torch.cat([torch.full_like(dec_input[:, :1], model.decoder_sos_char), dec_input[:, :-1]], dim=1)
+    first_pass = model.forward_tf(enc_input, shifted)
+    mixed = torch.cat([shifted[:, :1], first_pass[:, :-1]], dim=1)
+    assert torch.allclose(out, model.forward_tf(enc_input, mixed), atol=1e-6)
+
+
+def test_predict_refine():
+    model = make_transformer(fraction_subseq_tf=1)
+    model.eval()
+    calls = count_decoder_calls(model)
+    enc_input, _ = make_batch()
+    enc_input[1, 15:] = VOCAB.pad_id
+    with torch.no_grad():
+        preds = model.predict(enc_input, refine_passes=3)
+    assert preds.shape == (2, 20, NUM_PREDICTED_ANGLES * 2) and len(calls) == 3
+    assert [h["pass"] for h in model.refine_history] == [1, 2, 3]
+
+    # The first pass decodes the angle means; each later pass decodes the previous pass's predictions
+    valid = enc_input != VOCAB.pad_id
+    with torch.no_grad():
+        means = torch.tensor(model.angle_means, dtype=torch.float32).expand(2, 20, -1)
+        sos = torch.full_like(means[:, :1], model.decoder_sos_char)
+        expected = model.forward_tf(enc_input, torch.cat([sos, means[:, :-1]], dim=1))
+        assert torch.allclose(model.predict_refine(enc_input, n_passes=1)[valid], expected[valid], atol=1e-6)
+        second = model.forward_tf(enc_input, torch.cat([sos, expected[:, :-1]], dim=1))
+        assert torch.allclose(model.predict_refine(enc_input, n_passes=2)[valid], second[valid], atol=1e-6)
+
+        # Decoding stops once the predictions no longer change
+        model.predict_refine(enc_input, n_passes=50, tol=float("inf"))
+        assert len(model.refine_history) == 1
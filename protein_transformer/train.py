@@ -17,60 +17,99 @@ from tqdm import tqdm
 
 from protein_transformer.dataset import prepare_dataloaders, MAX_SEQ_LEN
 from protein_transformer.log import *
-from protein_transformer.losses import compute_batch_drmsd, mse_over_angles, combine_drmsd_mse
+from protein_transformer.losses import compute_batch_drmsd, mse_over_angles_fused, combine_drmsd_mse, DRMSD_VARIANTS
 from protein_transformer.models.convolutional_encoder import ConvEncoderOnlyTransformer
 from protein_transformer.models.encoder_only import EncoderOnlyTransformer
 from protein_transformer.models.transformer.Optimizer import ScheduledOptim
 from protein_transformer.models.transformer.Transformer import Transformer
+from protein_transformer.profiling import StepProfiler
 from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES
 
+MISSING_COORD_FILLER = 0  # Used when teacher forcing with an encoder/decoder model
 
-def train_epoch(model, training_data, validation_datasets, optimizer, device, args, log_writer, metrics, pool=None):
+
+def train_epoch(model, training_data, validation_datasets, optimizer, device, args, log_writer, metrics, pool=None,
+                profiler=None):
     """
-    One complete training epoch.
+    One complete training epoch. If a StepProfiler is provided, the time spent
+    in each stage of every step is recorded with it.
     """
+    if profiler is None:
+        profiler = StepProfiler(enabled=False)
     model.train()
     metrics = reset_metrics_for_epoch(metrics, "train")
+    accumulator = MetricAccumulator()
     batch_iter = tqdm(training_data, leave=False, unit="batch", dynamic_ncols=True)
+    profiler.reset_data_wait()
     for step, batch in enumerate(batch_iter):
+        profiler.start_step(num_res=(batch[0] != VOCAB.pad_id).sum() if profiler.enabled else None)
         optimizer.zero_grad()
-        src_seq, tgt_ang, tgt_crds = map(lambda x: x.to(device), batch)
-        pred = model(src_seq, tgt_ang)
-        losses = get_losses(args, pred, tgt_ang, tgt_crds, src_seq, pool=pool)
+        with profiler.stage("to-device"):
+            src_seq, tgt_ang, tgt_crds = map(lambda x: x.to(device), batch)
+        with profiler.stage("forward"):
+            pred = model(src_seq, tgt_ang)
+        losses = get_losses(args, pred, tgt_ang, tgt_crds, src_seq, pool=pool, profiler=profiler,
+                            variants=get_train_drmsd_variants(args, step))
 
-        # Clip gradients
-        if args.clip:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+        with profiler.stage("optimizer"):
+            # Clip gradients
+            if args.clip:
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
 
-        # Update parameters
-        optimizer.step()
+            # Update parameters
+            optimizer.step()
 
         # Record performance metrics
-        metrics = do_train_batch_logging(metrics, losses, src_seq, optimizer, args, log_writer, batch_iter, START_TIME,
-                                         pred, tgt_crds, step, validation_datasets, model, device)
+        with profiler.stage("logging"):
+            metrics = do_train_batch_logging(metrics, losses, src_seq, optimizer, args, log_writer, batch_iter,
+                                             START_TIME, pred, tgt_crds, step, validation_datasets, model, device,
+                                             accumulator)
+        profiler.end_step()
 
+    metrics = flush_train_batch_logging(metrics, accumulator, args, log_writer, batch_iter, START_TIME)
     metrics = update_metrics_end_of_epoch(metrics, "train")
 
     return metrics
 
 
-def get_losses(args, pred, tgt_ang, tgt_crds, src_seq, pool=None, log=True, do_backwards=True, return_rmsd=False, eval_mode=False):
+def get_train_drmsd_variants(args, step):
+    """
+    Returns the dRMSD variants (see losses.drmsd_work) needed at a training
+    step. The full dRMSDs are always needed for the loss and progress bar,
+    but the backbone dRMSDs are only reported on steps logged to wandb.
+    """
+    if not step or step % args.log_wandb_step == 0:
+        return DRMSD_VARIANTS
+    return "drmsd-full", "lndrmsd-full"
+
+
+def get_losses(args, pred, tgt_ang, tgt_crds, src_seq, pool=None, log=True, do_backwards=True, return_rmsd=False,
+               eval_mode=False, profiler=None, variants=DRMSD_VARIANTS):
     """
     Returns the computed losses/metrics for a batch. The variable 'loss'
-    will differ depending on the loss the user requested to train on.
+    will differ depending on the loss the user requested to train on. If a
+    StepProfiler is provided, the time spent computing each loss and
+    backpropagating is recorded with it. Only the dRMSD variants listed in
+    variants are computed; the others are reported as NaN.
     """
+    if profiler is None:
+        profiler = StepProfiler(enabled=False)
     # TODO remove outdated reference to loss
     # Always compute MSE loss b/c it's computationally cheap.
-    m_loss_full = mse_over_angles(pred, tgt_ang)
-    m_loss_bb = mse_over_angles(pred, tgt_ang, bb_only=True)
-    m_loss_sc = mse_over_angles(pred, tgt_ang, sc_only=True)
+    with profiler.stage("mse"):
+        m_loss_full, m_loss_bb, m_loss_sc, m_loss_per_angle = mse_over_angles_fused(pred, tgt_ang)
 
 
     if args.loss in ["lndrmsd", "drmsd", "combined"] or eval_mode:
+        # For the combined loss, dRMSD gradients are merged with the MSE term and backpropagated once, below
+        # The dRMSD computation and any backward pass through the model are timed separately within
+        drmsd_timings = {} if profiler.enabled else None
         ls = compute_batch_drmsd(pred, tgt_crds, src_seq, do_backward=do_backwards,
-                                 retain_graph=args.loss == "combined", pool=pool,
-                                 backbone_only=args.backbone_loss,
-                                 return_rmsd=return_rmsd)
+                                 defer_backward=args.loss == "combined", pool=pool,
+                                 backbone_only=args.backbone_loss, variants=variants,
+                                 return_rmsd=return_rmsd, timings=drmsd_timings)
+        if drmsd_timings:
+            profiler.record_many(drmsd_timings)
         if return_rmsd:
             d_loss, ln_d_loss, d_bb_loss, d_bb_ln_loss, rmsd_loss = ls
         else:
@@ -83,7 +122,8 @@ def get_losses(args, pred, tgt_ang, tgt_crds, src_seq, pool=None, log=True, do_b
         elif args.loss == "combined":
             loss = c_loss
             if do_backwards:
-                c_loss.backward()
+                with profiler.stage("backward"):
+                    c_loss.backward()
         elif args.loss == "mse":
             loss = m_loss_full
 
@@ -94,7 +134,8 @@ def get_losses(args, pred, tgt_ang, tgt_crds, src_seq, pool=None, log=True, do_b
                                                                         torch.tensor(0), None
         loss = m_loss_full
         if do_backwards:
-            m_loss_full.backward()
+            with profiler.stage("backward"):
+                m_loss_full.backward()
 
 
     losses = {"loss": loss,
@@ -106,6 +147,7 @@ def get_losses(args, pred, tgt_ang, tgt_crds, src_seq, pool=None, log=True, do_b
               "mse-full": m_loss_full,
               "mse-bb": m_loss_bb,
               "mse-sc": m_loss_sc,
+              "mse-per-angle": m_loss_per_angle,
               "rmsd-full": rmsd_loss}
 
     return losses
@@ -136,7 +178,7 @@ def eval_epoch(model, validation_data, device, args, metrics, mode="valid", pool
 
 
 def train(model, metrics, training_data, train_eval_loader, validation_datasets, test_data, optimizer, device, args,
-          log_writer, scheduler, drmsd_worker_pool):
+          log_writer, scheduler, drmsd_worker_pool, profiler=None):
     """
     Model training control loop.
     """
@@ -146,7 +188,10 @@ def train(model, metrics, training_data, train_eval_loader, validation_datasets,
         # Train epoch
         start = time.time()
         metrics = train_epoch(model, training_data, validation_datasets, optimizer, device, args, log_writer, metrics,
-                              pool=drmsd_worker_pool)
+                              pool=drmsd_worker_pool, profiler=profiler)
+        if profiler is not None and profiler.enabled:
+            profiler.print_summary()
+            profiler.save()
         if args.eval_train:
            metrics = eval_epoch(model, train_eval_loader, device, args, metrics, mode="train", pool=drmsd_worker_pool)
         print_end_of_epoch_status("train", (start, metrics))
@@ -212,6 +257,7 @@ def checkpoint_model(args, optimizer, model, metrics, epoch_i, scheduler):
     checkpoint = {
         'model_state_dict': model_state_dict,
         'settings': args,
+        'angle_means': model.angle_means,
         'epoch': epoch_i,
         'optimizer_state_dict': optimizer.state_dict(),
         'scheduler_state_dict': scheduler.state_dict() if scheduler else None,
@@ -285,7 +331,8 @@ def make_model(args, device, angle_means):
                                        dropout=args.dropout,
                                        vocab=VOCAB,
                                        angle_means=angle_means,
-                                       use_tanh_out=not "linear-out" in args.model)
+                                       use_tanh_out=not "linear-out" in args.model,
+                                       **get_attn_kwargs(args))
     elif "conv-enc" in args.model:
         model = ConvEncoderOnlyTransformer(nlayers=args.n_layers,
                                            nhead=args.n_head,
@@ -299,7 +346,8 @@ def make_model(args, device, angle_means):
                                            conv_kernel_sizes=[a for a in [args.conv1_size, args.conv2_size, args.conv3_size] if a],
                                            conv_dim_reductions=[a for a in [args.conv1_reduc, args.conv2_reduc, args.conv3_reduc] if a],
                                            use_embedding=args.use_embedding,
-                                           conv_out_matches_dm=args.conv_out_matches_dm)
+                                           conv_out_matches_dm=args.conv_out_matches_dm,
+                                           **get_attn_kwargs(args))
     elif args.model == "enc-dec":
         model = Transformer(dm=args.d_model,
                             dff=args.d_inner_hid,
@@ -315,11 +363,22 @@ def make_model(args, device, angle_means):
                             dropout=args.dropout,
                             fraction_complete_tf=args.fraction_complete_tf,
                             fraction_subseq_tf=args.fraction_subseq_tf,
-                            angle_means=angle_means)
+                            angle_means=angle_means,
+                            scheduled_sampling=getattr(args, "scheduled_sampling", "parallel"))
     else:
         raise argparse.ArgumentError("Model architecture not implemented.")
     return model
 
+def get_attn_kwargs(args):
+    """
+    Returns the attention settings of encoder-only models. Arguments saved
+    before these settings existed default to full attention in every layer.
+    """
+    return {"attn_types": getattr(args, "attn_types", None),
+            "attn_window": getattr(args, "attn_window", 32),
+            "attn_global_tokens": getattr(args, "attn_global_tokens", 0)}
+
+
 def parse_conv_kernel_info_from_model_name(mname):
     """ Returns the parsed settings for the number and arrangement of convolutional
     layers. Specifically, this returns the requested kernel sizes and the factor
@@ -443,6 +502,10 @@ def create_parser():
                                "trains fastest when this is 1.")
     training.add_argument("-fsstf", "--fraction_subseq_tf", type=float, default=1,
                           help="Fraction of the time to use teacher forcing on a per-timestep basis.")
+    training.add_argument("--scheduled_sampling", type=str, choices=["parallel", "sequential"], default="parallel",
+                          help="How the enc-dec model feeds its own predictions back when --fraction_subseq_tf < 1. "
+                               "'parallel' mixes the predictions of a teacher forced pass into the decoder input and "
+                               "decodes again in parallel. 'sequential' decodes one timestep at a time (slow).")
     training.add_argument("--skip_missing_res_train", type=my_bool, default="False",
                           help="When training, skip over batches that have missing residues. This can make training"
                                "faster if using teacher forcing.")
@@ -463,6 +526,12 @@ def create_parser():
     training.add_argument('--sequential_drmsd_loss', action="store_true",
                           help="Compute DRMSD loss without batch-level parallelization.")
     training.add_argument("--bins", type=int, default=-1, help="Number of bins for protein dataset batching. ")
+    training.add_argument("--crop_len", type=int, default=None,
+                          help="Train on random, contiguous windows of at most this many residues from each protein, "
+                               "instead of truncating proteins longer than the maximum sequence length.")
+    training.add_argument("--crop_observed_bias", type=float, default=0.,
+                          help="When cropping, bias (0-1) the choice of window towards regions with observed "
+                               "residues. 0 samples windows uniformly.")
     training.add_argument("--train_eval_downsample", type=float, default=0.10, help="Fraction of training set to "
                                                                                    "evaluate on each epoch.")
     training.add_argument("--automatically_determine_batch_size", "-adbs", type=my_bool, help="Experimentally determine"
@@ -486,6 +555,16 @@ def create_parser():
                                  "decoder"
                                  " both have this number of layers.")
     model_args.add_argument('-do', '--dropout', type=float, default=0.1, help="Dropout applied between layers.")
+    model_args.add_argument("--attn_types", type=str, nargs="+", choices=["full", "local"], default=["full"],
+                            help="Self-attention used by the encoder layers of encoder-only models. Either one type "
+                                 "for every layer, or one per layer, e.g. 'local local full full full full'. "
+                                 "'local' attention only attends to residues within --attn_window positions.")
+    model_args.add_argument("--attn_window", type=int, default=32,
+                            help="Number of residues on either side of each residue attended to by 'local' "
+                                 "attention layers.")
+    model_args.add_argument("--attn_global_tokens", type=int, default=0,
+                            help="Number of positions at the start of the sequence that attend to, and are attended "
+                                 "by, every residue in 'local' attention layers.")
     model_args.add_argument('--postnorm', action='store_true',
                             help="Use post-layer normalization, as depicted in the original figure for the Transformer "
                                  "model. May not train as well as pre-layer normalization.")
@@ -512,7 +591,17 @@ def create_parser():
     saving_args.add_argument('--log_val_struct_step', '-lvs', type=int, default=50,
                              help="During training, make predictions on 1 structure from every validation set.")
     saving_args.add_argument('--log_wandb_step', type=int, default=1,
-                             help="Frequency of logging to wandb during training.")
+                             help="Frequency of logging to wandb during training. Training batch metrics are "
+                                  "only transferred from the device at this frequency.")
+    saving_args.add_argument("--profile", action="store_true",
+                             help="Records the time spent in each stage of every training step (data loading, "
+                                  "forward, losses, backward, optimizer step, logging, etc.). Adds a device "
+                                  "synchronization between stages, so training is slightly slower.")
+    saving_args.add_argument("--profile_dir", type=str, default=None,
+                             help="Directory for profiling results. Defaults to 'profile' within the run directory.")
+    saving_args.add_argument("--profile_trace_steps", type=int, nargs=2, default=None, metavar=("FIRST", "LAST"),
+                             help="If provided with --profile, records training steps FIRST through LAST (counted "
+                                  "from the start of training) with torch.profiler and saves a Chrome trace.")
     saving_args.add_argument("--save_pngs", "-png", type=my_bool, default="True", help="Save images when making structures.")
     saving_args.add_argument('--no_cuda', action='store_true')
     saving_args.add_argument('-c', '--cluster', type=my_bool, default="False",
@@ -583,6 +672,10 @@ def main():
     args.add_sos_eos = args.model == "enc-dec"
     LOGFILEHEADER = prepare_log_header(args)
     args.bins = "auto" if args.bins == -1 else args.bins
+    assert args.crop_len is None or args.crop_len > 0, "Please use a positive crop length."
+    assert 0 <= args.crop_observed_bias <= 1, "Please use a crop observed bias between 0 and 1."
+    assert args.model != "enc-dec" or args.attn_types == ["full"], "Local attention requires an encoder-only model."
+    assert len(args.attn_types) in [1, args.n_layers], "Please provide one attention type, or one for each layer."
     if args.automatically_determine_batch_size:
         args.batch_size = determine_largest_batch_size(args)
     if "conv-enc" in args.model:  # This will generate a model architecture based on a supplied name, ie conv-env|3,3,3|2,2,2
@@ -666,13 +759,17 @@ def main():
     wandb.save(os.path.join(local_base_dir, "checkpoints/*"))
     wandb.save(os.path.join(local_base_dir, "*.train"))
 
+    profiler = StepProfiler(enabled=args.profile, device=device,
+                            out_dir=args.profile_dir or os.path.join(local_base_dir, "profile"), name=args.name,
+                            trace_steps=args.profile_trace_steps)
+
     print(args, "\n")
 
     # Start training
     training_data, training_eval_loader, validation_datasets, test_data = prepare_dataloaders(data, args, MAX_SEQ_LEN)
     del data
     train(model, metrics, training_data, training_eval_loader, validation_datasets, test_data, optimizer,
-          device, args, log_writer, scheduler, drmsd_worker_pool)
+          device, args, log_writer, scheduler, drmsd_worker_pool, profiler)
     log_f.close()
 
 
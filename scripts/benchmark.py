@@ -0,0 +1,396 @@
+"""
+Micro- and macro-benchmarks for the performance-critical paths of
+protein_transformer, run on synthetic data so that no dataset or network
+access is required.
+
+    Usage:
+        python benchmark.py run --out results.json [--only REGEX] [--quick]
+        python benchmark.py compare baseline.json results.json [--threshold 0.1]
+
+"run" times every benchmark case and writes the results, along with a
+description of the environment, to a JSON file. "compare" reports the ratio
+of the median time of every case shared by two result files, and exits with a
+non-zero status if any case became slower than the allowed threshold. This
+makes it possible to check a new build for regressions before deploying it.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from protein_transformer.dataset import collate_fn, paired_collate_fn
+from protein_transformer.losses import compute_batch_drmsd, drmsd
+from protein_transformer.models.encoder_only import EncoderOnlyTransformer
+from protein_transformer.models.transformer.Attention import MultiHeadedAttention
+from protein_transformer.protein.Sequence import VOCAB
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, NUM_PREDICTED_COORDS, nerf
+from protein_transformer.protein.StructureBuilder import StructureBuilder
+
+BENCHMARK_SEED = 0
+NUM_AMINO_ACIDS = 20
+
+
+def random_sequence(length, rng):
+    """ Returns a random integer-encoded amino acid sequence (without padding or sos/eos). """
+    return torch.tensor(rng.randint(0, NUM_AMINO_ACIDS, length))
+
+
+def random_angles(length, rng):
+    """ Returns random angles in radians (L x NUM_PREDICTED_ANGLES) with realistic bond angles. """
+    ang = rng.uniform(-np.pi, np.pi, (length, NUM_PREDICTED_ANGLES))
+    ang[:, 3:6] = rng.uniform(1.9, 2.2, (length, 3))
+    return torch.tensor(ang, dtype=torch.float32)
+
+
+def synthetic_protein(length, rng):
+    """ Returns the sequence, angles and coordinates ((L x NUM_PREDICTED_COORDS) x 3) of a random protein. """
+    seq = random_sequence(length, rng)
+    ang = random_angles(length, rng)
+    with torch.no_grad():
+        crd = StructureBuilder(seq, ang).build()
+    return seq, ang, crd
+
+
+def synthetic_batch(lengths, rng):
+    """
+    Returns a padded batch of (sequences, sin/cos angle predictions, true coordinates) in the format produced by
+    paired_collate_fn.
+    """
+    insts = []
+    for length in lengths:
+        seq, ang, crd = synthetic_protein(length, rng)
+        insts.append((seq.numpy(), np.concatenate([np.sin(ang.numpy()), np.cos(ang.numpy())], axis=-1),
+                      crd.numpy()))
+    seqs, angs, crds = paired_collate_fn(insts)
+    pred = torch.tensor(rng.uniform(-1, 1, angs.shape), dtype=torch.float32)
+    return seqs, pred, crds
+
+
+def bench_nerf(batch):
+    """ Placement of one atom (batch=1, as in StructureBuilder) or a batch of atoms, forward and backward. """
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    shape = (batch, 3) if batch > 1 else (3,)
+    a, b, c = (torch.tensor(rng.normal(size=shape), requires_grad=True) for _ in range(3))
+    chi = torch.tensor(rng.uniform(-np.pi, np.pi, shape[:-1]), requires_grad=True)
+
+    def run():
+        nerf(a, b, c, 1.5, 2.0, chi).sum().backward()
+    return run
+
+
+def bench_structure_build(length):
+    """ StructureBuilder.build for a single protein, without gradients. """
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    seq, ang = random_sequence(length, rng), random_angles(length, rng)
+
+    def run():
+        with torch.no_grad():
+            StructureBuilder(seq, ang).build()
+    return run
+
+
+def bench_drmsd(length):
+    """ drmsd between two full-atom structures. """
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    a = torch.tensor(rng.normal(size=(length * NUM_PREDICTED_COORDS, 3)))
+    b = torch.tensor(rng.normal(size=(length * NUM_PREDICTED_COORDS, 3)))
+
+    def run():
+        drmsd(a, b)
+    return run
+
+
+def bench_compute_batch_drmsd(batch, length, pool=None):
+    """ compute_batch_drmsd with a backward pass, optionally using a worker pool. """
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    seqs, pred, crds = synthetic_batch([length] * batch, rng)
+    pred.requires_grad_()
+
+    def run():
+        compute_batch_drmsd(pred, crds, seqs, do_backward=True, pool=pool)
+        pred.grad = None
+    return run
+
+
+def bench_collate(batch, length):
+    """ paired_collate_fn for a batch of (sequence, angle, coordinate) tuples of varying length. """
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    lengths = rng.randint(length // 2, length + 1, batch)
+    insts = [(rng.randint(0, NUM_AMINO_ACIDS, n),
+              rng.uniform(-1, 1, (n, NUM_PREDICTED_ANGLES * 2)),
+              rng.normal(size=(n * NUM_PREDICTED_COORDS, 3))) for n in lengths]
+
+    def run():
+        paired_collate_fn(insts)
+    return run
+
+
+def bench_collate_sequences(batch, length):
+    """ collate_fn for a batch of sequences of varying length. """
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    seqs = [rng.randint(0, NUM_AMINO_ACIDS, n) for n in rng.randint(length // 2, length + 1, batch)]
+
+    def run():
+        collate_fn(seqs, sequences=True)
+    return run
+
+
+def bench_attention(length, heads, batch=8, dm=256):
+    """ MultiHeadedAttention self-attention, forward and backward. """
+    torch.manual_seed(BENCHMARK_SEED)
+    attn = MultiHeadedAttention(dm, heads, dropout=0)
+    x = torch.randn(batch, length, dm, requires_grad=True)
+    mask = torch.ones(batch, 1, length, dtype=torch.bool)
+
+    def run():
+        attn(x, x, x, mask).sum().backward()
+    return run
+
+
+def bench_encoder_only(length, batch=8, backward=True):
+    """ EncoderOnlyTransformer forward (and optionally backward) on a padded batch. """
+    torch.manual_seed(BENCHMARK_SEED)
+    model = EncoderOnlyTransformer(nlayers=2, nhead=8, dmodel=256, dff=512, max_seq_len=max(length, 500), vocab=VOCAB,
+                                   angle_means=np.zeros(NUM_PREDICTED_ANGLES * 2), use_tanh_out=False, dropout=0)
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    seqs = torch.tensor(rng.randint(0, NUM_AMINO_ACIDS, (batch, length)))
+    seqs[batch // 2:, length * 3 // 4:] = VOCAB.pad_id
+
+    if backward:
+        model.train()
+
+        def run():
+            model(seqs).sum().backward()
+            model.zero_grad()
+    else:
+        model.eval()
+
+        def run():
+            with torch.no_grad():
+                model(seqs)
+    return run
+
+
+def bench_save_pdb(length):
+    """ PDB_Creator.save_pdb for a single full-atom structure. """
+    from protein_transformer.protein.PDB_Creator import PDB_Creator
+    rng = np.random.RandomState(BENCHMARK_SEED)
+    seq, _, crd = synthetic_protein(length, rng)
+    seq = VOCAB.ints2str(seq.numpy())
+    out_dir = tempfile.mkdtemp()
+    path = os.path.join(out_dir, "benchmark.pdb")
+
+    def run():
+        PDB_Creator(crd.numpy(), seq).save_pdb(path)
+    return run
+
+
+def get_benchmark_cases(quick=False, get_pool=None):
+    """
+    Returns a list of (name, params, setup) for every benchmark case, where setup() returns a function that runs the
+    case once. If quick, fewer and smaller cases are returned. get_pool() returns the multiprocessing pool used by
+    cases with pool=True, and is only called when one of them is set up. If get_pool is None, those cases are not
+    returned.
+    """
+    lengths = [64, 256] if quick else [64, 256, 500]
+    cases = []
+    for batch in [1, 1024]:
+        cases.append(("nerf", {"batch": batch}, lambda batch=batch: bench_nerf(batch)))
+    for length in lengths:
+        cases.append(("structure_build", {"length": length}, lambda length=length: bench_structure_build(length)))
+    for length in lengths:
+        cases.append(("drmsd", {"length": length}, lambda length=length: bench_drmsd(length)))
+    drmsd_length = 64 if quick else 128
+    for use_pool in [False, True]:
+        if use_pool and get_pool is None:
+            continue
+        cases.append(("compute_batch_drmsd", {"batch": 8, "length": drmsd_length, "pool": use_pool},
+                      lambda use_pool=use_pool: bench_compute_batch_drmsd(8, drmsd_length,
+                                                                          get_pool() if use_pool else None)))
+    cases.append(("collate_fn", {"batch": 32, "length": 500}, lambda: bench_collate_sequences(32, 500)))
+    cases.append(("paired_collate_fn", {"batch": 32, "length": 500}, lambda: bench_collate(32, 500)))
+    for length in lengths:
+        for heads in ([8] if quick else [4, 8, 16]):
+            cases.append(("attention", {"length": length, "heads": heads},
+                          lambda length=length, heads=heads: bench_attention(length, heads)))
+    for length in lengths:
+        for backward in [False, True]:
+            cases.append(("encoder_only", {"length": length, "backward": backward},
+                          lambda length=length, backward=backward: bench_encoder_only(length, backward=backward)))
+    for length in lengths:
+        cases.append(("save_pdb", {"length": length}, lambda length=length: bench_save_pdb(length)))
+    return cases
+
+
+def case_key(name, params):
+    """ Returns a unique, human-readable key for a benchmark case, i.e. 'attention[heads=8,length=64]'. """
+    return name + "[" + ",".join(f"{k}={v}" for k, v in sorted(params.items())) + "]"
+
+
+def time_callable(fn, repeat, min_time, warmup=1):
+    """
+    Returns a list of repeat timings (seconds per call) for fn. Each timing averages enough consecutive calls to last
+    at least min_time seconds, which is determined during warmup.
+    """
+    start = time.perf_counter()
+    for _ in range(warmup):
+        fn()
+    per_call = max((time.perf_counter() - start) / warmup, 1e-9)
+    number = max(1, int(np.ceil(min_time / per_call)))
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - start) / number)
+    return timings, number
+
+
+def get_environment():
+    """ Returns a description of the software and hardware used for a benchmark run. """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, encoding="utf-8",
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git_commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "torch_num_threads": torch.get_num_threads(),
+            "numpy": np.__version__}
+
+
+def run_benchmarks(only=None, quick=False, repeat=5, min_time=0.2, workers=None, verbose=True):
+    """
+    Runs every benchmark case whose key matches the regular expression only, and returns a dictionary with the
+    environment and the results of each case. Cases that cannot be run in this environment (i.e. due to a missing
+    optional dependency) are recorded as skipped. The worker pool (of workers processes) is only created if a case
+    that uses it is run.
+    """
+    pool = None
+
+    def get_pool():
+        nonlocal pool
+        if pool is None:
+            pool = mp.Pool(workers or mp.cpu_count())
+        return pool
+
+    results = {}
+    try:
+        for name, params, setup in get_benchmark_cases(quick=quick, get_pool=get_pool):
+            key = case_key(name, params)
+            if only is not None and not re.search(only, key):
+                continue
+            try:
+                fn = setup()
+            except ImportError as e:
+                results[key] = {"name": name, "params": params, "skipped": str(e)}
+                if verbose:
+                    print(f"{key:<55} skipped ({e})")
+                continue
+            timings, number = time_callable(fn, repeat, min_time)
+            results[key] = {"name": name,
+                            "params": params,
+                            "median": float(np.median(timings)),
+                            "min": float(np.min(timings)),
+                            "mean": float(np.mean(timings)),
+                            "std": float(np.std(timings)),
+                            "repeat": repeat,
+                            "number": number}
+            if verbose:
+                print(f"{key:<55} {results[key]['median'] * 1000:10.3f} ms  (min {results[key]['min'] * 1000:.3f})")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return {"environment": get_environment(), "results": results}
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compares the median time of every case present in both benchmark result dictionaries. Returns a list of
+    (key, baseline_median, current_median, ratio, status) sorted by key, where status is "regression" if the case
+    became slower by more than the fraction threshold, "improvement" if it became faster by more than threshold and
+    "ok" otherwise.
+    """
+    rows = []
+    for key in sorted(set(baseline["results"]) & set(current["results"])):
+        b, c = baseline["results"][key], current["results"][key]
+        if "median" not in b or "median" not in c:
+            continue
+        ratio = c["median"] / b["median"]
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 / (1 + threshold):
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append((key, b["median"], c["median"], ratio, status))
+    return rows
+
+
+def print_comparison(rows):
+    print(f"{'case':<55} {'baseline ms':>12} {'current ms':>12} {'ratio':>7}")
+    for key, b, c, ratio, status in rows:
+        flag = "" if status == "ok" else f"  <-- {status}"
+        print(f"{key:<55} {b * 1000:12.3f} {c * 1000:12.3f} {ratio:7.2f}{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the performance-critical paths of protein_transformer.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Runs the benchmarks and saves the results as JSON.")
+    run_parser.add_argument("--out", "-o", type=str, required=True, help="Path to the output JSON file.")
+    run_parser.add_argument("--only", type=str, default=None,
+                            help="Only runs cases whose key (i.e. 'attention[heads=8,length=64]') matches this regex.")
+    run_parser.add_argument("--quick", action="store_true", help="Runs fewer and smaller cases.")
+    run_parser.add_argument("--repeat", type=int, default=5, help="Number of timings recorded per case.")
+    run_parser.add_argument("--min_time", type=float, default=0.2,
+                            help="Minimum duration (seconds) of each timing. Fast cases are called repeatedly.")
+    run_parser.add_argument("--workers", type=int, default=None,
+                            help="Size of the dRMSD worker pool. Defaults to the number of CPUs.")
+    run_parser.add_argument("--threads", type=int, default=None, help="Number of threads used by PyTorch.")
+    compare_parser = subparsers.add_parser("compare", help="Compares two benchmark result files.")
+    compare_parser.add_argument("baseline", type=str, help="Results of the reference build.")
+    compare_parser.add_argument("current", type=str, help="Results of the build to be checked.")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="Fraction by which a case may slow down before it is considered a regression.")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        results = run_benchmarks(only=args.only, quick=args.quick, repeat=args.repeat, min_time=args.min_time,
+                                 workers=args.workers)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.out}.")
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        rows = compare_results(baseline, current, args.threshold)
+        print_comparison(rows)
+        if any(row[-1] == "regression" for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
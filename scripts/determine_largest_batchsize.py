@@ -49,7 +49,8 @@ def test_batch_size(args):
                     seqs=data['train']['seq'] * args.repeat_train,
                     crds=data['train']['crd'] * args.repeat_train,
                     angs=data['train']['ang'] * args.repeat_train,
-                    add_sos_eos=args.add_sos_eos, skip_missing_residues=args.skip_missing_res_train, bins=args.bins)
+                    add_sos_eos=args.add_sos_eos, skip_missing_residues=args.skip_missing_res_train, bins=args.bins,
+                    crop_len=args.crop_len, crop_observed_bias=args.crop_observed_bias)
                 train_loader = torch.utils.data.DataLoader(
                     train_dataset,
                     num_workers=1,
@@ -0,0 +1,70 @@
+"""
+    Exports a checkpoint saved during training to a slim inference checkpoint.
+
+    Training checkpoints also pickle the optimizer state, scheduler state and
+    full metrics history, all of which must be unpickled just to obtain the
+    weights. The exported directory holds only the weights (as one flat,
+    memory-mappable file) and a JSON description of the model, and can be
+    passed anywhere a checkpoint path is accepted (predict_fasta.py,
+    protein_transformer.server, load_model_from_checkpoint).
+
+    Usage:
+        python export_inference_checkpoint.py model_best.chkpt model_best_inference/
+        python export_inference_checkpoint.py model_best.chkpt model_best_inference/ --verify
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from protein_transformer.inference import export_inference_checkpoint, load_model_from_checkpoint, predict_angles
+from protein_transformer.protein.Sequence import VOCAB
+
+
+def get_size(path):
+    """ Returns the size in bytes of a file, or of all files in a directory. """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def verify_export(model, export_dir, num_seqs=4, seed=0):
+    """
+    Loads the exported model and returns the largest absolute difference
+    between its predictions and model's for random sequences, and the time
+    taken to load it in seconds.
+    """
+    start = time.time()
+    exported, _ = load_model_from_checkpoint(export_dir)
+    load_time = time.time() - start
+    rng = np.random.RandomState(seed)
+    seqs = ["".join(rng.choice(list(VOCAB.stdaas), length)) for length in rng.randint(10, 100, num_seqs)]
+    kwargs = {"refine_passes": 2} if hasattr(model, "decoder") else {}
+    diffs = [np.abs(a - b).max() for a, b in zip(predict_angles(model, seqs, **kwargs),
+                                                  predict_angles(exported, seqs, **kwargs))]
+    return max(diffs), load_time
+
+
+def main():
+    start = time.time()
+    model, model_args = load_model_from_checkpoint(args.checkpoint)
+    load_time = time.time() - start
+    export_inference_checkpoint(model, model_args, args.out_dir)
+    print(f"Exported {args.checkpoint} ({get_size(args.checkpoint) / 2 ** 20:.1f} MiB) to {args.out_dir} "
+          f"({get_size(args.out_dir) / 2 ** 20:.1f} MiB).")
+    if args.verify:
+        max_diff, export_load_time = verify_export(model, args.out_dir)
+        print(f"Maximum difference between predictions: {max_diff:.2e}. Load time: {load_time:.2f}s for the "
+              f"checkpoint, {export_load_time:.2f}s for the export.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports a training checkpoint for inference.")
+    parser.add_argument("checkpoint", type=str, help="Path to a model checkpoint saved by train.py.")
+    parser.add_argument("out_dir", type=str, help="Directory for the exported model.")
+    parser.add_argument("--verify", action="store_true",
+                        help="Load the exported model and compare its predictions to the checkpoint's.")
+    args = parser.parse_args()
+    main()
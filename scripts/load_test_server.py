@@ -0,0 +1,146 @@
+"""
+    Measures the latency and throughput of a running prediction server
+    (protein_transformer/server.py).
+
+    A fixed number of clients each keep one connection open and send
+    /predict requests back to back until the requested number of predictions
+    has been made, so that the server always has --concurrency requests in
+    flight. Sequences are drawn from FASTA files, or generated at random with
+    lengths between --min_len and --max_len. The latency percentiles,
+    throughput, and the server's own /metrics are printed at the end.
+
+    Usage:
+        python -m protein_transformer.server model_best.chkpt --port 8000 &
+        python load_test_server.py --port 8000 --num_requests 2000 --concurrency 32
+        python load_test_server.py --port 8000 --fasta proteome.fasta --output pdb
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from predict_fasta import read_fasta
+
+
+async def send_request(reader, writer, host, method, path, payload=None):
+    """ Sends a request over an open connection and returns the response's status and decoded JSON body. """
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def get(host, port, path):
+    """ Returns the status and JSON body of a GET request sent over a new connection. """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return await send_request(reader, writer, host, "GET", path)
+    finally:
+        writer.close()
+
+
+async def _client(host, port, jobs, output, results):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while jobs:
+            pid, seq = jobs.pop()
+            start = time.perf_counter()
+            status, _ = await send_request(reader, writer, host, "POST", "/predict",
+                                           {"id": pid, "sequence": seq, "output": output})
+            results.append((time.perf_counter() - start, status, len(seq)))
+    finally:
+        writer.close()
+
+
+def summarize(results, seconds):
+    """
+    Returns the latency percentiles (in ms) of successful requests, the
+    number of errors, and the throughput in requests and residues per second
+    given a list of (latency in seconds, status, sequence length) tuples.
+    """
+    ok = [(lat, length) for lat, status, length in results if status == 200]
+    latencies = np.asarray([lat for lat, _ in ok]) * 1000
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) if len(ok) else (float("nan"),) * 3
+    return {"num_requests": len(results),
+            "num_errors": len(results) - len(ok),
+            "seconds": seconds,
+            "latency_ms": {"p50": p50, "p90": p90, "p99": p99,
+                           "mean": float(latencies.mean()) if len(ok) else float("nan"),
+                           "max": float(latencies.max()) if len(ok) else float("nan")},
+            "requests_per_second": len(ok) / max(seconds, 1e-9),
+            "residues_per_second": sum(length for _, length in ok) / max(seconds, 1e-9)}
+
+
+async def run_load_test(host, port, records, concurrency=16, output="angles"):
+    """
+    Predicts every (id, sequence) record with concurrency connections and
+    returns the summary of the responses (see summarize).
+    """
+    jobs = list(reversed(records))
+    results = []
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(host, port, jobs, output, results) for _ in range(min(concurrency, len(jobs)))])
+    return summarize(results, time.perf_counter() - start)
+
+
+def make_records(num_requests, min_len, max_len, seed=0):
+    """ Returns num_requests (id, sequence) records of random sequences with lengths in [min_len, max_len]. """
+    rng = np.random.RandomState(seed)
+    aas = list("ACDEFGHIKLMNPQRSTVWY")
+    return [(f"seq{i}", "".join(rng.choice(aas, length)))
+            for i, length in enumerate(rng.randint(min_len, max_len + 1, num_requests))]
+
+
+def main():
+    if args.fasta:
+        records = list(read_fasta(args.fasta))[:args.num_requests]
+    else:
+        records = make_records(args.num_requests, args.min_len, args.max_len, args.seed)
+    if args.warmup:
+        asyncio.run(run_load_test(args.host, args.port, records[:args.warmup], args.concurrency, args.output))
+    summary = asyncio.run(run_load_test(args.host, args.port, records, args.concurrency, args.output))
+    latency = summary["latency_ms"]
+    print(f"{summary['num_requests']} requests ({summary['num_errors']} errors) in {summary['seconds']:.2f}s "
+          f"with {args.concurrency} concurrent clients.")
+    print(f"Latency (ms): p50 {latency['p50']:.1f}, p90 {latency['p90']:.1f}, p99 {latency['p99']:.1f}, "
+          f"max {latency['max']:.1f}")
+    print(f"Throughput: {summary['requests_per_second']:.1f} req/s, {summary['residues_per_second']:.0f} res/s")
+    status, metrics = asyncio.run(get(args.host, args.port, "/metrics"))
+    if status == 200:
+        print(f"Server: {metrics['num_batches']} batches, mean batch size {metrics['mean_batch_size']}.")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"client": summary, "server": metrics}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the latency and throughput of a prediction server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address of the server.")
+    parser.add_argument("--port", type=int, default=8000, help="Port of the server.")
+    parser.add_argument("--num_requests", type=int, default=1000, help="Number of predictions to request.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Number of requests in flight at once.")
+    parser.add_argument("--output", type=str, default="angles", choices=["angles", "coords", "pdb"],
+                        help="Output requested for each prediction.")
+    parser.add_argument("--fasta", type=str, nargs="+", default=None,
+                        help="FASTA file(s) of sequences to predict. Defaults to random sequences.")
+    parser.add_argument("--min_len", type=int, default=50, help="Minimum length of random sequences.")
+    parser.add_argument("--max_len", type=int, default=400, help="Maximum length of random sequences.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random sequences.")
+    parser.add_argument("--warmup", type=int, default=0,
+                        help="Number of requests sent before measuring, e.g. to warm up the server.")
+    parser.add_argument("--json", type=str, default=None, help="Path to write the client and server statistics.")
+    args = parser.parse_args()
+    main()
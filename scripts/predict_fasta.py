@@ -0,0 +1,282 @@
+"""
+    Predicts full-atom structures for every sequence in one or more FASTA files
+    with a trained model, writing one PDB file per sequence.
+
+    Sequences are streamed from the FASTA files and sorted by length within a
+    buffer, so that each batch contains sequences of similar length and holds
+    at most --max_tokens (padded) residues. Sequences longer than an
+    encoder-only model's maximum length are predicted alone with sliding
+    windows (see protein_transformer.inference). Prediction, coordinate
+    building, and PDB writing run as three overlapping pipeline stages
+    connected by bounded queues. Coordinates may be built by a pool of
+    processes, which suits proteome-scale predictions on CPU nodes. With
+    --cache_dir, predictions are stored in a PredictionCache and sequences
+    predicted before by the same model skip prediction and building.
+
+    Usage:
+        python predict_fasta.py model_best.chkpt proteome.fasta -o predictions/
+        python predict_fasta.py model_best.chkpt a.fasta b.fasta -o out/ --max_tokens 32000 --build_workers 8
+        python predict_fasta.py model_best.chkpt proteome.fasta -o out/ --cache_dir ~/.cache/predictions
+"""
+
+import argparse
+import collections
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+import tqdm
+
+from protein_transformer.inference import (load_model_from_checkpoint, predict_angles, build_coords,
+                                           bucket_by_length, get_max_len)
+from protein_transformer.prediction_cache import PredictionCache, model_digest
+from protein_transformer.protein.PDB_Creator import PDB_Creator
+from protein_transformer.protein.Sequence import VOCAB
+
+
+def read_fasta(paths):
+    """
+    Yields (protein id, sequence) tuples from each FASTA file in paths,
+    without reading the whole file into memory. The id is the first word of
+    each header line.
+    """
+    for path in paths:
+        with open(path) as f:
+            pid, seq = None, []
+            for line in f:
+                line = line.strip()
+                if line.startswith(">"):
+                    if pid is not None:
+                        yield pid, "".join(seq)
+                    pid, seq = (line[1:].split() or [""])[0], []
+                elif pid is not None:
+                    seq.append(line.upper().replace("*", ""))
+            if pid is not None:
+                yield pid, "".join(seq)
+
+
+def make_batches(records, max_tokens, max_batch_size, buffer_size, max_len=None):
+    """ Streams records into length-bucketed batches, sorting buffer_size records at a time. """
+    buffer = []
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= buffer_size:
+            yield from bucket_by_length(buffer, max_tokens, max_batch_size, max_len)
+            buffer = []
+    yield from bucket_by_length(buffer, max_tokens, max_batch_size, max_len)
+
+
+def predict_batch(model, batch, refine_passes=None, window=None, overlap=None):
+    """
+    Returns a list of (id, sequence, angles) tuples for a batch of (id,
+    sequence) records, where angles are in radians (L x NUM_PREDICTED_ANGLES).
+    """
+    angles = predict_angles(model, [seq for _, seq in batch], refine_passes, window, overlap)
+    return [(pid, seq, ang) for (pid, seq), ang in zip(batch, angles)]
+
+
+def build_structure(item):
+    """ Returns (id, sequence, angles, coordinates, None) given (id, sequence, angles). """
+    pid, seq, angles = item
+    return pid, seq, angles, build_coords(seq, angles), None
+
+
+def get_pdb_path(out_dir, pid):
+    """ Returns the path of the PDB file for protein pid, replacing characters that are unsafe in file names. """
+    return os.path.join(out_dir, re.sub(r"[^\w.-]", "_", pid) + ".pdb")
+
+
+def _init_build_worker():
+    torch.set_num_threads(1)
+
+
+def _put(q, item, errors):
+    """ Puts item into q, raising the first error of any pipeline stage rather than waiting forever. """
+    while True:
+        if errors:
+            raise errors[0]
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _close(q, errors):
+    """
+    Puts the end-of-stream sentinel None into q. If a pipeline stage has
+    failed, the stage reading from q may have stopped, so q is emptied
+    (its items would not be written anyway) rather than waiting for room.
+    """
+    while True:
+        try:
+            q.put(None, timeout=0.1)
+            return
+        except queue.Full:
+            if errors:
+                try:
+                    while True:
+                        q.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+def _build_stage(build_queue, write_queue, build_workers, errors):
+    """ Builds coordinates for predictions from build_queue and passes them to write_queue. """
+    try:
+        if not build_workers:
+            for item in iter(build_queue.get, None):
+                _put(write_queue, build_structure(item), errors)
+        else:
+            with ProcessPoolExecutor(build_workers, initializer=_init_build_worker) as executor:
+                pending = collections.deque()
+                for item in iter(build_queue.get, None):
+                    pending.append(executor.submit(build_structure, item))
+                    while len(pending) > 2 * build_workers:
+                        _put(write_queue, pending.popleft().result(), errors)
+                while pending:
+                    _put(write_queue, pending.popleft().result(), errors)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        _close(write_queue, errors)
+
+
+def _write_stage(write_queue, out_dir, stats, errors, progress_bar, cache=None):
+    """
+    Writes a PDB file for each structure from write_queue, and adds
+    structures that were not read from the cache to it.
+    """
+    try:
+        for pid, seq, angles, coords, cached in iter(write_queue.get, None):
+            if cached is not None and "pdb" in cached:
+                pdb = cached["pdb"]
+            else:
+                pdb = PDB_Creator(coords, seq).get_pdb_string(title=pid)
+            with open(get_pdb_path(out_dir, pid), "w") as f:
+                f.write(pdb)
+            if cache is not None and cached is None:
+                cache.put(seq, angles, coords, pdb)
+            stats["num_proteins"] += 1
+            stats["num_residues"] += len(seq)
+            if progress_bar is not None:
+                progress_bar.update(1)
+    except Exception as e:
+        errors.append(e)
+
+
+def predict_fasta(model, model_args, fasta_paths, out_dir, max_tokens=16384, max_batch_size=256, buffer_size=4096,
+                  build_workers=0, queue_size=64, refine_passes=None, window=None, overlap=None, cache=None,
+                  verbose=False):
+    """
+    Predicts and writes the structures of every sequence in fasta_paths to
+    out_dir. Sequences with non-standard amino acids, or that are too long
+    for an encoder-decoder model, are skipped. Sequences found in cache (a
+    PredictionCache) are written without being predicted. Returns a
+    dictionary with the number of proteins and residues written, the skipped
+    protein ids, the number of cache hits, and the elapsed time in seconds.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.time()
+    stats = {"num_proteins": 0, "num_residues": 0, "skipped": [], "cache_hits": 0}
+    errors = []
+    build_queue, write_queue = queue.Queue(maxsize=queue_size), queue.Queue(maxsize=queue_size)
+    progress_bar = tqdm.tqdm(desc="Predicted", unit=" proteins", smoothing=0.1) if verbose else None
+    stages = [threading.Thread(target=_build_stage, args=(build_queue, write_queue, build_workers, errors)),
+              threading.Thread(target=_write_stage, args=(write_queue, out_dir, stats, errors, progress_bar, cache))]
+    for stage in stages:
+        stage.start()
+
+    standard_aas = set(VOCAB.stdaas)
+    max_len = get_max_len(model)
+
+    def records():
+        for pid, seq in read_fasta(fasta_paths):
+            if not seq or not set(seq) <= standard_aas or (model_args.model == "enc-dec" and len(seq) > max_len):
+                stats["skipped"].append(pid)
+                continue
+            cached = cache.get(seq, title=pid) if cache is not None else None
+            if cached is not None and "coords" in cached:
+                stats["cache_hits"] += 1
+                _put(write_queue, (pid, seq, cached["angles"], cached["coords"], cached), errors)
+            else:
+                yield pid, seq
+
+    try:
+        for batch in make_batches(records(), max_tokens, max_batch_size, buffer_size, max_len):
+            for item in predict_batch(model, batch, refine_passes, window, overlap):
+                _put(build_queue, item, errors)
+    finally:
+        _close(build_queue, errors)
+        for stage in stages:
+            stage.join()
+        if progress_bar is not None:
+            progress_bar.close()
+    if errors:
+        raise errors[0]
+    stats["seconds"] = time.time() - start
+    return stats
+
+
+def main():
+    device = torch.device(args.device)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, model_args = load_model_from_checkpoint(args.checkpoint, device)
+    cache = None
+    if args.cache_dir:
+        digest = model_digest(model, model_args, refine_passes=args.refine_passes, window=args.window,
+                              overlap=args.overlap)
+        cache = PredictionCache(args.cache_dir, digest, max_bytes=int(args.cache_max_gb * 2 ** 30),
+                                store_pdb=args.cache_pdb)
+    stats = predict_fasta(model, model_args, args.fasta, args.out_dir, max_tokens=args.max_tokens,
+                          max_batch_size=args.max_batch_size, buffer_size=args.buffer_size,
+                          build_workers=args.build_workers, queue_size=args.queue_size,
+                          refine_passes=args.refine_passes, window=args.window, overlap=args.overlap, cache=cache,
+                          verbose=True)
+    print(f"Wrote {stats['num_proteins']} structures ({stats['num_residues']} residues) to {args.out_dir} in "
+          f"{stats['seconds']:.1f}s ({stats['num_residues'] / max(stats['seconds'], 1e-9):.0f} res/s).")
+    if cache is not None:
+        print(f"Read {stats['cache_hits']} structures from the cache ({cache.stats()['bytes'] / 2 ** 20:.0f} MiB).")
+    if stats["skipped"]:
+        print(f"Skipped {len(stats['skipped'])} sequences with non-standard amino acids or that were too long: "
+              f"{', '.join(stats['skipped'][:10])}{' ...' if len(stats['skipped']) > 10 else ''}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predicts structures for the sequences in FASTA files.")
+    parser.add_argument("checkpoint", type=str, help="Path to a model checkpoint saved by train.py.")
+    parser.add_argument("fasta", type=str, nargs="+", help="Path(s) to FASTA file(s).")
+    parser.add_argument("-o", "--out_dir", type=str, required=True, help="Directory for the predicted PDB files.")
+    parser.add_argument("--device", type=str, default="cpu", help="Device used for prediction, e.g. cpu or cuda.")
+    parser.add_argument("--threads", type=int, default=None, help="Number of threads used by torch for prediction.")
+    parser.add_argument("--max_tokens", type=int, default=16384,
+                        help="Maximum number of (padded) residues in a batch.")
+    parser.add_argument("--max_batch_size", type=int, default=256, help="Maximum number of sequences in a batch.")
+    parser.add_argument("--buffer_size", type=int, default=4096,
+                        help="Number of sequences read and sorted by length at a time.")
+    parser.add_argument("--build_workers", type=int, default=max(1, multiprocessing.cpu_count() - 1),
+                        help="Number of processes used to build coordinates. 0 builds them in a single thread.")
+    parser.add_argument("--queue_size", type=int, default=64,
+                        help="Maximum number of proteins waiting between pipeline stages.")
+    parser.add_argument("--refine_passes", type=int, default=None,
+                        help="For enc-dec models, decode with this many refinement passes instead of "
+                             "autoregressively.")
+    parser.add_argument("--window", type=int, default=None,
+                        help="Window length for sequences longer than the model's maximum length. Defaults to the "
+                             "maximum length.")
+    parser.add_argument("--overlap", type=int, default=None,
+                        help="Overlap between windows. Defaults to a quarter of the window.")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Directory of a prediction cache, used to skip sequences predicted before.")
+    parser.add_argument("--cache_max_gb", type=float, default=10,
+                        help="Size of the prediction cache, beyond which the least recently used entries are "
+                             "evicted.")
+    parser.add_argument("--cache_pdb", action="store_true", help="Also store PDB files in the prediction cache.")
+    args = parser.parse_args()
+    main()
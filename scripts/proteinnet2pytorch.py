@@ -13,18 +13,20 @@ import multiprocessing
 import os
 import re
 import sys
+from glob import glob
 
 import numpy as np
 import prody as pr
 import torch
 import tqdm
 
-from protein_transformer.dataset import MAX_SEQ_LEN
+from protein_transformer.dataset import MAX_SEQ_LEN, precompute_sequence_data
 
 sys.path.append(".")
 from protein_transformer.protein.structure_utils import angle_list_to_sin_cos, get_seq_and_masked_coords_and_angles, \
     no_nans_infs_allzeros, parse_astral_summary_file, get_chain_from_astral_id, GLOBAL_PAD_CHAR
 import proteinnet_parsing
+from structure_cache import StructureCache
 from protein_transformer.protein.structure_exceptions import  NonStandardAminoAcidError, SequenceError, \
     ContigMultipleMatchingError, ShortStructureError, MissingAtomsError, NoneStructureError
 from proteinnet_errors import ERRORS
@@ -53,9 +55,16 @@ def get_chain_from_trainid(proteinnet_id):
         except:
             return ERRORS["FAILED_ASTRAL_IDS"]
 
-    # Continue loading the chain, given the PDB ID
+    # Continue loading the chain, given the PDB ID. Previously parsed structures are loaded from the local cache.
+    chain = None
+    if STRUCTURE_CACHE is not None:
+        try:
+            chain = STRUCTURE_CACHE.get_chain(pdbid, chid)
+        except:
+            chain = None
     try:
-        chain = pr.parsePDB(pdbid, chain=chid)
+        if chain is None:
+            chain = pr.parsePDB(pdbid, chain=chid)
     except:
         try:
             chain = pr.parseCIF(pdbid, chain=chid) # changed pr.parsePDB to pr.parseCIF, removed heirarchal view
@@ -119,11 +128,11 @@ def get_proteinnet_seq_from_id(pnid):
     Given a ProteinNet ID, this method returns the associated primary AA sequence.
     """
     if "#" not in pnid:
-        true_seq = PN_TRAIN_DICT[pnid]["primary"]
+        true_seq = PN_TRAIN_DICT[pnid]
     elif "TBM#" in pnid or "FM#" in pnid or "TBM-hard" in pnid:
-        true_seq = PN_TEST_DICT[pnid]["primary"]
+        true_seq = PN_TEST_DICT[pnid]
     else:
-        true_seq = PN_VALID_DICT[pnid]["primary"]
+        true_seq = PN_VALID_DICT[pnid]
     return true_seq
 
 
@@ -162,6 +171,84 @@ def work(pdbid_chain):
     return dihedrals, coords, sequence, pdbid_chain
 
 
+def keyed_work(pnid):
+    """
+    Returns (pnid, work(pnid)) so that results can be matched to their
+    ProteinNet IDs when they are computed out of order.
+    """
+    return pnid, work(pnid)
+
+
+def load_completed_ids(work_dir):
+    """
+    Returns the set of ProteinNet IDs whose results have already been recorded
+    in a result shard within work_dir. A shard's .ids file is only written
+    after the shard itself has been saved, so partially written shards are
+    ignored.
+    """
+    completed = set()
+    for ids_file in glob(os.path.join(work_dir, "results_*.ids")):
+        with open(ids_file, "r") as f:
+            completed.update(f.read().splitlines())
+    return completed
+
+
+def write_result_shard(work_dir, results):
+    """
+    Saves a dictionary mapping ProteinNet IDs to their results (as returned by
+    work) as the next result shard in work_dir.
+    """
+    shard_nums = [int(os.path.basename(f)[8:-3]) for f in glob(os.path.join(work_dir, "results_*.pt"))]
+    shard_path = os.path.join(work_dir, f"results_{max(shard_nums, default=-1) + 1:06}.pt")
+    torch.save(results, shard_path + ".tmp")
+    os.replace(shard_path + ".tmp", shard_path)
+    with open(shard_path.replace(".pt", ".ids"), "w") as f:
+        f.write("\n".join(results.keys()) + "\n")
+
+
+def process_ids_resumably(pnids, work_dir, shard_size):
+    """
+    Processes all requested ProteinNet IDs (train, validation and test) in a
+    single worker pool, writing results to work_dir in shards of shard_size
+    as they complete. IDs that already have results in work_dir are skipped,
+    so an interrupted conversion can be resumed.
+
+    Structures that fail with a transient error (see TRANSIENT_ERRORS) are
+    not recorded, so they are retried when the conversion is resumed.
+    Returns a dictionary mapping those IDs to their error codes.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    completed = load_completed_ids(work_dir)
+    todo = [pnid for pnid in pnids if pnid not in completed]
+    print(f"{len(pnids) - len(todo)} of {len(pnids)} structures already processed.")
+    shard, transient_failures = {}, {}
+    with multiprocessing.Pool(multiprocessing.cpu_count()) as p:
+        for pnid, result in tqdm.tqdm(p.imap_unordered(keyed_work, todo), total=len(todo), dynamic_ncols=True):
+            if type(result) == int and ERRORS.is_transient(result):
+                transient_failures[pnid] = result
+                continue
+            shard[pnid] = result
+            if len(shard) >= shard_size:
+                write_result_shard(work_dir, shard)
+                shard = {}
+    if shard:
+        write_result_shard(work_dir, shard)
+    return transient_failures
+
+
+def merge_result_shards(work_dir, pnids):
+    """
+    Loads the completed result shards from work_dir and returns a dictionary
+    mapping each of the requested ProteinNet IDs to its result.
+    """
+    pnids = set(pnids)
+    results = {}
+    for ids_file in sorted(glob(os.path.join(work_dir, "results_*.ids"))):
+        shard = torch.load(ids_file.replace(".ids", ".pt"), weights_only=False)
+        results.update({pnid: r for pnid, r in shard.items() if pnid in pnids})
+    return results
+
+
 def unpack_processed_results(results, pnids):
     """
     Given an iterable of processed results containing angles, sequences, and PDB IDs,
@@ -189,29 +276,32 @@ def unpack_processed_results(results, pnids):
     return all_ohs, all_angs, all_crds, all_ids
 
 
-def validate_data_dict(data):
+def validate_data_dict(data, valid_splits):
     """
-    Performs several checks on dictionary before saving.
+    Performs several checks on dictionary before saving. valid_splits lists
+    the validation splits the dictionary contains.
     """
     # Assert size of each data subset matches
     train_len = len(data["train"]["seq"])
     test_len = len(data["test"]["seq"])
-    items_recorded = ["seq", "ang", "ids", "crd"]
+    items_recorded = ["seq", "ang", "ids", "crd", "seq_ints", "has_missing", "lens"]
     for num_items, subset in zip([train_len, test_len], ["train", "test"]):
         assert all([l == num_items
                     for l in map(len, [data[subset][k]
                                        for k in items_recorded])]), f"{subset} lengths don't match."
 
-    for split in VALID_SPLITS:
+    for split in valid_splits:
         valid_len = len(data[f"valid-{split}"]["seq"])
-        assert all([l == valid_len for l in map(len, [data[f"valid-{split}"][k] for k in ["ang", "ids", "crd"]])]), \
+        assert all([l == valid_len for l in map(len, [data[f"valid-{split}"][k] for k in items_recorded])]), \
             "Valid lengths don't match."
 
 
-def create_data_dict(train_seq, test_seq, train_ang, test_ang, train_crd, test_crd, train_ids, test_ids, all_validation_data):
+def create_data_dict(train_seq, test_seq, train_ang, test_ang, train_crd, test_crd, train_ids, test_ids,
+                     all_validation_data, casp_version):
     """
     Given split data along with the query information that generated it, this function saves the
-    data as a Python dictionary, which is then saved to disk using torch.save.
+    data as a Python dictionary, which is then saved to disk using torch.save. casp_version (i.e. "casp12") is
+    recorded in the description.
     See commit  d1935a0869720f85c00824f3aecbbfc6b947711c for a method that saves all relevant information.
     """
     # Sort data
@@ -229,7 +319,7 @@ def create_data_dict(train_seq, test_seq, train_ang, test_ang, train_crd, test_c
                      "crd": test_crd},
             "settings": {"max_len": max(map(len, train_seq + test_seq)),
                          "pad_char": GLOBAL_PAD_CHAR},
-            "description": {f"ProteinNet {CASP_VERSION.upper()}"},
+            "description": {f"ProteinNet {casp_version.upper()}"},
             # To parse date later, use datetime.datetime.strptime(date, "%I:%M%p on %B %d, %Y")
             "date": datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y")}
     max_val_len = 0
@@ -246,7 +336,11 @@ def create_data_dict(train_seq, test_seq, train_ang, test_ang, train_crd, test_c
 
     data["settings"]["bin-data"] = bin_sequence_data(train_seq, maxlen=MAX_SEQ_LEN)
     data["settings"]["angle_means"] = compute_angle_means(data)
-    validate_data_dict(data)
+
+    # Store integer-encoded sequences, missing residue flags and lengths so datasets need not recompute them
+    for split in ["train", "test"] + [f"valid-{split}" for split in all_validation_data.keys()]:
+        data[split].update(precompute_sequence_data(data[split]["seq"], data[split]["ang"]))
+    validate_data_dict(data, all_validation_data.keys())
     return data
 
 
@@ -293,15 +387,16 @@ def bin_sequence_data(seqs, maxlen):
             "bin_max_len": maxlen}
 
 
-def add_proteinnetID_to_idx_mapping(data):
+def add_proteinnetID_to_idx_mapping(data, valid_splits):
     """
     Given an already processes ProteinNet data dictionary, this function adds
     a mapping from ProteinNet ID to the subset and index number where that
     protein can be looked up in the current dictionary. Useful if you'd like
-    to quickly extract a certain protein.
+    to quickly extract a certain protein. valid_splits lists the validation
+    splits the dictionary contains.
     """
     d = {}
-    for subset in ["train", "test"] + [f"valid-{split}" for split in VALID_SPLITS]:
+    for subset in ["train", "test"] + [f"valid-{split}" for split in valid_splits]:
         for idx, pnid in enumerate(data[subset]["ids"]):
             d[pnid] = {"subset": subset, "idx": idx}
 
@@ -353,47 +448,51 @@ def save_data_dict(data):
 def main():
     lim = args.limit
     global PN_TRAIN_DICT, PN_VALID_DICT, PN_TEST_DICT
-    train_pdb_ids, valid_ids, test_casp_ids = proteinnet_parsing.parse_raw_proteinnet(args.input_dir, TRAIN_FILE)
+    train_pdb_ids, valid_ids, test_casp_ids = proteinnet_parsing.parse_raw_proteinnet(args.input_dir, TRAIN_FILE,
+                                                                                      args.raw_shard_size)
     print("IDs fetched.")
-    PN_TRAIN_DICT, PN_VALID_DICT, PN_TEST_DICT = torch.load(
-        os.path.join(args.input_dir, "torch", TRAIN_FILE)), torch.load(
-        os.path.join(args.input_dir, "torch", "validation.pt")), torch.load(
-        os.path.join(args.input_dir, "torch", "testing.pt"))
     print(len(train_pdb_ids), len(valid_ids), len(test_casp_ids))
-    # Download and preprocess all data from PDB IDs
-    with multiprocessing.Pool(multiprocessing.cpu_count()) as p:
-        train_results = list(tqdm.tqdm(p.imap(work, train_pdb_ids[:lim]), total=len(train_pdb_ids[:lim]), dynamic_ncols=True))
     if lim:
         vlim = 1
     else:
         vlim = None
-    valid_result_meta = {}
-    for split, vids in group_validation_set(valid_ids).items():
-        valid_result_meta[split] = []
-        for vid in tqdm.tqdm(vids[:vlim], dynamic_ncols=True):
-            valid_result_meta[split].append(work(vid))
-
-    test_results = []
-    for tid in tqdm.tqdm(test_casp_ids[:vlim], dynamic_ncols=True):
-        test_results.append(work(tid))
+    train_pdb_ids = train_pdb_ids[:lim]
+    valid_ids_grouped = {split: vids[:vlim] for split, vids in group_validation_set(valid_ids).items()}
+    test_casp_ids = test_casp_ids[:vlim]
+
+    # Only the primary sequences of the requested proteins are needed, so the shards are read one at a time
+    torch_dict_dir = os.path.join(args.input_dir, "torch")
+    PN_TRAIN_DICT = proteinnet_parsing.load_preprocessed_sequences(torch_dict_dir, TRAIN_FILE, train_pdb_ids)
+    PN_VALID_DICT = proteinnet_parsing.load_preprocessed_sequences(
+        torch_dict_dir, "validation.pt", [vid for vids in valid_ids_grouped.values() for vid in vids])
+    PN_TEST_DICT = proteinnet_parsing.load_preprocessed_sequences(torch_dict_dir, "testing.pt", test_casp_ids)
+
+    # Download and preprocess all data from PDB IDs, recording results in shards as they complete
+    all_ids = train_pdb_ids + [vid for vids in valid_ids_grouped.values() for vid in vids] + test_casp_ids
+    work_dir = args.work_dir if args.work_dir else os.path.join(args.input_dir, "processed")
+    all_results = process_ids_resumably(all_ids, work_dir, args.shard_size)
+    all_results.update(merge_result_shards(work_dir, all_ids))
+    train_results = [all_results[pnid] for pnid in train_pdb_ids]
+    valid_result_meta = {split: [all_results[vid] for vid in vids] for split, vids in valid_ids_grouped.items()}
+    test_results = [all_results[tid] for tid in test_casp_ids]
 
     print("Structures processed.")
     
 
     # Unpack results
     print("Training set:\t", end="")
-    train_ohs, train_angs, train_strs, train_ids = unpack_processed_results(train_results, train_pdb_ids[:lim])
-    for (split, results), vids in zip(valid_result_meta.items(), group_validation_set(valid_ids).values()):
+    train_ohs, train_angs, train_strs, train_ids = unpack_processed_results(train_results, train_pdb_ids)
+    for (split, results), vids in zip(valid_result_meta.items(), valid_ids_grouped.values()):
         print(f"Valid set {split}%:\t", end="")
-        valid_result_meta[split] = unpack_processed_results(results, vids[:vlim])
+        valid_result_meta[split] = unpack_processed_results(results, vids)
     print("Test set:\t\t", end="")
-    test_ohs, test_angs, test_strs, test_ids = unpack_processed_results(test_results, test_casp_ids[:vlim])
+    test_ohs, test_angs, test_strs, test_ids = unpack_processed_results(test_results, test_casp_ids)
     ERRORS.summarize()
 
     # Split into train, test and validation sets. Report sizes.
     data = create_data_dict(train_ohs, test_ohs, train_angs, test_angs, train_strs, test_strs, train_ids, test_ids,
-                            valid_result_meta)
-    data = add_proteinnetID_to_idx_mapping(data)
+                            valid_result_meta, CASP_VERSION)
+    data = add_proteinnetID_to_idx_mapping(data, VALID_SPLITS)
     save_data_dict(data)
 
 
@@ -408,6 +507,20 @@ if __name__ == "__main__":
                         help="Path for ProDy-downloaded PDB files.")
     parser.add_argument('--training_set', type=int, default=100, help='Which thinning of the training set to parse. '
                                                                       '{30,50,70,90,95,100}. Default 100.')
+    parser.add_argument('--raw_shard_size', type=int, default=None,
+                        help='Stream the raw ProteinNet files and save them in shards of this many proteins, '
+                             'which keeps memory bounded for very large files.')
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='Directory for intermediate result shards. Re-running with the same directory resumes '
+                             'the conversion, skipping structures that were already processed. Defaults to '
+                             '<input_dir>/processed.')
+    parser.add_argument('--shard_size', type=int, default=500,
+                        help='Number of processed structures to record in each intermediate result shard.')
+    parser.add_argument('--structure_cache', type=str, default=None,
+                        help='Directory for the cache of parsed structures from --pdb_dir. Defaults to '
+                             '<pdb_dir>/parsed_cache.')
+    parser.add_argument('--no_structure_cache', action='store_true',
+                        help='Parse every structure file directly instead of using the parsed structure cache.')
     args = parser.parse_args()
 
     VALID_SPLITS = [10, 20, 30, 40, 50, 70, 90]
@@ -421,6 +534,11 @@ if __name__ == "__main__":
     CASP_VERSION = match.group(0)
 
     pr.pathPDBFolder(args.pdb_dir)  # Set PDB download location
+    if args.no_structure_cache:
+        STRUCTURE_CACHE = None
+    else:
+        STRUCTURE_CACHE = StructureCache(args.structure_cache if args.structure_cache else
+                                         os.path.join(args.pdb_dir, "parsed_cache"), args.pdb_dir)
     np.set_printoptions(suppress=True)  # suppresses scientific notation when printing
     np.set_printoptions(threshold=sys.maxsize)  # suppresses '...' when printing
 
@@ -18,6 +18,9 @@ ERROR_CODES = [("SEQUENCE_ERRORS", "structures failed because of an unresolvable
                ("NONE_CHAINS", "chains became none when parsing."),
                ("COORDSET_INDEX_ERROR", "structures failed to correctly select ACSIndex.")]
 
+# Errors that may not recur if the structure is processed again, i.e. failed downloads or interrupted file reads.
+TRANSIENT_ERRORS = ["PARSING_ERROR_OSERROR", "UNKNOWN_EXCEPTIONS", "NONE_CHAINS", "NONE_STRUCTURE_ERRORS"]
+
 
 class ProteinErrors(object):
     """
@@ -71,6 +74,10 @@ class ProteinErrors(object):
         error_code = self[error_name]
         return self.counts[error_code]
 
+    def is_transient(self, error_code):
+        """ Returns True iff the error code is one of the TRANSIENT_ERRORS, which are worth retrying. """
+        return error_code in {self[name] for name in TRANSIENT_ERRORS}
+
     def get_error_names(self):
         """ Returns a list of error names. """
         return self.name_to_code.keys()
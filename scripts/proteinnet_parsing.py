@@ -2,11 +2,16 @@
 https://github.com/aqlaboratory/proteinnet. """
 
 import os
+from functools import partial
 from glob import glob
 import multiprocessing
 
+import numpy as np
 import torch
 
+DSSP_DICT = {'L': 0, 'H': 1, 'B': 2, 'E': 3, 'G': 4, 'I': 5, 'T': 6, 'S': 7}
+MASK_DICT = {'-': 0, '+': 1}
+
 
 def load_ids_from_text_files(directory, train_file):
     """
@@ -30,8 +35,8 @@ def read_protein_from_file(file_pointer, include_tertiary):
     Hallgren.
     """
     dict_ = {}
-    _dssp_dict = {'L': 0, 'H': 1, 'B': 2, 'E': 3, 'G': 4, 'I': 5, 'T': 6, 'S': 7}
-    _mask_dict = {'-': 0, '+': 1}
+    _dssp_dict = DSSP_DICT
+    _mask_dict = MASK_DICT
 
     while True:
         next_line = file_pointer.readline()
@@ -64,6 +69,135 @@ def read_protein_from_file(file_pointer, include_tertiary):
             return None
 
 
+def read_numeric_block(file_pointer, n_rows, dtype=np.float32):
+    """
+    Reads n_rows whitespace-delimited lines from file_pointer and decodes them
+    with a single numpy call, rather than converting each value with float().
+    Returns an (n_rows x L) array, where L is 0 for an empty record.
+    """
+    block = "".join([file_pointer.readline() for _ in range(n_rows)])
+    if not block.strip():
+        return np.zeros((n_rows, 0), dtype=dtype)
+    return np.fromstring(block, dtype=dtype, sep=" ").reshape(n_rows, -1)
+
+
+def read_protein_record(file_pointer, include_tertiary, include_evolutionary=True):
+    """
+    A faster version of read_protein_from_file. Numeric blocks ([EVOLUTIONARY]
+    and [TERTIARY]) are decoded in bulk into numpy arrays, and sections that are
+    not requested are skipped without being decoded. Returns None at the end of
+    the file.
+    """
+    record = {}
+    while True:
+        next_line = file_pointer.readline()
+        if next_line == '[ID]\n':
+            record['id'] = file_pointer.readline()[:-1]
+        elif next_line == '[PRIMARY]\n':
+            record['primary'] = file_pointer.readline()[:-1]
+        elif next_line == '[EVOLUTIONARY]\n':
+            if include_evolutionary:
+                record['evolutionary'] = read_numeric_block(file_pointer, 21)
+            else:
+                for _ in range(21):
+                    file_pointer.readline()
+        elif next_line == '[SECONDARY]\n':
+            record['secondary'] = [DSSP_DICT[dssp] for dssp in file_pointer.readline()[:-1]]
+        elif next_line == '[TERTIARY]\n':
+            if include_tertiary:
+                record['tertiary'] = read_numeric_block(file_pointer, 3)
+            else:
+                for _ in range(3):
+                    file_pointer.readline()
+        elif next_line == '[MASK]\n':
+            record['mask'] = [MASK_DICT[aa] for aa in file_pointer.readline()[:-1]]
+        elif next_line == '\n':
+            return record
+        elif next_line == '':
+            return record if record else None
+
+
+def iter_proteins_from_file(input_filename, include_tertiary=False, include_evolutionary=True):
+    """
+    Lazily yields one parsed ProteinNet record (a dictionary, see
+    read_protein_record) at a time from a raw ProteinNet file. Only a single
+    record is held in memory at once.
+    """
+    with open(input_filename, "r") as input_file:
+        while True:
+            record = read_protein_record(input_file, include_tertiary, include_evolutionary)
+            if record is None:
+                return
+            yield record
+
+
+def shard_index_path(torch_dict_dir, name):
+    """
+    Returns the path of the index file that lists the shards of a sharded,
+    preprocessed ProteinNet file. The index is written last, so its existence
+    means that all shards were written successfully.
+    """
+    return os.path.join(torch_dict_dir, name.replace(".pt", "") + ".shards")
+
+
+def process_file_sharded(input_filename, torch_dict_dir, shard_size):
+    """
+    A bounded-memory alternative to process_file. Streams records from one raw
+    ProteinNet file and writes them to disk in shards of shard_size proteins,
+    each a Pytorch-saved dictionary mapping ProteinNet IDs to records.
+    """
+    print("    " + input_filename)
+    name = os.path.basename(input_filename)
+    shard_names = []
+    shard = {}
+
+    def write_shard():
+        shard_name = f"{name}.{len(shard_names):05}.pt"
+        torch.save(shard, os.path.join(torch_dict_dir, shard_name))
+        shard_names.append(shard_name)
+
+    with open(input_filename + '.ids', "w") as text_file:
+        for record in iter_proteins_from_file(input_filename, include_tertiary=False):
+            id_ = record.pop("id")
+            shard[id_] = record
+            text_file.write(f"{id_}\n")
+            if len(shard) == shard_size:
+                write_shard()
+                shard = {}
+    if shard or not shard_names:
+        write_shard()
+    with open(shard_index_path(torch_dict_dir, name), "w") as index_file:
+        index_file.write("\n".join(shard_names) + "\n")
+    print(f"{input_filename} finished.")
+
+
+def iter_preprocessed_shards(torch_dict_dir, name):
+    """
+    Yields, one shard at a time, the dictionaries of a preprocessed ProteinNet
+    file (i.e. 'training_100.pt'), whether it was saved whole or in shards.
+    """
+    single_file = os.path.join(torch_dict_dir, name)
+    if os.path.exists(single_file):
+        yield torch.load(single_file, weights_only=False)
+        return
+    with open(shard_index_path(torch_dict_dir, name), "r") as index_file:
+        for shard_name in index_file.read().splitlines():
+            yield torch.load(os.path.join(torch_dict_dir, shard_name), weights_only=False)
+
+
+def load_preprocessed_sequences(torch_dict_dir, name, ids=None):
+    """
+    Returns a dictionary mapping ProteinNet IDs to primary sequences for a
+    preprocessed ProteinNet file, reading one shard at a time so that only
+    the sequences (of the requested ids, if provided) are held in memory.
+    """
+    ids = set(ids) if ids is not None else None
+    sequences = {}
+    for shard in iter_preprocessed_shards(torch_dict_dir, name):
+        sequences.update({pnid: record["primary"] for pnid, record in shard.items() if ids is None or pnid in ids})
+    return sequences
+
+
 def process_file(input_filename):
     """
     A parallelizable method for processing one raw ProteinNet file and
@@ -88,16 +222,20 @@ def process_file(input_filename):
     print(f"{input_filename} finished.")
 
 
-def parse_raw_proteinnet(input_dir, train_file):
+def parse_raw_proteinnet(input_dir, train_file, shard_size=None):
     """
     Preprocesses raw ProteinNet records by reading them and transforming them
     into a Pytorch-saved dictionary. It excludes the tertiary information as
-    this will acquired from the PDB.
+    this will acquired from the PDB. If shard_size is provided, each file is
+    streamed and saved in shards of that many proteins (see
+    process_file_sharded) so that very large files can be parsed in bounded
+    memory.
     """
     global torch_dict_dir
     # Test for .pt files existance, return ids and exit if already complete
     torch_dict_dir = os.path.join(input_dir, "torch/")
-    if os.path.exists(os.path.join(torch_dict_dir, train_file)):
+    if os.path.exists(os.path.join(torch_dict_dir, train_file)) or \
+            os.path.exists(shard_index_path(torch_dict_dir, train_file)):
         print("Raw ProteinNet files already preprocessed.")
         train_ids, valid_ids, test_ids = load_ids_from_text_files(torch_dict_dir.replace("/torch", "/raw"), train_file)
         return train_ids, valid_ids, test_ids
@@ -110,6 +248,9 @@ def parse_raw_proteinnet(input_dir, train_file):
     print("Preprocessing raw ProteinNet files...")
 
     with multiprocessing.Pool(multiprocessing.cpu_count()) as p:
-        p.map(process_file, input_files)
+        if shard_size:
+            p.map(partial(process_file_sharded, torch_dict_dir=torch_dict_dir, shard_size=shard_size), input_files)
+        else:
+            p.map(process_file, input_files)
     print("Done.")
-    return parse_raw_proteinnet(input_dir, train_file)
\ No newline at end of file
+    return parse_raw_proteinnet(input_dir, train_file, shard_size)
@@ -0,0 +1,167 @@
+"""
+A local, content-addressed cache of parsed PDB/mmCIF structures.
+
+Parsing a structure file with ProDy is one of the most expensive steps of
+converting ProteinNet into PyTorch format, and the same entry is often parsed
+many times (once per chain or model that ProteinNet references, and once more
+for every repeated conversion). This module parses each file from a local PDB
+mirror once and records the result as a set of flat NumPy arrays (coordinates,
+atom names, residue names/numbers, chain IDs, etc.) in an .npz file named by
+the SHA-1 digest of the original file's contents. Later requests for any chain
+of that entry rebuild a ProDy AtomGroup directly from those arrays, skipping
+text parsing entirely. No network access is required.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import prody as pr
+
+# Candidate file names for a PDB ID within a local mirror, in order of preference. "{mid}" refers to the middle two
+# characters of the PDB ID, which is used by divided mirrors of the PDB (i.e. "a9/pdb1a9u.ent.gz").
+STRUCTURE_FILE_PATTERNS = [("{id}.pdb.gz", "pdb"), ("{id}.pdb", "pdb"), ("pdb{id}.ent.gz", "pdb"),
+                           ("pdb{id}.ent", "pdb"), ("{mid}/pdb{id}.ent.gz", "pdb"), ("{mid}/{id}.pdb.gz", "pdb"),
+                           ("{id}.cif.gz", "cif"), ("{id}.cif", "cif"), ("{mid}/{id}.cif.gz", "cif")]
+
+# Per-atom data recorded for each structure, named according to ProDy's get/set methods (i.e. getNames/setNames)
+ATOM_DATA_FIELDS = ["Names", "Resnames", "Resnums", "Chids", "Icodes", "Altlocs", "Serials", "Segnames", "Elements",
+                    "Betas", "Occupancies"]
+ATOM_FLAG_FIELDS = ["hetatm", "pdbter"]
+
+
+def find_local_structure_file(pdbid, pdb_dir):
+    """
+    Returns the path and format ("pdb" or "cif") of the structure file for pdbid within the local mirror pdb_dir.
+    PDB formatted files are preferred to mmCIF files, matching the order in which they are parsed during
+    preprocessing. Returns (None, None) if no file is available locally.
+    """
+    pdbid = pdbid.lower()
+    for pattern, fmt in STRUCTURE_FILE_PATTERNS:
+        for pid in (pdbid, pdbid.upper()):
+            path = os.path.join(pdb_dir, pattern.format(id=pid, mid=pid[1:3]))
+            if os.path.isfile(path):
+                return path, fmt
+    return None, None
+
+
+def file_digest(path):
+    """
+    Returns the SHA-1 hex digest of the contents of the file at path.
+    """
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def atomgroup_to_arrays(atomgroup):
+    """
+    Returns a dictionary of NumPy arrays describing every atom and coordinate set of a ProDy AtomGroup.
+    """
+    arrays = {"coordsets": atomgroup.getCoordsets().astype(np.float32)}
+    for field in ATOM_DATA_FIELDS:
+        data = getattr(atomgroup, "get" + field)()
+        if data is not None:
+            arrays[field] = data
+    for flag in ATOM_FLAG_FIELDS:
+        data = atomgroup.getFlags(flag)
+        if data is not None:
+            arrays["flag_" + flag] = data
+    return arrays
+
+
+def arrays_to_atomgroup(arrays, title, mask=None):
+    """
+    Rebuilds a ProDy AtomGroup from the arrays produced by atomgroup_to_arrays. If a boolean mask is provided,
+    only the selected atoms are included.
+    """
+    if mask is None:
+        mask = slice(None)
+    atomgroup = pr.AtomGroup(title)
+    atomgroup.setCoords(arrays["coordsets"][:, mask].astype(np.float64))
+    for field in ATOM_DATA_FIELDS:
+        if field in arrays:
+            getattr(atomgroup, "set" + field)(arrays[field][mask])
+    for flag in ATOM_FLAG_FIELDS:
+        if "flag_" + flag in arrays:
+            atomgroup.setFlags(flag, arrays["flag_" + flag][mask])
+    return atomgroup
+
+
+class StructureCache(object):
+    """
+    Parses structure files from a local PDB mirror and caches the parsed result on disk, keyed by the digest of the
+    file's contents. Recently used structures are also kept in memory so that several chains from the same entry
+    can be retrieved without touching the disk.
+    """
+
+    def __init__(self, cache_dir, pdb_dir, max_in_memory=8):
+        self.cache_dir = cache_dir
+        self.pdb_dir = pdb_dir
+        self.max_in_memory = max_in_memory
+        self._recent = OrderedDict()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _cache_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest + ".npz")
+
+    def _parse(self, path, fmt):
+        """ Parses the full structure file with ProDy, returning None if it could not be parsed. """
+        if fmt == "pdb":
+            return pr.parsePDB(path)
+        return pr.parseCIF(path)
+
+    def _write(self, cache_path, arrays):
+        """ Saves arrays to cache_path, using a rename so that partially written files are never read. """
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, cache_path)
+
+    def load_arrays(self, pdbid):
+        """
+        Returns the cached arrays describing the structure of pdbid, parsing the local file and adding it to the cache
+        if needed. Returns None if no local file exists or if it could not be parsed.
+        """
+        path, fmt = find_local_structure_file(pdbid, self.pdb_dir)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key in self._recent:
+            self._recent.move_to_end(key)
+            return self._recent[key]
+
+        cache_path = self._cache_path(file_digest(path))
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as data:
+                arrays = {k: data[k] for k in data.files}
+        else:
+            atomgroup = self._parse(path, fmt)
+            if atomgroup is None:
+                return None
+            arrays = atomgroup_to_arrays(atomgroup)
+            self._write(cache_path, arrays)
+
+        self._recent[key] = arrays
+        if len(self._recent) > self.max_in_memory:
+            self._recent.popitem(last=False)
+        return arrays
+
+    def get_chain(self, pdbid, chid):
+        """
+        Returns a ProDy AtomGroup containing only chain chid of the structure pdbid, equivalent to
+        pr.parsePDB(pdbid, chain=chid). Returns None if the structure is not available locally or the chain does not
+        exist.
+        """
+        arrays = self.load_arrays(pdbid)
+        if arrays is None:
+            return None
+        mask = arrays["Chids"] == chid
+        if not mask.any():
+            return None
+        return arrays_to_atomgroup(arrays, f"{pdbid}_{chid}", mask)
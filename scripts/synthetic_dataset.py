@@ -0,0 +1,325 @@
+"""
+    Generates synthetic protein structure datasets with the same schema as the
+    ProteinNet-derived datasets created by proteinnet2pytorch.py.
+
+    Each synthetic protein is made by sampling a sequence and a realistic set
+    of angles, building its full-atom structure with StructureBuilder, and then
+    measuring its angles and coordinates with the same conventions (and the
+    same missing-data padding) used when converting real structures. Protein
+    lengths and angle statistics may be taken from an existing dataset's
+    settings (its length histogram and "angle_means"), or from built-in
+    defaults. Proteins are generated in parallel and deterministically from a
+    seed, so datasets of millions of residues can be made for load-testing
+    training and inference without the real data.
+
+    Usage:
+        python synthetic_dataset.py -o ../data/proteinnet/synthetic.pt --num_train 10000
+        python synthetic_dataset.py -o synthetic.pt --train_residues 5000000 --reference casp12.pt
+"""
+
+import argparse
+import datetime
+import multiprocessing
+
+import numpy as np
+import torch
+import tqdm
+
+from protein_transformer.dataset import MAX_SEQ_LEN, VALID_SPLITS
+from protein_transformer.protein.Sequence import ONE_TO_THREE_LETTER_MAP
+from protein_transformer.protein.SidechainBuildInfo import SC_BUILD_INFO
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, NUM_PREDICTED_COORDS
+from protein_transformer.protein.StructureBuilder import StructureBuilder
+from protein_transformer.protein.structure_utils import GLOBAL_PAD_CHAR, measure_angles_from_coords
+import proteinnet2pytorch
+
+# Background amino acid frequencies (%) of UniProtKB/Swiss-Prot
+AMINO_ACID_FREQUENCIES = {"A": 8.25, "R": 5.53, "N": 4.06, "D": 5.45, "C": 1.37, "Q": 3.93, "E": 6.75, "G": 7.07,
+                          "H": 2.27, "I": 5.96, "L": 9.66, "K": 5.84, "M": 2.42, "F": 3.86, "P": 4.70, "S": 6.56,
+                          "T": 5.34, "W": 1.08, "Y": 2.92, "V": 6.87}
+
+# Default angle distributions, as mixtures of von Mises components [(weight, mean, concentration), ...], one per
+# predicted angle. Phi and psi are sampled jointly from Ramachandran basins (alpha, beta, polyproline II and
+# left-handed helix) that persist over runs of residues, so they are described separately. The CB torsion is
+# determined by the backbone for L-amino acids, so it is not sampled at all.
+RAMACHANDRAN_BASINS = [(0.45, -1.10, -0.75), (0.35, -2.09, 2.27), (0.15, -1.31, 2.53), (0.05, 1.00, 0.80)]
+RAMACHANDRAN_KAPPA = 15
+MEAN_SECONDARY_STRUCTURE_RUN = 8
+ROTAMERS = [(0.35, -1.05, 20), (0.45, np.pi, 20), (0.20, 1.05, 20)]
+DEFAULT_ANGLE_MIXTURES = [None,                   # phi, sampled from RAMACHANDRAN_BASINS
+                          None,                   # psi, sampled from RAMACHANDRAN_BASINS
+                          [(1., np.pi, 200)],     # omega
+                          [(1., 1.94, 1000)],     # N-CA-C
+                          [(1., 2.03, 1000)],     # CA-C-N
+                          [(1., 2.13, 1000)],     # C-N-CA
+                          None] + [ROTAMERS] * (NUM_PREDICTED_ANGLES - 7)
+
+# StructureBuilder places CB with the torsion N(i+1)-C-CA-CB, or C(i-1)-N-CA-CB for the last residue. For
+# L-amino acids, these are offset from psi and phi, respectively, by the following amounts (measured from 1UBI).
+CB_TORSION_PSI_OFFSET = 2.19
+CB_TORSION_PHI_OFFSET = -2.18
+
+DEFAULT_MEAN_LENGTH = 180
+DEFAULT_LENGTH_SIGMA = 0.6
+MEAN_MISSING_SEGMENT_LENGTH = 5
+
+
+def kappa_from_mean_resultant_length(r):
+    """
+    Returns the approximate maximum likelihood estimate of the von Mises concentration parameter, given the mean
+    resultant length r of a sample of angles (Best & Fisher, 1981).
+    """
+    r = min(r, 1 - 1e-6)
+    if r < 0.53:
+        return 2 * r + r ** 3 + 5 * r ** 5 / 6
+    elif r < 0.85:
+        return -0.4 + 1.39 * r + 0.43 / (1 - r)
+    return 1 / (r ** 3 - 4 * r ** 2 + 3 * r)
+
+
+def angle_mixtures_from_means(angle_means):
+    """
+    Given a dataset's "angle_means" setting (the mean cosine and sine of each angle, [cos sin cos sin ...]), returns
+    angle mixtures in the format of DEFAULT_ANGLE_MIXTURES with a single von Mises component per angle. Phi and psi
+    are then sampled independently rather than from RAMACHANDRAN_BASINS.
+    """
+    angle_means = np.asarray(angle_means).reshape(NUM_PREDICTED_ANGLES, 2)
+    mixtures = []
+    for i, (cos, sin) in enumerate(angle_means):
+        if i == 6:
+            mixtures.append(None)
+            continue
+        mixtures.append([(1., float(np.arctan2(sin, cos)), kappa_from_mean_resultant_length(np.hypot(cos, sin)))])
+    return mixtures
+
+
+def sample_from_mixture(mixture, size, rng):
+    """ Samples size angles (in [-pi, pi]) from a mixture of von Mises components. """
+    weights = np.asarray([w for w, _, _ in mixture])
+    components = rng.choice(len(mixture), size=size, p=weights / weights.sum())
+    angles = np.empty(size)
+    for i, (_, mu, kappa) in enumerate(mixture):
+        selected = components == i
+        angles[selected] = rng.vonmises(mu, kappa, selected.sum())
+    return angles
+
+
+def sample_sequence(length, rng):
+    """ Samples a random protein sequence of the given length, following AMINO_ACID_FREQUENCIES. """
+    letters = list(AMINO_ACID_FREQUENCIES.keys())
+    probs = np.asarray(list(AMINO_ACID_FREQUENCIES.values()))
+    return "".join(rng.choice(letters, size=length, p=probs / probs.sum()))
+
+
+def sample_angles(length, rng, angle_mixtures=None):
+    """
+    Samples a set of angles (L x NUM_PREDICTED_ANGLES) in radians for a protein of the given length, suitable for
+    building a structure with StructureBuilder. If angle_mixtures is None, DEFAULT_ANGLE_MIXTURES are used.
+    """
+    angle_mixtures = angle_mixtures or DEFAULT_ANGLE_MIXTURES
+    ang = np.empty((length, NUM_PREDICTED_ANGLES))
+    for i, mixture in enumerate(angle_mixtures):
+        if mixture is not None:
+            ang[:, i] = sample_from_mixture(mixture, length, rng)
+
+    # Sample phi/psi from Ramachandran basins that persist over runs of residues, as in secondary structure elements
+    if angle_mixtures[0] is None:
+        basin_weights = np.asarray([w for w, _, _ in RAMACHANDRAN_BASINS])
+        run_lengths = rng.geometric(1 / MEAN_SECONDARY_STRUCTURE_RUN, size=length)
+        run_basins = rng.choice(len(RAMACHANDRAN_BASINS), size=length, p=basin_weights / basin_weights.sum())
+        basins = np.repeat(run_basins, run_lengths)[:length]
+        means = np.asarray([[phi, psi] for _, phi, psi in RAMACHANDRAN_BASINS])[basins]
+        ang[:, 0] = rng.vonmises(means[:, 0], RAMACHANDRAN_KAPPA)
+        ang[:, 1] = rng.vonmises(means[:, 1], RAMACHANDRAN_KAPPA)
+
+    # The CB torsion places CB as in an L-amino acid
+    ang[:-1, 6] = ang[:-1, 1] + CB_TORSION_PSI_OFFSET
+    ang[-1, 6] = ang[-1, 0] + CB_TORSION_PHI_OFFSET
+    return np.arctan2(np.sin(ang), np.cos(ang))
+
+
+def sample_missing_residues(length, missing_rate, rng):
+    """
+    Returns a boolean mask (L) that is True for residues whose structure is unobserved. Missing residues occur in
+    segments, covering about missing_rate of the protein on average. The first and last residues may be missing,
+    but at least 2 residues are always observed.
+    """
+    missing = np.zeros(length, dtype=bool)
+    if missing_rate <= 0:
+        return missing
+    n_segments = rng.poisson(missing_rate * length / MEAN_MISSING_SEGMENT_LENGTH)
+    for start, seg_len in zip(rng.randint(0, length, n_segments),
+                              rng.geometric(1 / MEAN_MISSING_SEGMENT_LENGTH, n_segments)):
+        missing[start:start + seg_len] = True
+    if (~missing).sum() < 2:
+        missing[:] = False
+    return missing
+
+
+def make_synthetic_protein(length, seed, angle_mixtures=None, missing_rate=0.):
+    """
+    Creates a single synthetic protein. Returns (angles, coordinates, sequence), where angles (L x
+    NUM_PREDICTED_ANGLES) and coordinates ((L x NUM_PREDICTED_COORDS) x 3) were measured from the built structure and
+    contain GLOBAL_PAD_CHAR for missing data, exactly as in datasets created by proteinnet2pytorch.py.
+    """
+    rng = np.random.RandomState(seed)
+    seq = sample_sequence(length, rng)
+    ang = sample_angles(length, rng, angle_mixtures)
+    with torch.no_grad():
+        coords = StructureBuilder(seq, torch.tensor(ang, dtype=torch.float32)).build()
+    coords = coords.numpy().astype(np.float64).reshape(length, NUM_PREDICTED_COORDS, 3)
+
+    # Remove padding atoms and unobserved residues, then measure the structure as if it were real
+    resnames = np.asarray([ONE_TO_THREE_LETTER_MAP[aa] for aa in seq])
+    n_atoms = np.asarray([4 + len(SC_BUILD_INFO[rn]["atom-names"]) for rn in resnames])
+    coords[np.arange(NUM_PREDICTED_COORDS)[None] >= n_atoms[:, None]] = GLOBAL_PAD_CHAR
+    coords[sample_missing_residues(length, missing_rate, rng)] = GLOBAL_PAD_CHAR
+    dihedrals = measure_angles_from_coords(coords, resnames)
+
+    return dihedrals, coords.reshape(-1, 3), seq
+
+
+def _synthetic_protein_work(length_seed_mixtures_missing):
+    """ Unpacks arguments for make_synthetic_protein. Useful for Pool.imap(). """
+    return make_synthetic_protein(*length_seed_mixtures_missing)
+
+
+def _init_worker():
+    # Each worker builds one structure at a time, so intra-op parallelism only adds overhead
+    torch.set_num_threads(1)
+
+
+def sample_lengths(rng, num_proteins=None, num_residues=None, bin_data=None, min_len=20, max_len=MAX_SEQ_LEN):
+    """
+    Samples protein lengths, either num_proteins of them, or as many as needed to reach a total of num_residues.
+    Lengths follow the histogram in bin_data (a dataset's "bin-data" setting) if provided, or a log-normal
+    distribution otherwise, and are limited to [min_len, max_len].
+    """
+    def sample(n):
+        if bin_data is not None:
+            edges = np.concatenate(([min_len - 1], np.asarray(bin_data["hist_bins"], dtype=float)))
+            bins = rng.choice(len(bin_data["bin_probs"]), size=n, p=bin_data["bin_probs"])
+            lengths = np.floor(rng.uniform(edges[bins], edges[bins + 1])).astype(int) + 1
+        else:
+            lengths = np.rint(rng.lognormal(np.log(DEFAULT_MEAN_LENGTH), DEFAULT_LENGTH_SIGMA, n)).astype(int)
+        return np.clip(lengths, min_len, max_len)
+
+    if num_proteins is not None:
+        return sample(num_proteins)
+    lengths = []
+    total = 0
+    while total < num_residues:
+        new = sample(max(1, (num_residues - total) // DEFAULT_MEAN_LENGTH + 1))
+        new = new[:np.searchsorted(np.cumsum(new), num_residues - total) + 1]
+        lengths.append(new)
+        total += new.sum()
+    return np.concatenate(lengths)
+
+
+def generate_proteins(lengths, seed, angle_mixtures=None, missing_rate=0., pool=None, desc=None):
+    """
+    Generates a synthetic protein for each length in lengths. Returns lists of (sequences, angles, coordinates).
+    Protein i is always generated from the same random seed (derived from seed and i), so results do not depend on
+    whether or not a worker pool is used.
+    """
+    seeds = np.random.SeedSequence(seed).generate_state(len(lengths))
+    tasks = [(int(l), int(s), angle_mixtures, missing_rate) for l, s in zip(lengths, seeds)]
+    if pool is not None:
+        results = pool.imap(_synthetic_protein_work, tasks, chunksize=max(1, min(64, len(tasks) // 256)))
+    else:
+        results = map(_synthetic_protein_work, tasks)
+    seqs, angs, crds = [], [], []
+    for ang, crd, seq in tqdm.tqdm(results, total=len(tasks), desc=desc, disable=desc is None):
+        seqs.append(seq)
+        angs.append(ang)
+        crds.append(crd)
+    return seqs, angs, crds
+
+
+def create_synthetic_data_dict(num_train=None, num_valid=10, num_test=10, train_residues=None, seed=0,
+                               reference_settings=None, missing_rate=0., min_len=20, max_len=MAX_SEQ_LEN,
+                               num_workers=1, verbose=False):
+    """
+    Creates a synthetic dataset dictionary with the same schema as proteinnet2pytorch.create_data_dict. The training
+    set contains num_train proteins, or as many proteins as are needed to reach train_residues residues. Each
+    validation split contains num_valid proteins, and the test set contains num_test proteins.
+
+    If reference_settings (the "settings" of an existing dataset) is provided, protein lengths and angle
+    distributions follow its "bin-data" and "angle_means".
+    """
+    rng = np.random.RandomState(seed)
+    bin_data, angle_mixtures = None, None
+    if reference_settings is not None:
+        bin_data = reference_settings.get("bin-data")
+        if reference_settings.get("angle_means") is not None:
+            angle_mixtures = angle_mixtures_from_means(reference_settings["angle_means"])
+
+    def make_split(name, split_seed, **kwargs):
+        lengths = sample_lengths(rng, bin_data=bin_data, min_len=min_len, max_len=max_len, **kwargs)
+        return generate_proteins(lengths, [seed, split_seed], angle_mixtures, missing_rate, pool,
+                                 desc=name if verbose else None)
+
+    pool = multiprocessing.Pool(num_workers, initializer=_init_worker) if num_workers > 1 else None
+    try:
+        if train_residues is not None:
+            train_seq, train_ang, train_crd = make_split("train", 0, num_residues=train_residues)
+        else:
+            train_seq, train_ang, train_crd = make_split("train", 0, num_proteins=num_train)
+        train_ids = [f"SYN{i}_1_A" for i in range(len(train_seq))]
+        all_validation_data = {}
+        for i, split in enumerate(VALID_SPLITS):
+            seq, ang, crd = make_split(f"valid-{split}", i + 1, num_proteins=num_valid)
+            all_validation_data[split] = (seq, ang, crd, [f"{split}#SYNV{j}_1_A" for j in range(num_valid)])
+        test_seq, test_ang, test_crd = make_split("test", len(VALID_SPLITS) + 1, num_proteins=num_test)
+        test_ids = [f"SYNT{i}" for i in range(num_test)]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    data = proteinnet2pytorch.create_data_dict(train_seq, test_seq, train_ang, test_ang, train_crd, test_crd,
+                                               train_ids, test_ids, all_validation_data, casp_version="synthetic")
+    data["description"] = {f"Synthetic proteins (seed {seed})"}
+    data = proteinnet2pytorch.add_proteinnetID_to_idx_mapping(data, VALID_SPLITS)
+    return data
+
+
+def main():
+    reference_settings = None
+    if args.reference:
+        reference_settings = torch.load(args.reference)["settings"]
+    data = create_synthetic_data_dict(num_train=args.num_train, num_valid=args.num_valid, num_test=args.num_test,
+                                      train_residues=args.train_residues, seed=args.seed,
+                                      reference_settings=reference_settings, missing_rate=args.missing_rate,
+                                      min_len=args.min_len, max_len=args.max_len, num_workers=args.num_workers,
+                                      verbose=True)
+    n_res = sum(map(len, data["train"]["seq"]))
+    print(f"Created {len(data['train']['seq'])} training proteins ({n_res} residues) on "
+          f"{datetime.datetime.now().strftime('%I:%M%p on %B %d, %Y')}.")
+    torch.save(data, args.out_file)
+    print(f"Data saved to {args.out_file}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates a synthetic protein structure dataset with the same "
+                                                 "format as the datasets created by proteinnet2pytorch.py.")
+    parser.add_argument("-o", "--out_file", type=str, required=True, help="Path to output file (.pt file).")
+    size_args = parser.add_mutually_exclusive_group()
+    size_args.add_argument("--num_train", type=int, default=1000, help="Number of training proteins.")
+    size_args.add_argument("--train_residues", type=int, default=None,
+                           help="Total number of training residues. Overrides --num_train.")
+    parser.add_argument("--num_valid", type=int, default=10, help="Number of proteins in each validation split.")
+    parser.add_argument("--num_test", type=int, default=10, help="Number of test proteins.")
+    parser.add_argument("--reference", type=str, default=None,
+                        help="Path to an existing dataset. Protein lengths and angle distributions follow its "
+                             "settings. By default, built-in distributions are used.")
+    parser.add_argument("--missing_rate", type=float, default=0.,
+                        help="Average fraction of residues whose structure is unobserved. Note that, by default, "
+                             "proteins with unobserved residues are not used for training.")
+    parser.add_argument("--min_len", type=int, default=20, help="Minimum protein length.")
+    parser.add_argument("--max_len", type=int, default=MAX_SEQ_LEN, help="Maximum protein length.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--num_workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of processes used to build structures.")
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,41 @@
+import json
+import sys
+sys.path.append("scripts")
+
+from benchmark import case_key, compare_results, run_benchmarks
+
+
+def make_results(medians):
+    return {"environment": {}, "results": {k: {"median": v} for k, v in medians.items()}}
+
+
+def test_case_key():
+    assert case_key("attention", {"length": 64, "heads": 8}) == "attention[heads=8,length=64]"
+
+
+def test_compare_results():
+    baseline = make_results({"a": 1.0, "b": 1.0, "c": 1.0, "only_in_baseline": 1.0})
+    current = make_results({"a": 1.05, "b": 1.5, "c": 0.5, "only_in_current": 1.0})
+    current["results"]["skipped"] = {"skipped": "No module named 'pymol'"}
+    baseline["results"]["skipped"] = {"median": 1.0}
+    rows = compare_results(baseline, current, threshold=0.1)
+    assert [(key, status) for key, _, _, _, status in rows] == [("a", "ok"), ("b", "regression"),
+                                                                 ("c", "improvement")]
+    assert rows[1][3] == 1.5
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(only=r"^collate_fn|^nerf\[batch=1\]", quick=True, repeat=2, min_time=0, verbose=False)
+    assert set(results["results"]) == {"collate_fn[batch=32,length=500]", "nerf[batch=1]"}
+    for r in results["results"].values():
+        assert r["min"] <= r["median"] and r["repeat"] == 2 and r["number"] >= 1
+    assert "torch" in results["environment"]
+    json.dumps(results)
+    rows = compare_results(results, results)
+    assert all(row[-1] == "ok" for row in rows)
+
+
+def test_run_benchmarks_with_pool():
+    results = run_benchmarks(only="pool=True", quick=True, repeat=1, min_time=0, workers=2, verbose=False)
+    assert list(results["results"]) == ["compute_batch_drmsd[batch=8,length=64,pool=True]"]
+    assert results["results"]["compute_batch_drmsd[batch=8,length=64,pool=True]"]["median"] > 0
@@ -0,0 +1,25 @@
+import sys
+sys.path.append("scripts")
+
+import torch
+
+from export_inference_checkpoint import get_size, verify_export
+from protein_transformer.inference import export_inference_checkpoint, load_model_from_checkpoint
+from protein_transformer.tests.helpers import make_small_model
+
+
+def test_export_is_smaller_and_equivalent(tmp_path):
+    model, args = make_small_model()
+    optimizer = torch.optim.Adam(model.parameters())
+    model(torch.randint(0, 20, (2, 10))).sum().backward()
+    optimizer.step()
+    checkpoint = str(tmp_path / "model.chkpt")
+    torch.save({"model_state_dict": model.state_dict(), "settings": args, "angle_means": model.angle_means,
+                "optimizer_state_dict": optimizer.state_dict(), "metrics": {"train": {"loss-history": [1.] * 10000}}},
+               checkpoint)
+
+    model, model_args = load_model_from_checkpoint(checkpoint)
+    export_inference_checkpoint(model, model_args, str(tmp_path / "export"))
+    assert get_size(str(tmp_path / "export")) < get_size(checkpoint)
+    max_diff, _ = verify_export(model, str(tmp_path / "export"))
+    assert max_diff == 0
@@ -0,0 +1,48 @@
+import asyncio
+import sys
+import threading
+sys.path.append("scripts")
+
+import numpy as np
+import pytest
+import torch
+
+from load_test_server import make_records, run_load_test, summarize
+from protein_transformer.models.encoder_only import EncoderOnlyTransformer
+from protein_transformer.protein.Sequence import VOCAB
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES
+from protein_transformer.server import PredictionServer
+
+
+@pytest.fixture
+def port():
+    torch.manual_seed(0)
+    model = EncoderOnlyTransformer(nlayers=1, nhead=2, dmodel=16, dff=32, max_seq_len=64, vocab=VOCAB,
+                                   angle_means=np.random.RandomState(0).uniform(-.9, .9, NUM_PREDICTED_ANGLES * 2),
+                                   use_tanh_out=True)
+    model.eval()
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    server = PredictionServer(model, max_wait_ms=20)
+    yield asyncio.run_coroutine_threadsafe(server.start("127.0.0.1", 0), loop).result().sockets[0].getsockname()[1]
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_summarize():
+    results = [(i / 1000, 200, 10) for i in range(1, 101)] + [(0.5, 400, 10)]
+    summary = summarize(results, seconds=2.0)
+    assert summary["num_requests"] == 101 and summary["num_errors"] == 1
+    assert summary["latency_ms"]["p50"] == pytest.approx(50.5)
+    assert summary["latency_ms"]["p99"] == pytest.approx(99.01)
+    assert summary["requests_per_second"] == 50 and summary["residues_per_second"] == 500
+
+
+def test_run_load_test(port):
+    records = make_records(40, 5, 100)
+    summary = asyncio.run(run_load_test("127.0.0.1", port, records, concurrency=8))
+    assert summary["num_requests"] == 40 and summary["num_errors"] == 0
+    assert 0 < summary["latency_ms"]["p50"] <= summary["latency_ms"]["p99"]
@@ -0,0 +1,125 @@
+import sys
+import threading
+sys.path.append("scripts")
+
+import numpy as np
+import pytest
+import torch
+
+import predict_fasta as predict_fasta_module
+from predict_fasta import make_batches, predict_fasta, read_fasta
+from protein_transformer.inference import load_model_from_checkpoint
+from protein_transformer.prediction_cache import PredictionCache, model_digest
+from protein_transformer.tests.helpers import make_small_model
+
+
+def write_fasta(path, records):
+    with open(path, "w") as f:
+        for pid, seq in records:
+            f.write(f">{pid} some description\n")
+            for i in range(0, len(seq), 60):
+                f.write(seq[i:i + 60] + "\n")
+
+
+def random_seq(rng, length):
+    return "".join(rng.choice(list("ACDEFGHIKLMNPQRSTVWY"), length))
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    model, args = make_small_model()
+    path = str(tmp_path / "model.chkpt")
+    torch.save({"model_state_dict": model.state_dict(), "settings": args}, path)
+    return path
+
+
+def test_read_fasta(tmp_path):
+    records = [("sp|P1|A", "MKV" * 30), ("B", "ACD"), ("C", "")]
+    write_fasta(tmp_path / "a.fasta", records[:2])
+    write_fasta(tmp_path / "b.fasta", records[2:])
+    assert list(read_fasta([tmp_path / "a.fasta", tmp_path / "b.fasta"])) == records
+
+
+def test_make_batches():
+    rng = np.random.RandomState(0)
+    records = [(str(i), random_seq(rng, l)) for i, l in enumerate(rng.randint(5, 120, 200))]
+    records.append(("long", random_seq(rng, 300)))
+    batches = list(make_batches(iter(records), max_tokens=500, max_batch_size=16, buffer_size=64, max_len=200))
+    assert sorted(pid for b in batches for pid, _ in b) == sorted(pid for pid, _ in records)
+    for b in batches:
+        assert len(b) <= 16
+        assert len(b) == 1 or max(len(s) for _, s in b) * len(b) <= 500
+    assert [("long", records[-1][1])] in batches
+
+
+def test_load_model_from_checkpoint(checkpoint):
+    model, args = load_model_from_checkpoint(checkpoint)
+    assert args.model == "enc-only" and not model.training
+    state = torch.load(checkpoint, weights_only=False)["model_state_dict"]
+    assert torch.equal(model.output_projection.bias, state["output_projection.bias"])
+
+
+@pytest.mark.parametrize("build_workers", [0, 2])
+def test_predict_fasta(checkpoint, tmp_path, build_workers):
+    rng = np.random.RandomState(1)
+    records = [(f"prot{i}", random_seq(rng, l)) for i, l in enumerate([12, 30, 31, 45, 600])]
+    records += [("nonstandard", "MKXV")]
+    write_fasta(tmp_path / "in.fasta", records)
+    model, model_args = load_model_from_checkpoint(checkpoint)
+
+    stats = predict_fasta(model, model_args, [str(tmp_path / "in.fasta")], str(tmp_path / "out"), max_tokens=64,
+                          build_workers=build_workers, queue_size=2)
+    assert stats["num_proteins"] == 5 and stats["skipped"] == ["nonstandard"]
+    assert stats["num_residues"] == 12 + 30 + 31 + 45 + 600
+    for pid, seq in records[:-1]:
+        with open(tmp_path / "out" / f"{pid}.pdb") as f:
+            ca_lines = [l for l in f if l.startswith("ATOM") and l[12:16].strip() == "CA"]
+        assert len(ca_lines) == len(seq)
+
+
+@pytest.mark.parametrize("store_pdb", [False, True])
+def test_predict_fasta_with_cache(checkpoint, tmp_path, store_pdb):
+    rng = np.random.RandomState(2)
+    records = [(f"prot{i}", random_seq(rng, l)) for i, l in enumerate([12, 30, 45])]
+    records += [("copy_of_prot1", records[1][1])]
+    write_fasta(tmp_path / "in.fasta", records)
+    model, model_args = load_model_from_checkpoint(checkpoint)
+    cache = PredictionCache(str(tmp_path / "cache"), model_digest(model, model_args), store_pdb=store_pdb)
+
+    stats = predict_fasta(model, model_args, [str(tmp_path / "in.fasta")], str(tmp_path / "out1"), cache=cache)
+    assert stats["num_proteins"] == 4 and cache.stats()["entries"] == 3
+
+    write_fasta(tmp_path / "more.fasta", records + [("new", random_seq(rng, 20))])
+    stats = predict_fasta(model, model_args, [str(tmp_path / "more.fasta")], str(tmp_path / "out2"), cache=cache)
+    assert stats["num_proteins"] == 5 and stats["cache_hits"] == 4 and cache.stats()["entries"] == 4
+    for pid, _ in records:
+        with open(tmp_path / "out1" / f"{pid}.pdb") as f1, open(tmp_path / "out2" / f"{pid}.pdb") as f2:
+            assert f1.read() == f2.read()
+
+
+def fail_to_build(item):
+    raise ValueError(f"Could not build {item[0]}.")
+
+
+@pytest.mark.parametrize("build_workers", [0, 2])
+def test_predict_fasta_stage_failure(checkpoint, tmp_path, monkeypatch, build_workers):
+    rng = np.random.RandomState(3)
+    write_fasta(tmp_path / "in.fasta", [(f"prot{i}", random_seq(rng, 20)) for i in range(40)])
+    model, model_args = load_model_from_checkpoint(checkpoint)
+    monkeypatch.setattr(predict_fasta_module, "build_structure", fail_to_build)
+
+    # The failure must be raised rather than leaving the pipeline waiting on its full queues
+    result = []
+
+    def run():
+        try:
+            predict_fasta(model, model_args, [str(tmp_path / "in.fasta")], str(tmp_path / "out"), max_batch_size=4,
+                          build_workers=build_workers, queue_size=1)
+        except ValueError as e:
+            result.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=60)
+    assert not thread.is_alive()
+    assert len(result) == 1 and str(result[0]).startswith("Could not build prot")
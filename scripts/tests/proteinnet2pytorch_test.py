@@ -0,0 +1,61 @@
+import os
+import sys
+sys.path.append("scripts")
+
+import pytest
+
+import proteinnet2pytorch
+from proteinnet2pytorch import load_completed_ids, merge_result_shards, process_ids_resumably
+from proteinnet_errors import ERRORS
+
+PNIDS = [f"{i}ABC_1_A" for i in range(7)]
+
+
+def stub_work(outcomes, run):
+    """ Returns a replacement for work() that fails with outcomes[pnid] (an error name) or succeeds. """
+    def work(pnid):
+        if pnid in outcomes:
+            return ERRORS[outcomes[pnid]]
+        return "angles", "coords", f"sequence from run {run}", pnid
+    return work
+
+
+def test_process_ids_resumably(tmp_path, monkeypatch):
+    work_dir = str(tmp_path / "processed")
+    outcomes = {PNIDS[1]: "NSAA_ERRORS", PNIDS[2]: "PARSING_ERROR_OSERROR", PNIDS[3]: "UNKNOWN_EXCEPTIONS"}
+    monkeypatch.setattr(proteinnet2pytorch, "work", stub_work(outcomes, run=1))
+    transient = process_ids_resumably(PNIDS[:5], work_dir, shard_size=2)
+
+    # Only successes and permanent errors are recorded, in shards of shard_size
+    assert transient == {PNIDS[2]: ERRORS["PARSING_ERROR_OSERROR"], PNIDS[3]: ERRORS["UNKNOWN_EXCEPTIONS"]}
+    assert sorted(f for f in os.listdir(work_dir)) == ["results_000000.ids", "results_000000.pt",
+                                                       "results_000001.ids", "results_000001.pt"]
+    assert load_completed_ids(work_dir) == {PNIDS[0], PNIDS[1], PNIDS[4]}
+
+    # Resuming skips recorded structures and retries transient failures
+    monkeypatch.setattr(proteinnet2pytorch, "work", stub_work({}, run=2))
+    assert process_ids_resumably(PNIDS, work_dir, shard_size=2) == {}
+    assert "results_000003.pt" in os.listdir(work_dir) and "results_000004.pt" not in os.listdir(work_dir)
+    results = merge_result_shards(work_dir, PNIDS)
+    assert set(results) == set(PNIDS)
+    assert results[PNIDS[1]] == ERRORS["NSAA_ERRORS"]
+    assert [results[pnid][2] for pnid in (PNIDS[0], PNIDS[4])] == ["sequence from run 1"] * 2
+    assert [results[pnid][2] for pnid in (PNIDS[2], PNIDS[3], PNIDS[5], PNIDS[6])] == ["sequence from run 2"] * 4
+
+
+def test_merge_result_shards_ignores_unfinished_shards(tmp_path, monkeypatch):
+    work_dir = str(tmp_path)
+    monkeypatch.setattr(proteinnet2pytorch, "work", stub_work({}, run=1))
+    process_ids_resumably(PNIDS[:3], work_dir, shard_size=10)
+    os.remove(os.path.join(work_dir, "results_000000.ids"))  # As if interrupted before the .ids file was written
+    assert load_completed_ids(work_dir) == set()
+    assert merge_result_shards(work_dir, PNIDS) == {}
+
+    process_ids_resumably(PNIDS[:3], work_dir, shard_size=10)
+    assert set(merge_result_shards(work_dir, PNIDS[1:])) == set(PNIDS[1:3])
+
+
+@pytest.mark.parametrize("name,transient", [("NSAA_ERRORS", False), ("SHORT_ERRORS", False),
+                                            ("PARSING_ERROR_OSERROR", True), ("UNKNOWN_EXCEPTIONS", True)])
+def test_is_transient(name, transient):
+    assert ERRORS.is_transient(ERRORS[name]) == transient
@@ -0,0 +1,85 @@
+import io
+import os
+import sys
+sys.path.append("scripts")
+
+import numpy as np
+import pytest
+
+from proteinnet_parsing import (read_protein_from_file, read_protein_record, read_numeric_block,
+                                process_file_sharded, iter_preprocessed_shards, load_preprocessed_sequences,
+                                shard_index_path)
+
+
+def make_record(pnid, seq, seed, secondary=True):
+    """ Returns the text of a raw ProteinNet record for seq with random evolutionary and tertiary data. """
+    rng = np.random.RandomState(seed)
+    lines = ["[ID]", pnid, "[PRIMARY]", seq, "[EVOLUTIONARY]"]
+    lines += [" ".join(f"{v:.4f}" for v in row) for row in rng.rand(21, len(seq))]
+    if secondary:
+        lines += ["[SECONDARY]", "".join(rng.choice(list("LHE"), len(seq)))]
+    lines += ["[TERTIARY]"]
+    lines += ["\t".join(f"{v:.1f}" for v in row) for row in rng.uniform(-1000, 1000, (3, 3 * len(seq)))]
+    lines += ["[MASK]", "".join(rng.choice(list("+-"), len(seq))), ""]
+    return "\n".join(lines) + "\n"
+
+
+RECORDS = [("1ABC_1_A", "MKVLA", True), ("30#2DEF_1_B", "GW", False), ("TBM#T0950", "ACDEFGHIKL", True),
+           ("3GHI_2_C", "Y", True), ("4JKL_1_D", "PPQ", False)]
+
+
+@pytest.fixture
+def raw_file(tmp_path):
+    path = tmp_path / "raw" / "training_100"
+    os.makedirs(path.parent)
+    with open(path, "w") as f:
+        f.write("".join(make_record(pnid, seq, i, sec) for i, (pnid, seq, sec) in enumerate(RECORDS)))
+    return str(path)
+
+
+@pytest.mark.parametrize("include_tertiary", [False, True])
+def test_read_protein_record_matches_read_protein_from_file(raw_file, include_tertiary):
+    with open(raw_file) as f1, open(raw_file) as f2:
+        while True:
+            expected = read_protein_from_file(f1, include_tertiary)
+            record = read_protein_record(f2, include_tertiary)
+            if expected is None:
+                assert record is None
+                break
+            assert record.keys() == expected.keys()
+            for key in expected:
+                if key in ("evolutionary", "tertiary"):
+                    assert np.allclose(record[key], np.array(expected[key]))
+                else:
+                    assert record[key] == expected[key]
+
+
+def test_read_protein_record_skips_evolutionary(raw_file):
+    with open(raw_file) as f:
+        record = read_protein_record(f, include_tertiary=True, include_evolutionary=False)
+    assert "evolutionary" not in record and record["tertiary"].shape == (3, 15) and record["primary"] == "MKVLA"
+
+
+def test_read_numeric_block():
+    block = read_numeric_block(io.StringIO("1 2 3\n4 5 6\nnext line\n"), 2)
+    assert block.shape == (2, 3) and block.dtype == np.float32 and block[1, 2] == 6
+    assert read_numeric_block(io.StringIO("\n\n\n"), 3).shape == (3, 0)
+
+
+def test_process_file_sharded(raw_file, tmp_path):
+    torch_dict_dir = str(tmp_path / "torch")
+    os.makedirs(torch_dict_dir)
+    process_file_sharded(raw_file, torch_dict_dir, shard_size=2)
+
+    with open(shard_index_path(torch_dict_dir, "training_100.pt")) as f:
+        assert f.read().splitlines() == [f"training_100.{i:05}.pt" for i in range(3)]
+    with open(raw_file + ".ids") as f:
+        assert f.read().splitlines() == [pnid for pnid, _, _ in RECORDS]
+    shards = list(iter_preprocessed_shards(torch_dict_dir, "training_100.pt"))
+    assert [len(s) for s in shards] == [2, 2, 1]
+    merged = {pnid: record for shard in shards for pnid, record in shard.items()}
+    assert {pnid: r["primary"] for pnid, r in merged.items()} == {pnid: seq for pnid, seq, _ in RECORDS}
+    assert "tertiary" not in merged["1ABC_1_A"] and merged["1ABC_1_A"]["evolutionary"].shape == (21, 5)
+
+    assert load_preprocessed_sequences(torch_dict_dir, "training_100.pt", ["3GHI_2_C", "1ABC_1_A"]) == \
+        {"1ABC_1_A": "MKVLA", "3GHI_2_C": "Y"}
@@ -0,0 +1,67 @@
+import gzip
+import sys
+sys.path.append("scripts")
+import numpy as np
+import prody as pr
+import pytest
+
+from structure_cache import StructureCache, find_local_structure_file
+
+PDB_TEXT = """\
+ATOM      1  N   GLY A   1      11.104   6.134  -6.504  1.00  0.00           N
+ATOM      2  CA  GLY A   1      11.639   6.071  -5.147  1.00  0.00           C
+ATOM      3  C   GLY A   1      12.552   7.255  -4.830  1.00  0.00           C
+ATOM      4  O   GLY A   1      13.102   7.889  -5.738  1.00  0.00           O
+ATOM      5  N   ALA A   2      12.704   7.539  -3.541  1.00  0.00           N
+ATOM      6  CA  ALA A   2      13.554   8.641  -3.097  1.00  0.00           C
+ATOM      7  C   ALA A   2      14.983   8.185  -2.828  1.00  0.00           C
+ATOM      8  O   ALA A   2      15.250   7.003  -2.604  1.00  0.00           O
+ATOM      9  CB  ALA A   2      13.000   9.277  -1.825  1.00  0.00           C
+TER      10      ALA A   2
+ATOM     11  N   SER B   1       1.104   6.134  -6.504  1.00  0.00           N
+ATOM     12  CA  SER B   1       1.639   6.071  -5.147  1.00  0.00           C
+ATOM     13  C   SER B   1       2.552   7.255  -4.830  1.00  0.00           C
+ATOM     14  O   SER B   1       3.102   7.889  -5.738  1.00  0.00           O
+ATOM     15  CB  SER B   1       0.500   5.100  -4.800  1.00  0.00           C
+ATOM     16  OG  SER B   1       0.900   3.800  -5.100  1.00  0.00           O
+TER      17      SER B   1
+HETATM   18  O   HOH B 101       5.000   5.000   5.000  1.00  0.00           O
+END
+"""
+
+
+@pytest.fixture
+def pdb_dir(tmp_path):
+    with gzip.open(tmp_path / "1abc.pdb.gz", "wt") as f:
+        f.write(PDB_TEXT)
+    return tmp_path
+
+
+def test_find_local_structure_file(pdb_dir):
+    path, fmt = find_local_structure_file("1ABC", str(pdb_dir))
+    assert path == str(pdb_dir / "1abc.pdb.gz") and fmt == "pdb"
+    assert find_local_structure_file("2xyz", str(pdb_dir)) == (None, None)
+
+
+@pytest.mark.parametrize("chid", ["A", "B"])
+def test_cached_chain_matches_parsed_chain(pdb_dir, chid):
+    expected = pr.parsePDB(str(pdb_dir / "1abc.pdb.gz"), chain=chid)
+    for _ in range(2):
+        # A fresh cache object each time ensures the second pass is read from disk rather than memory
+        cache = StructureCache(str(pdb_dir / "cache"), str(pdb_dir))
+        chain = cache.get_chain("1abc", chid)
+        assert np.allclose(chain.getCoords(), expected.getCoords(), atol=1e-4)
+        assert list(chain.getNames()) == list(expected.getNames())
+        assert list(chain.getResnums()) == list(expected.getResnums())
+        assert chain.getSequence() == expected.getSequence()
+        assert chain.select("protein and not hetero").numAtoms() == \
+               expected.select("protein and not hetero").numAtoms()
+
+
+def test_cache_entries_are_content_addressed(pdb_dir):
+    cache = StructureCache(str(pdb_dir / "cache"), str(pdb_dir))
+    cache.get_chain("1abc", "A")
+    cache.get_chain("1abc", "B")
+    assert len(list((pdb_dir / "cache").rglob("*.npz"))) == 1
+    assert cache.get_chain("1abc", "Z") is None
+    assert cache.get_chain("2xyz", "A") is None
@@ -0,0 +1,84 @@
+import sys
+sys.path.append("scripts")
+import numpy as np
+import torch
+
+import proteinnet2pytorch
+from synthetic_dataset import create_synthetic_data_dict, make_synthetic_protein, sample_lengths
+from protein_transformer.dataset import VALID_SPLITS
+from protein_transformer.losses import angles_to_coords
+from protein_transformer.protein.Sequence import VOCAB
+from protein_transformer.protein.Sequence import ONE_TO_THREE_LETTER_MAP
+from protein_transformer.protein.SidechainBuildInfo import SC_BUILD_INFO
+from protein_transformer.protein.Structure import NUM_PREDICTED_ANGLES, NUM_PREDICTED_COORDS
+
+
+def test_make_synthetic_protein_conventions():
+    ang, crd, seq = make_synthetic_protein(30, seed=3)
+    assert ang.shape == (30, NUM_PREDICTED_ANGLES) and crd.shape == (30 * NUM_PREDICTED_COORDS, 3)
+    assert len(seq) == 30
+    # Terminal backbone angles are unmeasurable
+    assert np.isnan(ang[0, 0]) and np.isnan(ang[-1, 1:3]).all() and np.isnan(ang[-1, 4:6]).all()
+    assert not np.isnan(ang[1:-1, :6]).any()
+    # Padding atoms and sidechain angles are missing, according to each residue's size
+    crd = crd.reshape(30, NUM_PREDICTED_COORDS, 3)
+    for i, aa in enumerate(seq):
+        n_atoms = 4 + len(SC_BUILD_INFO[ONE_TO_THREE_LETTER_MAP[aa]]["atom-names"])
+        assert not np.isnan(crd[i, :n_atoms]).any() and np.isnan(crd[i, n_atoms:]).all()
+        if aa == "G":
+            assert np.isnan(ang[i, 6:]).all()
+
+
+def test_synthetic_angles_rebuild_structure():
+    # The measured angles must reproduce the synthetic backbone (up to a rigid transformation). The last residue's
+    # oxygen is excluded, because it is placed using psi, which cannot be measured for the last residue.
+    ang, crd, seq = make_synthetic_protein(12, seed=4)
+    rebuilt = angles_to_coords(torch.tensor(np.nan_to_num(ang), dtype=torch.float32),
+                               torch.tensor(VOCAB.str2ints(seq, add_sos_eos=False)))
+    crd = crd.reshape(12, NUM_PREDICTED_COORDS, 3)[:, :4].reshape(-1, 3)[:-1]
+    rebuilt = rebuilt.reshape(12, NUM_PREDICTED_COORDS, 3)[:, :4].reshape(-1, 3)[:-1]
+    true_d = np.linalg.norm(crd[:, None] - crd[None], axis=-1)
+    rebuilt = rebuilt.numpy()
+    pred_d = np.linalg.norm(rebuilt[:, None] - rebuilt[None], axis=-1)
+    observed = ~np.isnan(true_d)
+    assert np.abs(true_d[observed] - pred_d[observed]).max() < 0.05
+
+
+def test_missing_residues():
+    ang, crd, _ = make_synthetic_protein(200, seed=5, missing_rate=0.2)
+    missing = np.isnan(crd.reshape(200, NUM_PREDICTED_COORDS, 3)).all(axis=(1, 2))
+    assert 0 < missing.sum() < 200
+    assert np.isnan(ang[missing]).all()
+
+
+def test_sample_lengths():
+    rng = np.random.RandomState(0)
+    lengths = sample_lengths(rng, num_residues=5000, min_len=20, max_len=100)
+    assert lengths.sum() >= 5000 and lengths[:-1].sum() < 5000
+    assert lengths.min() >= 20 and lengths.max() <= 100
+    bin_data = {"hist_bins": np.asarray([50, 60]), "bin_probs": np.asarray([0., 1.])}
+    lengths = sample_lengths(rng, num_proteins=100, bin_data=bin_data)
+    assert ((lengths > 50) & (lengths <= 60)).all()
+
+
+def test_create_synthetic_data_dict():
+    data = create_synthetic_data_dict(num_train=4, num_valid=1, num_test=1, seed=0, min_len=10, max_len=20)
+    assert len(data["train"]["seq"]) == 4 and len(data["test"]["seq"]) == 1
+    for split in VALID_SPLITS:
+        assert len(data[f"valid-{split}"]["seq"]) == 1
+    assert data["train"]["ang"][0].shape[1] == NUM_PREDICTED_ANGLES * 2
+    assert data["settings"]["angle_means"].shape == (NUM_PREDICTED_ANGLES * 2,)
+    assert data["settings"]["max_len"] <= 20
+    assert data["train"]["seq_ints"][0].dtype == np.int8
+    assert list(data["train"]["lens"]) == list(map(len, data["train"]["seq"]))
+    assert not data["train"]["has_missing"].any()
+    assert data["pnids"]["SYN0_1_A"]["subset"] == "train" and data["pnids"]["10#SYNV0_1_A"]["subset"] == "valid-10"
+    # The converter's module-level settings are left alone
+    assert not hasattr(proteinnet2pytorch, "CASP_VERSION") and not hasattr(proteinnet2pytorch, "VALID_SPLITS")
+
+    # Datasets generated with the same seed are identical, and can follow the settings of another dataset
+    again = create_synthetic_data_dict(num_train=4, num_valid=1, num_test=1, seed=0, min_len=10, max_len=20)
+    assert all(np.array_equal(a, b, equal_nan=True) for a, b in zip(data["train"]["crd"], again["train"]["crd"]))
+    ref = create_synthetic_data_dict(num_train=3, num_valid=1, num_test=1, seed=1, min_len=10, max_len=20,
+                                     reference_settings=data["settings"])
+    assert len(ref["train"]["seq"]) == 3